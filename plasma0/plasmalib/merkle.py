@@ -0,0 +1,183 @@
+from eth_hash.auto import keccak
+
+'''
+Iterative Merkle & Merkle-sum tree engine shared by every tree builder.
+
+Every node of a tree has the same width, so a level is kept as one contiguous
+bytes buffer & the two children of a parent are one slice of it. Levels are
+built bottom up in a loop; a node without a sibling at the end of a level is
+carried up unchanged. Parent functions take the 2 * node_size bytes of a pair
+of children & return (parent node, value stored under the parent in the DB):
+
+- `hash_parent`: plain 32 byte nodes, parent = keccak(left + right)
+- `sum_hash_parent`: 32 byte nodes of hash [24 bytes] + sum [8 bytes], with the
+  first byte of each child replaced by 0 (left) or 1 (right) before hashing
+- `sum_hash40_parent`: 40 byte nodes of hash [32 bytes] + sum [8 bytes]
+
+Nodes are only written once the tree is done, in one write batch if the DB has
+them, rather than one `db.put` per node. Trees can also be indexed for proofs:
+the exact pair of children of every parent is stored under `get_children_key`,
+since a parent's value isn't always enough to find them again (eg. with
+`sum_hash_parent` the children's first bytes are overwritten).
+'''
+
+CHILDREN_PREFIX = b'children-'
+
+def get_children_key(parent):
+    return CHILDREN_PREFIX + parent
+
+
+def hash_parent(pair):
+    return keccak(pair), pair
+
+def sum_hash_parent(pair):
+    value = bytearray(pair)
+    value[0] = 0
+    value[32] = 1
+    value = bytes(value)
+    node_sum = int.from_bytes(pair[24:32], byteorder='big') + int.from_bytes(pair[56:64], byteorder='big')
+    return keccak(value)[0:24] + node_sum.to_bytes(8, byteorder='big'), value
+
+def sum_hash40_parent(pair):
+    node_sum = int.from_bytes(pair[32:40], byteorder='big') + int.from_bytes(pair[72:80], byteorder='big')
+    return keccak(pair) + node_sum.to_bytes(8, byteorder='big'), pair
+
+def iterate_levels(leaves, parent_fn, node_size, nodes=None, index=False):
+    ''' Yields every level of the tree as one bytes buffer, from the leaves up to the
+        root. Every new node is written with `nodes.put(parent, value)` if given, along
+        with its children if `index` is set.
+    '''
+    assert len(leaves) > 0
+    level = b''.join(leaves)
+    assert len(level) == len(leaves) * node_size
+    yield level
+    while len(level) > node_size:
+        count = len(level) // node_size
+        paired_bytes = (count - count % 2) * node_size
+        parents = []
+        for offset in range(0, paired_bytes, 2 * node_size):
+            pair = level[offset:offset + 2 * node_size]
+            parent, value = parent_fn(pair)
+            parents.append(parent)
+            if nodes is not None:
+                nodes.put(parent, value)
+                if index:
+                    nodes.put(get_children_key(parent), pair)
+        if count % 2 == 1:
+            parents.append(level[paired_bytes:])
+        level = b''.join(parents)
+        yield level
+
+def put_nodes(db, nodes):
+    ''' Writes (key, value) pairs in one write batch if the DB supports them '''
+    wb = db.write_batch() if hasattr(db, 'write_batch') else db
+    for key, value in nodes:
+        wb.put(key, value)
+    if wb is not db:
+        wb.write()
+
+def build_tree(leaves, parent_fn, node_size, db=None, index=False):
+    ''' Returns the root of the tree over `leaves`, storing every parent node in `db` if
+        given--in one write batch if the DB supports them--& its children if `index` is set.
+    '''
+    nodes = db
+    if db is not None and hasattr(db, 'write_batch'):
+        nodes = db.write_batch()
+    for level in iterate_levels(leaves, parent_fn, node_size, nodes, index):
+        pass
+    if nodes is not db:
+        nodes.write()
+    return level
+
+
+class NodeList(list):
+    ''' Collects (key, value) pairs instead of writing them, eg. in a worker process '''
+    def put(self, key, value):
+        self.append((key, value))
+
+def build_subtree(args):
+    ''' Pool task: returns (root, nodes) of the tree over one chunk of leaves '''
+    leaves, parent_fn, node_size, store, index = args
+    nodes = NodeList() if store else None
+    return build_tree(leaves, parent_fn, node_size, nodes, index), nodes
+
+def build_tree_parallel(leaves, parent_fn, node_size, db=None, index=False, pool=None, chunk_leaves=2**12):
+    ''' Same as `build_tree`, with the subtrees over each `chunk_leaves` leaves built
+        across `pool`, then merged serially. `chunk_leaves` is a power of two, so every
+        chunk's subtree is exactly the matching part of the serial tree--even the
+        last chunk's, whose root is carried up unchanged--& the root is identical.
+    '''
+    assert chunk_leaves & (chunk_leaves - 1) == 0
+    if pool is None or len(leaves) <= chunk_leaves:
+        return build_tree(leaves, parent_fn, node_size, db, index)
+    tasks = [(leaves[i:i + chunk_leaves], parent_fn, node_size, db is not None, index) for i in range(0, len(leaves), chunk_leaves)]
+    subtree_roots = []
+    nodes = None
+    if db is not None:
+        nodes = db.write_batch() if hasattr(db, 'write_batch') else db
+    for subtree_root, subtree_nodes in pool.map(build_subtree, tasks):
+        subtree_roots.append(subtree_root)
+        if nodes is not None:
+            for key, value in subtree_nodes:
+                nodes.put(key, value)
+    for level in iterate_levels(subtree_roots, parent_fn, node_size, nodes, index):
+        pass
+    if nodes is not None and nodes is not db:
+        nodes.write()
+    return level
+
+
+class IncrementalTree:
+    '''
+    Append-only tree with the same shape & root as `build_tree`, built as leaves
+    arrive. Only the frontier is kept: `frontier[h]` is the root of the last
+    complete subtree of 2**h leaves which doesn't have a right sibling yet, so
+    memory is O(log n) & each append does amortized O(1) hashing. Finished
+    parents are written to `db` (with their children if `index` is set) as soon
+    as they are made.
+
+    `get_root` folds the frontier into the root of the leaves so far without
+    storing anything, so it can be called at any time; `seal` does the same but
+    stores the fold's nodes too.
+    '''
+    def __init__(self, parent_fn, db=None, index=False):
+        self.parent_fn = parent_fn
+        self.db = db
+        self.index = index
+        self.frontier = []
+        self.count = 0
+
+    def combine(self, pair, store):
+        parent, value = self.parent_fn(pair)
+        if store and self.db is not None:
+            self.db.put(parent, value)
+            if self.index:
+                self.db.put(get_children_key(parent), pair)
+        return parent
+
+    def append(self, leaf):
+        node = leaf
+        height = 0
+        # Carry completed subtrees up like a binary counter
+        while height < len(self.frontier) and self.frontier[height] is not None:
+            node = self.combine(self.frontier[height] + node, True)
+            self.frontier[height] = None
+            height += 1
+        if height == len(self.frontier):
+            self.frontier.append(node)
+        else:
+            self.frontier[height] = node
+        self.count += 1
+
+    def get_root(self, store=False):
+        ''' Returns the root of every leaf appended so far, or None if there are none '''
+        root = None
+        for node in self.frontier:
+            if node is None:
+                continue
+            # An incomplete subtree on the right is carried up until it meets its left sibling
+            root = node if root is None else self.combine(node + root, store)
+        return root
+
+    def seal(self):
+        return self.get_root(True)
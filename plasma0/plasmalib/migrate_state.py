@@ -0,0 +1,108 @@
+'''
+Offline migration of a State DB from the v1 range layout to schema v2.
+
+v1 stored every range under three keys plus a nonce key:
+- <token_id><start>-0offset   -> offset [32 bytes]
+- <token_id><start>-1owner    -> owner [20 bytes]
+- <owner><token_id><start>    -> b'1'
+- <owner>-nonce               -> nonce [8 bytes]
+v2 stores one range key whose value packs end & owner, see `plasmalib.state`.
+
+Usage (with the operator stopped):
+    python -m plasmalib.migrate_state <db_dir>
+'''
+import sys
+import plyvel
+from eth_utils import big_endian_to_int
+from plasmalib.state import (
+    SCHEMA_VERSION,
+    SCHEMA_VERSION_KEY,
+    RANGE_PREFIX,
+    get_range_key,
+    decode_range_key,
+    encode_range_value,
+    decode_range_value,
+    get_owner_to_start_key,
+    get_owner_to_nonce_key,
+    get_balance_key,
+)
+from plasmalib.utils import (
+    int_to_big_endian8,
+    int_to_big_endian32,
+)
+
+V1_OFFSET_SUFFIX = b'-0offset'
+V1_OWNER_SUFFIX = b'-1owner'
+V1_NONCE_SUFFIX = b'-nonce'
+V1_OWNER_TO_START_VALUE = b'1'
+
+def migrate_v1_to_v2(db, batch_size=10000):
+    ''' Rewrites every v1 key in `db` into the v2 layout, in WriteBatches of about
+        `batch_size` keys. Batches only end between ranges, so every range is rewritten
+        (& its v1 keys deleted) within one batch, & balances & the schema version are
+        written last from the migrated ranges. So an interrupted migration can simply
+        be re-run: it picks up the v1 keys which are left. Returns the number of ranges
+        migrated by this run.
+    '''
+    assert db.get(SCHEMA_VERSION_KEY) is None, 'DB is not in the v1 layout'
+    num_ranges = 0
+    num_keys = 0
+    offsets = {}
+    wb = db.write_batch()
+    # Iterate over a snapshot so the keys we write aren't visited again
+    with db.snapshot() as sn:
+        for key, value in sn.iterator():
+            if len(key) == 48 and key.endswith(V1_OFFSET_SUFFIX):
+                # Offset keys sort right before the owner key of the same range, which
+                # deletes both
+                offsets[key[0:40]] = big_endian_to_int(value)
+                continue
+            elif len(key) == 47 and key.endswith(V1_OWNER_SUFFIX):
+                token_id, start = key[0:8], key[8:40]
+                end = big_endian_to_int(start) + offsets.pop(key[0:40])
+                wb.put(get_range_key(token_id, start), encode_range_value(end, value))
+                wb.delete(key[0:40] + V1_OFFSET_SUFFIX)
+                num_ranges += 1
+            elif len(key) == 60 and value == V1_OWNER_TO_START_VALUE:
+                wb.put(get_owner_to_start_key(key[0:20], key[20:28], key[28:60]), b'')
+            elif len(key) == 26 and key.endswith(V1_NONCE_SUFFIX):
+                wb.put(get_owner_to_nonce_key(key[0:20]), value)
+            else:
+                continue
+            wb.delete(key)
+            num_keys += 1
+            if num_keys >= batch_size and len(offsets) == 0:
+                wb.write()
+                wb = db.write_batch()
+                num_keys = 0
+    wb.write()
+    assert len(offsets) == 0, 'Found offset keys without a matching owner key'
+    # v1 had no balances, so compute them from every migrated range--including
+    # ones migrated by an earlier, interrupted run
+    balances = {}
+    for key, value in db.iterator(prefix=RANGE_PREFIX):
+        if len(key) != 41:
+            continue
+        token_id, start = decode_range_key(key)
+        end, owner = decode_range_value(value)
+        balance_key = get_balance_key(owner, token_id)
+        balances[balance_key] = balances.get(balance_key, 0) + end - start
+    wb = db.write_batch()
+    for balance_key, balance in balances.items():
+        wb.put(balance_key, int_to_big_endian32(balance))
+    wb.put(SCHEMA_VERSION_KEY, int_to_big_endian8(SCHEMA_VERSION))
+    wb.write()
+    return num_ranges
+
+def main(argv):
+    if len(argv) != 2:
+        print('usage: python -m plasmalib.migrate_state <db_dir>')
+        return 1
+    db = plyvel.DB(argv[1])
+    num_ranges = migrate_v1_to_v2(db)
+    db.close()
+    print('Migrated', num_ranges, 'ranges to schema version', SCHEMA_VERSION)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -1,7 +1,8 @@
 # THIS FILE CAN SERVE AS REFERENCE FOR FUTURE IMPLEMENTATIONS, BUT SHOULD NOT BE USED DIRECTLY
 
-from ethereum.utils import sha3, bytes_to_int, int_to_bytes, encode_hex
+from ethereum.utils import sha3, bytes_to_int, int_to_bytes
 import json
+from plasmalib.merkle import build_tree, sum_hash40_parent
 import random
 
 class EphemDB():
@@ -32,21 +33,7 @@ def fill_tx_list_with_notxs(txs):
     return full_tx_list
 
 def construct_tree(db, nodes):
-    if len(nodes) < 2:
-        return nodes[0]
-    remaining_nodes = []
-    for i in range(0, len(nodes), 2):
-        if i+1 == len(nodes):
-            remaining_nodes.append(nodes[i])
-            break
-        new_value = b''.join([nodes[i], nodes[i+1]])
-        new_sum = int_to_bytes(bytes_to_int(nodes[i+1][32:]) + bytes_to_int(nodes[i][32:])).rjust(8, b"\x00")
-        new_hash = b''.join([sha3(new_value), new_sum])
-        print('Left:', encode_hex(nodes[i]), 'parent:', encode_hex(new_hash))
-        print('Right:', encode_hex(nodes[i+1]), 'parent:', encode_hex(new_hash))
-        db.put(new_hash, new_value)
-        remaining_nodes.append(new_hash)
-    return construct_tree(db, remaining_nodes)
+    return build_tree(nodes, sum_hash40_parent, 40, db)
 
 def is_json(myjson):
     try:
@@ -1,22 +1,22 @@
-from plasmalib.utils import NullTx, bytes_to_int
+import heapq
+from plasmalib.utils import NullTx
+from plasmalib.merkle import build_tree, build_tree_parallel, hash_parent, sum_hash_parent, IncrementalTree, NodeList, put_nodes
 from eth_utils import int_to_big_endian
-from web3 import Web3
+from plasmalib.storage import MemoryBackend
 
-class EphemDB():
-    def __init__(self, kv=None):
-        self.kv = kv or {}
+# Block trees are kept in the same ordered in-memory map State can use
+EphemDB = MemoryBackend
 
-    def get(self, k):
-        return self.kv.get(k, None)
-
-    def put(self, k, v):
-        self.kv[k] = v
-
-    def delete(self, k):
-        del self.kv[k]
+# Buckets per task when hashing bucket tx trees over a pool
+BUCKET_CHUNK_SIZE = 1024
+# Bucket roots per subtree when hashing the block tree over a pool
+TREE_CHUNK_LEAVES = 2**12
 
 class TxBucket():
-    def __init__(self, db, start, offset, txs):
+    def __init__(self, db, start, offset, txs, root_hash=None):
+        ''' Stores the bucket's txs & hashes its tx tree, unless `root_hash` (with the
+            tree's nodes already stored) is given.
+        '''
         self.start = start
         self.txs = txs
         self.hashes = []
@@ -24,75 +24,98 @@ class TxBucket():
             self.hashes.append(tx.h)
             db.put(tx.h, tx.plaintext())
         if len(self.hashes) > 0:
-            root_hash = merklize(db, self.hashes)
+            if root_hash is None:
+                root_hash = merklize(db, self.hashes)
             self.tx_merkle_tree_root_hash = add_sum_to_hash(root_hash, offset)
 
 def add_sum_to_hash(raw_hash, int_sum):
     return b''.join([raw_hash[0:24], int_to_big_endian(int_sum).rjust(8, b"\x00")])
 
-def create_tx_buckets(db, txs):
-    starts_and_ends = set()
-    starts_and_ends.add(0)
-    txs_by_start = dict()
-    # Compute the bucket boundaries based on where txs start & end
-    for tx in txs:
-        starts_and_ends.add(tx.start)
-        starts_and_ends.add(tx.start+tx.offset)
-        if tx.start not in txs_by_start:
-            txs_by_start[tx.start] = []
-        txs_by_start[tx.start].append(tx)
+def create_tx_buckets(db, txs, pool=None):
+    ''' Returns the block's TxBuckets in coin order. With a `pool`, the buckets' tx
+        trees are hashed across it in chunks of BUCKET_CHUNK_SIZE buckets.
+    '''
+    if pool is None:
+        return list(iterate_tx_buckets(db, txs))
+    spans = list(iterate_bucket_spans(txs))
+    tasks = []
+    for i in range(0, len(spans), BUCKET_CHUNK_SIZE):
+        tasks.append([[tx.h for tx in span_txs] for start, offset, span_txs in spans[i:i + BUCKET_CHUNK_SIZE]])
+    root_hashes = []
+    nodes = NodeList()
+    for chunk_root_hashes, chunk_nodes in pool.map(merklize_buckets, tasks):
+        root_hashes += chunk_root_hashes
+        nodes += chunk_nodes
+    put_nodes(db, nodes)
+    return [TxBucket(db, start, offset, span_txs, root_hash) for (start, offset, span_txs), root_hash in zip(spans, root_hashes)]
+
+def merklize_buckets(bucket_hashes):
+    ''' Pool task: returns the tx tree root of each bucket & every node of the trees '''
+    nodes = NodeList()
+    return [merklize(nodes, hashes) for hashes in bucket_hashes], nodes
 
-    list_of_starts_and_ends = sorted(starts_and_ends)
-    active_txs = []
-    buckets = []
-    # Iterate over txs, adding them to their respective buckets
-    for idx, i in enumerate(list_of_starts_and_ends):
-        if i in txs_by_start:
-            active_txs = active_txs + txs_by_start[i]
+def iterate_tx_buckets(db, txs):
+    for start, offset, span_txs in iterate_bucket_spans(txs):
+        yield TxBucket(db, start, offset, span_txs)
+
+def iterate_bucket_spans(txs):
+    ''' Sweeps once over the points where txs start & end, yielding (start, offset, txs)
+        for every span between two points with the txs active over it, or a NullTx
+        if there are none. Active txs are kept in the order they started in (ties in the
+        order of `txs`).
+    '''
+    return iterate_sorted_bucket_spans(sorted(txs, key=lambda tx: tx.start))
+
+def iterate_sorted_bucket_spans(txs_by_start):
+    ''' `iterate_bucket_spans` over txs already sorted by start, which can be streamed,
+        eg. from a spill on disk. Only the active txs are held, with their ends in a
+        heap, & the next point is the next start or the earliest active end, so each
+        point costs O(log n) plus the size of its bucket.
+    '''
+    txs_by_start = iter(txs_by_start)
+    next_tx = next(txs_by_start, None)
+    num_started = 0
+    # Dicts keep insertion order, which is the order txs became active in
+    active_txs = {}
+    active_ends = []
+    i = 0
+    while True:
+        # Add all txs which start here
+        while next_tx is not None and next_tx.start == i:
+            active_txs[num_started] = next_tx
+            heapq.heappush(active_ends, (next_tx.start + next_tx.offset, num_started))
+            num_started += 1
+            next_tx = next(txs_by_start, None)
         # Remove all active txs which end here
-        active_txs = [tx for tx in active_txs if tx.start + tx.offset != i]
-        if len(active_txs) == 0 and idx+1 == len(list_of_starts_and_ends):
-            continue
-        bucket_offset = list_of_starts_and_ends[idx+1] - i
-        if len(active_txs) == 0 and idx+1 != len(list_of_starts_and_ends):
-            buckets.append(TxBucket(db, i, bucket_offset, [NullTx(i, list_of_starts_and_ends[idx+1] - i)]))
+        while len(active_ends) > 0 and active_ends[0][0] <= i:
+            del active_txs[heapq.heappop(active_ends)[1]]
+        if len(active_ends) > 0:
+            next_point = active_ends[0][0]
+            if next_tx is not None:
+                next_point = min(next_point, next_tx.start)
+        elif next_tx is not None:
+            next_point = next_tx.start
+        else:
+            return
+        bucket_offset = next_point - i
+        if len(active_txs) == 0:
+            yield i, bucket_offset, [NullTx(i, bucket_offset)]
         else:
-            buckets.append(TxBucket(db, i, bucket_offset, active_txs))
-    return buckets
+            yield i, bucket_offset, list(active_txs.values())
+        i = next_point
 
-def set_first_bit(byte_value, one_or_zero):
-    if one_or_zero == 0:
-        return b"\x00"
-    if one_or_zero == 1:
-        return b"\x01"
+def construct_tree(db, nodes, pool=None):
+    ''' Builds the Merkle-sum tree of bucket roots & returns the block root. The tree
+        is indexed so `plasmalib.operator.proofs` can prove coins against it. With a
+        `pool`, the lower levels are hashed across it.
+    '''
+    return build_tree_parallel(nodes, sum_hash_parent, 32, db, index=True, pool=pool, chunk_leaves=TREE_CHUNK_LEAVES)
 
-def construct_tree(db, nodes):
-    if len(nodes) == 1:
-        return nodes[0]
-    remaining_nodes = []
-    for i in range(0, len(nodes), 2):
-        if i+1 == len(nodes):
-            remaining_nodes.append(nodes[i])
-            break
-        left_value = nodes[i][1:].rjust(32, set_first_bit(nodes[i][0], 0))
-        right_value = nodes[i+1][1:].rjust(32, set_first_bit(nodes[i+1][0], 1))
-        new_value = b''.join([left_value, right_value])
-        new_sum = bytes_to_int(nodes[i+1][24:]) + bytes_to_int(nodes[i][24:])
-        new_hash = add_sum_to_hash(Web3.sha3(new_value), new_sum)
-        db.put(new_hash, new_value)
-        remaining_nodes.append(new_hash)
-    return construct_tree(db, remaining_nodes)
+def new_block_tree(db):
+    ''' Returns an IncrementalTree which bucket roots can be appended to in coin order as
+        they are finalized, giving the same root & index as `construct_tree`.
+    '''
+    return IncrementalTree(sum_hash_parent, db, index=True)
 
 def merklize(db, nodes):
-    if len(nodes) == 1:
-        return nodes[0]
-    remaining_nodes = []
-    for i in range(0, len(nodes), 2):
-        if i+1 == len(nodes):
-            remaining_nodes.append(nodes[i])
-            break
-        new_value = b''.join([nodes[i], nodes[i+1]])
-        new_hash = Web3.sha3(new_value)
-        db.put(new_hash, new_value)
-        remaining_nodes.append(new_hash)
-    return merklize(db, remaining_nodes)
+    return build_tree(nodes, hash_parent, 32, db)
@@ -0,0 +1,140 @@
+import mmap
+import os
+import struct
+from plasmalib.merkle import iterate_levels, sum_hash_parent
+
+'''
+Immutable flat-file block store: one file per block, read through mmap.
+
+Layout, all integers big endian:
+
+- header: magic [4 bytes] + version [4 bytes] + number of buckets [8 bytes] +
+  number of bucket -> tx references [8 bytes] + number of txs [8 bytes]
+- nodes: every level of the block's Merkle-sum tree, leaves (bucket roots) first
+  & the root last, as fixed-width hash [24 bytes] + sum [8 bytes] nodes. Level k+1
+  has ceil(count of level k / 2) nodes, so where each level starts follows from
+  the number of buckets.
+- bucket table: for each bucket, the index of its first reference [8 bytes],
+  plus one final entry for the end
+- references: the index of each tx in each bucket, in order [4 bytes each]
+- tx table: where each tx's plaintext starts in the tx data [8 bytes], plus
+  one final entry for the end
+- tx data: every distinct tx plaintext, back to back
+
+Nothing is parsed on open: a proof is a handful of slices of the mapped file,
+so serving proofs for old blocks costs page cache reads, & a block can be
+archived or copied as a single file.
+'''
+
+BLOCK_FILE_MAGIC = b'PLBK'
+BLOCK_FILE_VERSION = 1
+HEADER = struct.Struct('>4sIQQQ')
+NODE_SIZE = 32
+
+
+def get_level_counts(num_leaves):
+    counts = [num_leaves]
+    while counts[-1] > 1:
+        counts.append((counts[-1] + 1) // 2)
+    return counts
+
+def write_block_file(path, buckets):
+    ''' Writes the block made of `buckets` (TxBuckets in coin order) to `path` & returns its root '''
+    tx_indexes = {}
+    tx_plaintexts = []
+    bucket_table = [0]
+    references = []
+    for bucket in buckets:
+        for tx in bucket.txs:
+            if tx.h not in tx_indexes:
+                tx_indexes[tx.h] = len(tx_plaintexts)
+                tx_plaintexts.append(tx.plaintext())
+            references.append(tx_indexes[tx.h])
+        bucket_table.append(len(references))
+    tx_table = [0]
+    for plaintext in tx_plaintexts:
+        tx_table.append(tx_table[-1] + len(plaintext))
+    levels = list(iterate_levels([bucket.tx_merkle_tree_root_hash for bucket in buckets], sum_hash_parent, NODE_SIZE))
+    # Write to a temporary file first so a block file is never seen half written
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(HEADER.pack(BLOCK_FILE_MAGIC, BLOCK_FILE_VERSION, len(buckets), len(references), len(tx_plaintexts)))
+        for level in levels:
+            f.write(level)
+        f.write(struct.pack('>%dQ' % len(bucket_table), *bucket_table))
+        f.write(struct.pack('>%dI' % len(references), *references))
+        f.write(struct.pack('>%dQ' % len(tx_table), *tx_table))
+        for plaintext in tx_plaintexts:
+            f.write(plaintext)
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(tmp_path, path)
+    return levels[-1]
+
+
+class BlockFile:
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.num_buckets, num_references, self.num_txs = HEADER.unpack_from(self.mm, 0)
+        assert magic == BLOCK_FILE_MAGIC and version == BLOCK_FILE_VERSION
+        self.level_counts = get_level_counts(self.num_buckets)
+        self.level_offsets = []
+        offset = HEADER.size
+        for count in self.level_counts:
+            self.level_offsets.append(offset)
+            offset += count * NODE_SIZE
+        self.bucket_table_offset = offset
+        self.references_offset = self.bucket_table_offset + (self.num_buckets + 1) * 8
+        self.tx_table_offset = self.references_offset + num_references * 4
+        self.tx_data_offset = self.tx_table_offset + (self.num_txs + 1) * 8
+
+    def get_node(self, level, i):
+        offset = self.level_offsets[level] + i * NODE_SIZE
+        return self.mm[offset:offset + NODE_SIZE]
+
+    def get_node_sum(self, level, i):
+        return struct.unpack_from('>Q', self.mm, self.level_offsets[level] + i * NODE_SIZE + 24)[0]
+
+    def get_root(self):
+        return self.get_node(len(self.level_counts) - 1, 0)
+
+    def get_branch(self, coin):
+        ''' Returns (bucket index, leaf, branch) for the bucket containing `coin`, with
+            `branch` in the format of `proofs.get_branch`.
+        '''
+        level = len(self.level_counts) - 1
+        assert coin < self.get_node_sum(level, 0)
+        i = 0
+        offset = 0
+        branch = []
+        while level > 0:
+            left = 2 * i
+            level -= 1
+            if left + 1 == self.level_counts[level]:
+                # A node without a sibling was carried up unchanged
+                i = left
+                continue
+            left_sum = self.get_node_sum(level, left)
+            if coin < offset + left_sum:
+                branch.append((self.get_node(level, left + 1), False))
+                i = left
+            else:
+                branch.append((self.get_node(level, left), True))
+                offset += left_sum
+                i = left + 1
+        branch.reverse()
+        return i, self.get_node(0, i), branch
+
+    def get_bucket_txs(self, bucket):
+        ''' Returns the plaintext of every tx in a bucket '''
+        first, last = struct.unpack_from('>QQ', self.mm, self.bucket_table_offset + bucket * 8)
+        references = struct.unpack_from('>%dI' % (last - first), self.mm, self.references_offset + first * 4)
+        return [self.get_tx(i) for i in references]
+
+    def get_tx(self, i):
+        start, end = struct.unpack_from('>QQ', self.mm, self.tx_table_offset + i * 8)
+        return self.mm[self.tx_data_offset + start:self.tx_data_offset + end]
+
+    def close(self):
+        self.mm.close()
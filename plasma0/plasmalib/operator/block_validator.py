@@ -0,0 +1,89 @@
+import numpy as np
+from plasmalib.operator.transaction_validator import get_coin_map, group_swap_legs, is_complete_swap
+
+'''
+Vectorized validation of a whole block of txs against the coin map.
+
+The coin map & the block are loaded into NumPy arrays of starts, inclusive ends
+& owner ids--coordinates too big for int64 are replaced by their ranks--then every
+tx is checked at once:
+- containment & ownership: `searchsorted` finds the coin map range holding each
+  tx's start, which must also hold its end & belong to its sender
+- intra-block overlap: after sorting the block by start, a tx overlaps another if
+  it starts at or before the furthest end seen so far, or ends at or after the
+  next tx's start. Every tx in an overlap is invalid.
+- swaps: the legs of a swap are all valid or all invalid, & a swap missing legs
+  is invalid
+
+Txs are validated against the state before the block, so unlike calling `add_tx`
+in a loop, a tx can't spend coins received earlier in the same block.
+'''
+
+
+def load_coin_map(coin_map):
+    ''' Returns (starts, ends, owner ids, {owner: owner id}) for every range in a CoinMap,
+        with starts & ends as lists of ints
+    '''
+    owner_ids = {}
+    starts = []
+    ends = []
+    for chunk_starts, chunk_ends in zip(coin_map.ranges.starts, coin_map.ranges.ends):
+        starts += chunk_starts
+        ends += chunk_ends
+    owners = np.fromiter((owner_ids.setdefault(coin_map.owners[start], len(owner_ids)) for start in starts), dtype=np.int64, count=len(starts))
+    return starts, ends, owners, owner_ids
+
+def load_txs(txs, owner_ids):
+    ''' Returns (starts, inclusive ends, sender ids) of `txs`, with starts & ends as lists of
+        ints & -1 for senders who own nothing
+    '''
+    starts = [tx.start for tx in txs]
+    ends = [tx.start + tx.offset - 1 for tx in txs]
+    senders = np.fromiter((owner_ids.get(tx.sender, -1) for tx in txs), dtype=np.int64, count=len(txs))
+    return starts, ends, senders
+
+def to_coordinate_arrays(*coordinate_lists):
+    ''' Returns each list of coin coordinates as an int64 NumPy array, & the coordinate
+        of coin 0. Coins are 32 byte ints (eg. amounts in wei), so if any coordinate
+        doesn't fit in 64 bits, every coordinate is replaced by its rank among all of
+        them: validation only compares coordinates, so ranks give the same result.
+    '''
+    try:
+        return [np.array(coordinates, dtype=np.int64) for coordinates in coordinate_lists], 0
+    except OverflowError:
+        ranks = {coordinate: rank for rank, coordinate in enumerate(sorted(set([0]).union(*coordinate_lists)))}
+        return [np.fromiter((ranks[c] for c in coordinates), dtype=np.int64, count=len(coordinates)) for coordinates in coordinate_lists], ranks[0]
+
+def get_overlap_mask(starts, ends):
+    ''' Returns whether each [start, end] overlaps any other one '''
+    order = np.argsort(starts, kind='stable')
+    sorted_starts = starts[order]
+    sorted_ends = ends[order]
+    overlaps = np.zeros(len(starts), dtype=bool)
+    if len(starts) > 1:
+        furthest_end = np.maximum.accumulate(sorted_ends)
+        overlaps[1:] |= sorted_starts[1:] <= furthest_end[:-1]
+        overlaps[:-1] |= sorted_ends[:-1] >= sorted_starts[1:]
+    mask = np.empty(len(starts), dtype=bool)
+    mask[order] = overlaps
+    return mask
+
+def validate_block(db, txs):
+    ''' Returns a boolean NumPy array saying whether each tx in `txs` is valid '''
+    map_starts, map_ends, map_owners, owner_ids = load_coin_map(get_coin_map(db))
+    if len(map_starts) == 0:
+        return np.zeros(len(txs), dtype=bool)
+    starts, ends, senders = load_txs(txs, owner_ids)
+    (map_starts, map_ends, starts, ends), zero = to_coordinate_arrays(map_starts, map_ends, starts, ends)
+    # Index of the coin map range each tx starts in, -1 if it starts before every range
+    containing = np.searchsorted(map_starts, starts, side='right') - 1
+    found = containing >= 0
+    containing[~found] = 0
+    valid = found & (starts >= zero) & (ends >= starts)
+    valid &= map_ends[containing] >= ends
+    valid &= map_owners[containing] == senders
+    valid &= ~get_overlap_mask(starts, ends)
+    # A swap leg is only valid if every leg of its swap is in the block & valid
+    for legs in group_swap_legs(txs).values():
+        valid[legs] = valid[legs].all() and is_complete_swap([txs[i] for i in legs])
+    return valid
@@ -0,0 +1,93 @@
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+'''
+asyncio front end for State.
+
+Clients `await service.submit(tx, sig)` & get back whether their tx was accepted.
+Submitted txs are queued & coalesced into micro-batches: a batch is cut as soon as
+it holds `max_batch_size` txs or `max_batch_delay_ms` after its first tx arrived,
+whichever comes first. Each batch is validated & committed with one
+State.add_transaction call on a dedicated single thread executor--State isn't
+thread safe--so the event loop never blocks on signature checks or DB writes,
+& each caller's future is resolved with its own tx's result.
+
+Txs in the same batch which overlap are all rejected, just like a batch passed
+to State.add_transaction directly.
+'''
+
+
+class OperatorService:
+    def __init__(self, state, max_batch_size=256, max_batch_delay_ms=5, verify_sigs=True, pool=None):
+        self.state = state
+        self.max_batch_size = max_batch_size
+        self.max_batch_delay_ms = max_batch_delay_ms
+        self.verify_sigs = verify_sigs
+        # Optional process pool to fan signature checks out over
+        self.pool = pool
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.queue = None
+        self.task = None
+
+    def start(self):
+        ''' Starts the batching loop. Must be called from the event loop the service runs on. '''
+        self.queue = asyncio.Queue()
+        self.task = asyncio.ensure_future(self.run())
+
+    async def stop(self):
+        ''' Commits every tx queued so far, then stops the batching loop '''
+        await self.queue.put(None)
+        await self.task
+        self.executor.shutdown()
+
+    async def submit(self, tx, sig=None):
+        ''' Queues a TransferRecord & returns whether it was accepted once its batch is committed '''
+        assert not self.verify_sigs or sig is not None, 'A signature is required for every tx'
+        future = asyncio.get_event_loop().create_future()
+        await self.queue.put((tx, sig, future))
+        return await future
+
+    async def get_batch(self):
+        ''' Waits for the next tx, then collects more until the batch is full or its
+            deadline passes. Returns (batch, stopping).
+        '''
+        first = await self.queue.get()
+        if first is None:
+            return [], True
+        batch = [first]
+        deadline = time.time() + self.max_batch_delay_ms / 1000
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            try:
+                item = await asyncio.wait_for(self.queue.get(), remaining)
+            except asyncio.TimeoutError:
+                break
+            if item is None:
+                return batch, True
+            batch.append(item)
+        return batch, False
+
+    def commit_batch(self, txs, sigs):
+        return self.state.add_transaction(txs, sigs, self.pool)
+
+    async def run(self):
+        stopping = False
+        while not stopping:
+            batch, stopping = await self.get_batch()
+            if len(batch) == 0:
+                continue
+            txs = [tx for tx, sig, future in batch]
+            sigs = [sig for tx, sig, future in batch] if self.verify_sigs else None
+            try:
+                accepted = await asyncio.get_event_loop().run_in_executor(self.executor, self.commit_batch, txs, sigs)
+            except Exception as e:
+                for tx, sig, future in batch:
+                    if not future.cancelled():
+                        future.set_exception(e)
+                continue
+            for (tx, sig, future), tx_accepted in zip(batch, accepted):
+                if not future.cancelled():
+                    future.set_result(tx_accepted)
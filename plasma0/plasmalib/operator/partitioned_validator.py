@@ -0,0 +1,200 @@
+import bisect
+import multiprocessing
+from plasmalib.operator.transaction_validator import CoinMap, RangeList, get_coin_map, add_range, group_swap_legs, is_complete_swap
+
+'''
+Validates & applies txs in parallel by partitioning the coin space.
+
+Whether a tx is valid only depends on who owns its coins, & that only depends
+on earlier txs which touch the same coins. So [0, total_deposits) is split into
+`num_shards` contiguous shards, each run by a worker process with its own slice
+of the coin map, & every shard applies the txs touching it in block order:
+
+- a tx inside one shard is validated & applied by that shard alone
+- a tx crossing shard boundaries is split into one part per shard & goes through
+  two phases: every shard it touches votes on whether the sender owns its part,
+  at that tx's place in the shard's order, then the tx is committed by all of
+  them or by none
+- a swap goes through the same two phases as one unit, at its first leg's place:
+  each shard votes on all the parts of its legs at once, so the swap lands whole
+  or not at all. A swap missing legs is rejected outright.
+
+Voted units are decided in block order, so the verdicts & the final state are
+exactly those of `apply_txs`.
+'''
+
+
+def get_shard_bounds(total_deposits, num_shards):
+    ''' Returns the start of every shard, followed by total_deposits '''
+    return [total_deposits * k // num_shards for k in range(num_shards + 1)]
+
+def split_range(bounds, start, end):
+    ''' Splits the inclusive range [start, end] into (shard, start, end) parts. Coins past
+        the last shard stay in it.
+    '''
+    num_shards = len(bounds) - 1
+    shard = min(max(bisect.bisect_right(bounds, start) - 1, 0), num_shards - 1)
+    parts = []
+    while True:
+        if shard == num_shards - 1 or end < bounds[shard + 1]:
+            parts.append((shard, start, end))
+            return parts
+        parts.append((shard, start, bounds[shard + 1] - 1))
+        start = bounds[shard + 1]
+        shard += 1
+
+def get_coin_map_ranges(coin_map):
+    ''' Returns (start, end, owner) for every range in a CoinMap, in order '''
+    ranges = []
+    for chunk_starts, chunk_ends in zip(coin_map.ranges.starts, coin_map.ranges.ends):
+        for start, end in zip(chunk_starts, chunk_ends):
+            ranges.append((start, end, coin_map.owners[start]))
+    return ranges
+
+def parts_owned(coin_map, parts):
+    ''' Checks that every (sender, recipient, start, end) part is owned by its sender & that
+        no two parts overlap
+    '''
+    previous_end = -1
+    for sender, recipient, start, end in sorted(parts, key=lambda part: part[2]):
+        if start <= previous_end or not coin_map.is_owner(sender, start, end):
+            return False
+        previous_end = end
+    return True
+
+def run_validator_shard(conn, ranges):
+    ''' Worker loop. Every message is (decision, ops): `decision` commits or aborts the
+        unit this shard last voted on, `ops` are the next ops to run, ending at the
+        shard's next vote. `ops` of None ends the block.
+    '''
+    coin_map = CoinMap()
+    for start, end, owner in ranges:
+        coin_map.add(owner, start, end)
+    verdicts = {}
+    pending = None
+    while True:
+        decision, ops = conn.recv()
+        if pending is not None and decision:
+            for sender, recipient, start, end in pending:
+                coin_map.transfer(recipient, start, end)
+        pending = None
+        if ops is None:
+            conn.send((verdicts, get_coin_map_ranges(coin_map)))
+            conn.close()
+            return
+        for op in ops:
+            if op[0] == 'tx':
+                kind, i, sender, recipient, start, end = op
+                verdicts[i] = coin_map.is_owner(sender, start, end)
+                if verdicts[i]:
+                    coin_map.transfer(recipient, start, end)
+            else:
+                pending = op[2]
+                conn.send(parts_owned(coin_map, pending))
+
+def get_shard_ops(bounds, txs):
+    ''' Returns each shard's ops in block order & the units which are voted on, as
+        (index, indexes of its txs, shards). A tx inside one shard is a ('tx', i, sender,
+        recipient, start, end) op; a tx crossing shards or a swap is a unit with a
+        ('prepare', i, parts) op on each shard it touches, holding its parts there.
+    '''
+    shard_ops = [[] for shard in range(len(bounds) - 1)]
+    voted = []
+    swap_legs = group_swap_legs(txs)
+    for i, tx in enumerate(txs):
+        legs = [i]
+        if tx.is_swap:
+            legs = swap_legs[tx.swap.h]
+            if legs[0] != i or not is_complete_swap([txs[j] for j in legs]):
+                continue
+        # Incomplete swaps & empty txs are left out, so they are rejected
+        if any(txs[j].offset <= 0 for j in legs):
+            continue
+        shard_parts = {}
+        for j in legs:
+            for shard, start, end in split_range(bounds, txs[j].start, txs[j].start + txs[j].offset - 1):
+                shard_parts.setdefault(shard, []).append((txs[j].sender, txs[j].recipient, start, end))
+        if not tx.is_swap and len(shard_parts) == 1:
+            shard, parts = shard_parts.popitem()
+            shard_ops[shard].append(('tx', i) + parts[0])
+            continue
+        voted.append((i, legs, sorted(shard_parts)))
+        for shard, parts in shard_parts.items():
+            shard_ops[shard].append(('prepare', i, parts))
+    return shard_ops, voted
+
+def get_next_ops(ops, cursor):
+    ''' Returns the ops from `cursor` up to & including the next vote, & the new cursor '''
+    end = cursor
+    while end < len(ops):
+        end += 1
+        if ops[end - 1][0] == 'prepare':
+            break
+    return ops[cursor:end], end
+
+def store_ranges(db, ranges, owners):
+    ''' Replaces the coin map & the range lists of `owners` with `ranges` '''
+    coin_map = CoinMap()
+    range_lists = {owner: RangeList() for owner in owners}
+    for start, end, owner in ranges:
+        coin_map.add(owner, start, end)
+        if owner not in range_lists:
+            range_lists[owner] = RangeList()
+        add_range(range_lists[owner], start, end)
+    db.put('coin_map', coin_map)
+    for owner, owner_ranges in range_lists.items():
+        db.put(owner, owner_ranges)
+
+def add_txs_partitioned(db, txs, num_shards=4):
+    ''' Applies `txs` in order across `num_shards` worker processes & returns whether
+        each one was accepted, exactly as `apply_txs` would.
+    '''
+    coin_map = get_coin_map(db)
+    owners = set(coin_map.owners.values())
+    bounds = get_shard_bounds(db.get('total_deposits') or 0, num_shards)
+    shard_ranges = [[] for shard in range(num_shards)]
+    for start, end, owner in get_coin_map_ranges(coin_map):
+        for shard, part_start, part_end in split_range(bounds, start, end):
+            shard_ranges[shard].append((part_start, part_end, owner))
+    shard_ops, voted = get_shard_ops(bounds, txs)
+    conns = []
+    workers = []
+    for shard in range(num_shards):
+        parent_conn, child_conn = multiprocessing.Pipe()
+        worker = multiprocessing.Process(target=run_validator_shard, args=(child_conn, shard_ranges[shard]), daemon=True)
+        worker.start()
+        child_conn.close()
+        conns.append(parent_conn)
+        workers.append(worker)
+    try:
+        cursors = [0] * num_shards
+        for shard in range(num_shards):
+            ops, cursors[shard] = get_next_ops(shard_ops[shard], 0)
+            conns[shard].send((None, ops))
+        verdicts = [False] * len(txs)
+        # Decide voted units in block order--each shard is always blocked on the
+        # earliest undecided unit it is part of
+        for i, legs, shards in voted:
+            decision = all([conns[shard].recv() for shard in shards])
+            for j in legs:
+                verdicts[j] = decision
+            for shard in shards:
+                ops, cursors[shard] = get_next_ops(shard_ops[shard], cursors[shard])
+                conns[shard].send((decision, ops))
+        ranges = []
+        for shard in range(num_shards):
+            conns[shard].send((None, None))
+            shard_verdicts, shard_ranges = conns[shard].recv()
+            for i, verdict in shard_verdicts.items():
+                verdicts[i] = verdict
+            ranges += shard_ranges
+    finally:
+        for conn in conns:
+            conn.close()
+        for worker in workers:
+            worker.join()
+    for tx, verdict in zip(txs, verdicts):
+        if verdict:
+            owners.add(tx.recipient)
+    store_ranges(db, ranges, owners)
+    return verdicts
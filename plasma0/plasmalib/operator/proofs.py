@@ -0,0 +1,117 @@
+from plasmalib.merkle import get_children_key, sum_hash_parent
+
+'''
+Inclusion proofs for the Merkle-sum trees built by `block_generator.construct_tree`.
+
+Block trees are indexed, so every parent's children can be read straight from the
+DB & a coin is proven by walking from the block root down to the bucket holding
+it, choosing the left child if the coin is below the left child's sum: O(log n)
+reads. Nodes are hash [24 bytes] + sum [8 bytes] & a bucket covers the coins
+[sum of everything to its left, that + its own sum).
+
+A multiproof proves many coins or ranges of coins in the same block at once. It
+is the part of the tree the proven buckets hang off, in pre-order, with every
+node which is shared by several branches included only once:
+
+- ('branch', None): an internal node, followed by its left & right subtrees
+- ('node', node): a subtree with nothing to prove in it
+- ('leaf', node): a proven bucket
+'''
+
+
+def get_node_sum(node):
+    return int.from_bytes(node[24:32], byteorder='big')
+
+def get_children(db, node):
+    ''' Returns (left, right) of a node, or None for a leaf '''
+    pair = db.get(get_children_key(node))
+    if pair is None:
+        return None
+    return pair[:32], pair[32:]
+
+def get_branch(db, root, coin):
+    ''' Returns (leaf, branch) proving the bucket containing `coin`, where `branch` is
+        [(sibling, sibling is on the left)] from the leaf up to the root.
+    '''
+    assert coin < get_node_sum(root)
+    branch = []
+    node = root
+    offset = 0
+    children = get_children(db, node)
+    while children is not None:
+        left, right = children
+        if coin < offset + get_node_sum(left):
+            branch.append((right, False))
+            node = left
+        else:
+            branch.append((left, True))
+            offset += get_node_sum(left)
+            node = right
+        children = get_children(db, node)
+    branch.reverse()
+    return node, branch
+
+def verify_branch(root, coin, leaf, branch):
+    ''' Checks that `leaf` is in the tree of `root` & covers `coin` '''
+    node = leaf
+    leaf_start = 0
+    for sibling, sibling_is_left in branch:
+        if sibling_is_left:
+            leaf_start += get_node_sum(sibling)
+            node = sum_hash_parent(sibling + node)[0]
+        else:
+            node = sum_hash_parent(node + sibling)[0]
+    return node == root and leaf_start <= coin < leaf_start + get_node_sum(leaf)
+
+def get_multiproof(db, root, ranges):
+    ''' Returns one multiproof for every bucket overlapping any of the [start, end)
+        `ranges` of coins. A single coin is the range (coin, coin + 1).
+    '''
+    ranges = sorted(ranges)
+    proof = []
+    # Depth first, right child pushed first so the left subtree comes out first
+    stack = [(root, 0)]
+    while len(stack) > 0:
+        node, offset = stack.pop()
+        node_end = offset + get_node_sum(node)
+        if not any(start < node_end and offset < end for start, end in ranges):
+            proof.append(('node', node))
+            continue
+        children = get_children(db, node)
+        if children is None:
+            proof.append(('leaf', node))
+            continue
+        left, right = children
+        proof.append(('branch', None))
+        stack.append((right, offset + get_node_sum(left)))
+        stack.append((left, offset))
+    return proof
+
+def verify_multiproof(root, proof):
+    ''' Checks a multiproof against `root` & returns (start, end, leaf) for every
+        proven bucket, or None if it doesn't match.
+    '''
+    leaves = []
+    position = [0]
+
+    def rebuild(offset):
+        # Returns the node for the subtree starting at `position`
+        if position[0] >= len(proof):
+            raise ValueError('Truncated multiproof')
+        kind, node = proof[position[0]]
+        position[0] += 1
+        if kind == 'branch':
+            left = rebuild(offset)
+            right = rebuild(offset + get_node_sum(left))
+            return sum_hash_parent(left + right)[0]
+        if kind == 'leaf':
+            leaves.append((offset, offset + get_node_sum(node), node))
+        return node
+
+    try:
+        rebuilt_root = rebuild(0)
+    except (ValueError, RecursionError):
+        return None
+    if rebuilt_root != root or position[0] != len(proof):
+        return None
+    return leaves
@@ -0,0 +1,95 @@
+import heapq
+import os
+import struct
+from plasmalib.operator.block_generator import TxBucket, iterate_sorted_bucket_spans, new_block_tree
+
+'''
+Out-of-core block generation, for blocks too big to hold in memory.
+
+Txs are first spilled to disk as an external sort by start: they are read in
+runs of `run_size`, each run is sorted & written to its own file, & the runs are
+then merged back in coin order with `heapq.merge`, which holds one tx per run.
+The merged stream goes through the same sweep as `create_tx_buckets`, every
+bucket is stored & hashed as soon as it is complete, & its root is appended to an
+IncrementalTree which writes the block tree's nodes out as they are made. So
+memory is bounded by one run, the txs active over the current bucket & the tree
+frontier, & the root & DB contents are the same as the in-memory generator's.
+
+Spill records, all integers big endian:
+start [8 bytes] + offset [8 bytes] + plaintext length [4 bytes] + hash [32 bytes] + plaintext
+'''
+
+SPILL_RECORD = struct.Struct('>QQI')
+# Txs sorted in memory at a time while spilling
+SPILL_RUN_SIZE = 2**17
+SPILL_BUFFER_SIZE = 2**16
+
+
+class SpilledTx:
+    ''' A tx read back from a spill, with just what a TxBucket needs '''
+    def __init__(self, start, offset, h, plaintext):
+        self.start = start
+        self.offset = offset
+        self.h = h
+        self._plaintext = plaintext
+
+    def plaintext(self):
+        return self._plaintext
+
+def write_run(path, run):
+    run.sort(key=lambda record: record[0])
+    with open(path, 'wb', buffering=SPILL_BUFFER_SIZE) as f:
+        for start, offset, h, plaintext in run:
+            f.write(SPILL_RECORD.pack(start, offset, len(plaintext)))
+            f.write(h)
+            f.write(plaintext)
+
+def read_run(path):
+    with open(path, 'rb', buffering=SPILL_BUFFER_SIZE) as f:
+        while True:
+            record = f.read(SPILL_RECORD.size)
+            if len(record) == 0:
+                return
+            start, offset, length = SPILL_RECORD.unpack(record)
+            h = f.read(32)
+            yield SpilledTx(start, offset, h, f.read(length))
+
+def spill_txs(txs, spill_dir, run_size=SPILL_RUN_SIZE):
+    ''' Writes `txs` (any iterable) to `spill_dir` as runs sorted by start of at most
+        `run_size` txs each, & returns the paths of the runs in order.
+    '''
+    os.makedirs(spill_dir, exist_ok=True)
+    run_paths = []
+    run = []
+    for tx in txs:
+        # Only keep the bytes, so the tx object itself can be freed
+        run.append((tx.start, tx.offset, tx.h, tx.plaintext()))
+        if len(run) == run_size:
+            run_paths.append(os.path.join(spill_dir, 'run-%d' % len(run_paths)))
+            write_run(run_paths[-1], run)
+            run = []
+    if len(run) > 0:
+        run_paths.append(os.path.join(spill_dir, 'run-%d' % len(run_paths)))
+        write_run(run_paths[-1], run)
+    return run_paths
+
+def merge_runs(run_paths):
+    ''' Yields the txs of every run sorted by start. Sorts & the merge are both stable,
+        so txs with the same start come out in the order they were spilled in.
+    '''
+    return heapq.merge(*[read_run(path) for path in run_paths], key=lambda tx: tx.start)
+
+def generate_block(db, txs, spill_dir, run_size=SPILL_RUN_SIZE):
+    ''' Builds the block of `txs` in bounded memory, writing tx plaintexts & every tree
+        node to `db` as it goes. Returns (block root, number of buckets), with a root
+        of None for an empty block. The spill is removed afterwards.
+    '''
+    run_paths = spill_txs(txs, spill_dir, run_size)
+    try:
+        tree = new_block_tree(db)
+        for start, offset, span_txs in iterate_sorted_bucket_spans(merge_runs(run_paths)):
+            tree.append(TxBucket(db, start, offset, span_txs).tx_merkle_tree_root_hash)
+        return tree.seal(), tree.count
+    finally:
+        for path in run_paths:
+            os.remove(path)
@@ -1,83 +1,401 @@
 import bisect
+from eth_account import Account
+from eth_hash.auto import keccak
+from eth_keys.exceptions import BadSignature
+from eth_utils import decode_hex
+from plasmalib.operator.transactions import TransferRecord
 
-def subtract_range(range_list, start, end):
-    affected_range = None
-    for i in range(0, len(range_list), 2):
-        r_start = range_list[i]
-        r_end = range_list[i+1]
-        if r_start <= start and end <= r_end:
-            affected_range = i
-            break
-    if affected_range is None:
-        return False
-    # Remove the effected range
-    del range_list[i:i + 2]
-    # Create new sub-ranges based on what we deleted
-    if r_start < start:
-        # range_list += [r_start, start - 1]
-        insertion_point = bisect.bisect_left(range_list, r_start)
-        range_list[insertion_point:insertion_point] = [r_start, start - 1]
-    if r_end > end:
-        # range_list += [end + 1, r_end]
-        insertion_point = bisect.bisect_left(range_list, end + 1)
-        range_list[insertion_point:insertion_point] = [end + 1, r_end]
-    return True
+SIG_CHUNK_SIZE = 256
+
+# RangeList chunks are split once they grow past twice this many ranges
+RANGE_LIST_CHUNK_SIZE = 256
+
+class RangeList:
+    '''
+    Sorted list of an owner's inclusive [start, end] ranges. Ranges are kept in
+    chunks of parallel start & end lists, with the first start of every chunk kept
+    in `chunk_starts`, so finding a range is two bisects--O(log n)--& splitting or
+    merging ranges only shifts one small chunk instead of the whole list.
+
+    Iterating, indexing & comparing a RangeList treats it as the flat list
+    [start_0, end_0, start_1, end_1, ...] which owner ranges used to be stored as.
+    '''
+    def __init__(self, flat_ranges=()):
+        self.starts = []
+        self.ends = []
+        self.chunk_starts = []
+        for i in range(0, len(flat_ranges), 2):
+            self.append(flat_ranges[i], flat_ranges[i + 1])
+
+    def find(self, position):
+        ''' Returns (chunk, index) of the last range which starts at or before `position`, or None '''
+        chunk = bisect.bisect_right(self.chunk_starts, position) - 1
+        if chunk < 0:
+            return None
+        return chunk, bisect.bisect_right(self.starts[chunk], position) - 1
+
+    def get(self, position):
+        ''' Returns (start, end) of the range containing `position`, or None '''
+        found = self.find(position)
+        if found is None:
+            return None
+        chunk, i = found
+        if self.ends[chunk][i] < position:
+            return None
+        return self.starts[chunk][i], self.ends[chunk][i]
+
+    def append(self, start, end):
+        ''' Adds a range after every other range, without merging it '''
+        if len(self.starts) == 0 or len(self.starts[-1]) >= RANGE_LIST_CHUNK_SIZE:
+            self.starts.append([])
+            self.ends.append([])
+            self.chunk_starts.append(start)
+        self.starts[-1].append(start)
+        self.ends[-1].append(end)
+
+    def insert(self, start, end):
+        found = self.find(start)
+        if found is None:
+            if len(self.starts) == 0:
+                self.append(start, end)
+                return
+            # Goes before every other range
+            chunk, i = 0, 0
+            self.chunk_starts[0] = start
+        else:
+            chunk, i = found[0], found[1] + 1
+        self.starts[chunk].insert(i, start)
+        self.ends[chunk].insert(i, end)
+        if len(self.starts[chunk]) > 2 * RANGE_LIST_CHUNK_SIZE:
+            # Split the chunk in half
+            self.starts[chunk + 1:chunk + 1] = [self.starts[chunk][RANGE_LIST_CHUNK_SIZE:]]
+            self.ends[chunk + 1:chunk + 1] = [self.ends[chunk][RANGE_LIST_CHUNK_SIZE:]]
+            del self.starts[chunk][RANGE_LIST_CHUNK_SIZE:]
+            del self.ends[chunk][RANGE_LIST_CHUNK_SIZE:]
+            self.chunk_starts.insert(chunk + 1, self.starts[chunk + 1][0])
+
+    def remove(self, start):
+        ''' Removes the range which starts at `start` '''
+        chunk, i = self.find(start)
+        assert self.starts[chunk][i] == start
+        del self.starts[chunk][i]
+        del self.ends[chunk][i]
+        if len(self.starts[chunk]) == 0:
+            del self.starts[chunk]
+            del self.ends[chunk]
+            del self.chunk_starts[chunk]
+        elif i == 0:
+            self.chunk_starts[chunk] = self.starts[chunk][0]
+
+    def subtract(self, start, end):
+        ''' Removes [start, end] if it is inside one range, splitting that range. Returns
+            False if no single range contains it.
+        '''
+        containing_range = self.get(start)
+        if containing_range is None or containing_range[1] < end:
+            return False
+        r_start, r_end = containing_range
+        # Shrink or split the range in place
+        if r_start < start:
+            self.set_end(r_start, start - 1)
+        else:
+            self.remove(r_start)
+        if r_end > end:
+            self.insert(end + 1, r_end)
+        return True
+
+    def add(self, start, end):
+        ''' Adds [start, end], merging it with the ranges which end right before it &
+            start right after it.
+        '''
+        left_range = self.get(start - 1)
+        right_range = self.get(end + 1)
+        if right_range is not None:
+            self.remove(right_range[0])
+            end = right_range[1]
+        if left_range is not None:
+            # Grow the left range in place
+            self.set_end(left_range[0], end)
+        else:
+            self.insert(start, end)
+
+    def set_end(self, start, end):
+        ''' Moves the end of the range which starts at `start` '''
+        chunk, i = self.find(start)
+        assert self.starts[chunk][i] == start
+        self.ends[chunk][i] = end
+
+    def __len__(self):
+        return 2 * sum(len(chunk) for chunk in self.starts)
+
+    def __iter__(self):
+        for chunk_starts, chunk_ends in zip(self.starts, self.ends):
+            for start, end in zip(chunk_starts, chunk_ends):
+                yield start
+                yield end
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        range_index, is_end = divmod(i, 2)
+        for chunk_starts, chunk_ends in zip(self.starts, self.ends):
+            if range_index < len(chunk_starts):
+                return chunk_ends[range_index] if is_end else chunk_starts[range_index]
+            range_index -= len(chunk_starts)
+        raise IndexError('RangeList index out of range')
+
+    def __eq__(self, other):
+        return list(self) == list(other)
+
+    def __repr__(self):
+        return 'RangeList(%r)' % list(self)
+
+
+class CoinMap:
+    '''
+    Global map of every deposited coin to its owner: the inclusive ranges of all
+    owners in one RangeList, with the owner of each range keyed by its start.
+    Adjacent ranges with the same owner are always merged, so the ranges match the
+    owners' own RangeLists one to one & checking who owns [start, end] is a single
+    O(log n) lookup, however many transfers the coins have been through.
+    '''
+    def __init__(self):
+        self.ranges = RangeList()
+        self.owners = {}
+
+    def get(self, index):
+        ''' Returns (start, end, owner) of the range containing coin `index`, or None '''
+        r = self.ranges.get(index)
+        if r is None:
+            return None
+        return r + (self.owners[r[0]],)
+
+    def get_owner(self, index):
+        r = self.get(index)
+        return None if r is None else r[2]
+
+    def is_owner(self, owner, start, end):
+        ''' Checks that `owner` holds every coin in [start, end] '''
+        r = self.get(start)
+        return r is not None and end <= r[1] and r[2] == owner
+
+    def add(self, owner, start, end):
+        ''' Gives the unowned coins [start, end] to `owner`, merging them with `owner`'s neighbouring ranges '''
+        left_range = self.get(start - 1)
+        right_range = self.get(end + 1)
+        if right_range is not None and right_range[2] == owner:
+            self.ranges.remove(right_range[0])
+            del self.owners[right_range[0]]
+            end = right_range[1]
+        if left_range is not None and left_range[2] == owner:
+            self.ranges.set_end(left_range[0], end)
+        else:
+            self.ranges.insert(start, end)
+            self.owners[start] = owner
+
+    def transfer(self, recipient, start, end):
+        ''' Moves [start, end], which must be inside one range, to `recipient` '''
+        r_start, r_end, owner = self.get(start)
+        assert self.ranges.subtract(start, end)
+        if r_start == start:
+            del self.owners[start]
+        if r_end > end:
+            self.owners[end + 1] = owner
+        self.add(recipient, start, end)
+
+def get_coin_map(db):
+    ''' Returns the CoinMap, building it from the owners' range lists (RangeLists or flat
+        lists) if the DB doesn't have one yet, eg. a DB written before it existed. Like
+        the range lists, it has to be put back after it is changed.
+    '''
+    coin_map = db.get('coin_map')
+    if coin_map is None:
+        coin_map = CoinMap()
+        for owner, owner_ranges in db.iterator():
+            if isinstance(owner_ranges, (list, RangeList)):
+                owner_ranges = list(owner_ranges)
+                for start, end in zip(owner_ranges[0::2], owner_ranges[1::2]):
+                    coin_map.add(owner, start, end)
+        db.put('coin_map', coin_map)
+    return coin_map
 
+def get_owner(db, index):
+    ''' Returns the owner of coin `index`, or None if it hasn't been deposited '''
+    return get_coin_map(db).get_owner(index)
+
+def subtract_range(range_list, start, end):
+    return range_list.subtract(start, end)
 
 def add_range(range_list, start, end):
-    # Find left_range (a range which ends at the start of our tx) and right_range (a range which starts at the end of our tx)
-    left_range = None
-    right_range = None
-    insertion_point = bisect.bisect_left(range_list, start)
-    if insertion_point > 0 and range_list[insertion_point - 1] == start - 1:
-        left_range = insertion_point - 2
-    if insertion_point < len(range_list) and range_list[insertion_point] == end + 1:
-        right_range = insertion_point
-    # Set the start and end of our new range based on the deleted ranges
-    if left_range is not None:
-        start = range_list[left_range]
-    if right_range is not None:
-        end = range_list[right_range + 1]
-    # Delete the left_range and right_range if we found them
-    if left_range is not None and right_range is not None:
-        del range_list[left_range + 1:right_range + 1]
-        return
-    elif left_range is not None:
-        del range_list[left_range:left_range + 2]
-        insertion_point -= 2
-    elif right_range is not None:
-        del range_list[right_range:right_range + 2]
-    range_list[insertion_point:insertion_point] = [start, end]
+    range_list.add(start, end)
+
+def get_range_list(db, owner):
+    ''' Returns the RangeList of `owner`, converting ranges stored as a flat list. Old
+        deposits were stored back to back without merging, so adjacent ranges are merged
+        as they're converted, like the coin map merges them.
+    '''
+    owner_ranges = db.get(owner)
+    if owner_ranges is None:
+        return RangeList()
+    if not isinstance(owner_ranges, RangeList):
+        flat_ranges = owner_ranges
+        owner_ranges = RangeList()
+        for start, end in zip(flat_ranges[0::2], flat_ranges[1::2]):
+            owner_ranges.add(start, end)
+    return owner_ranges
+
+def add_txs(db, txs, pool=None):
+    ''' Verifies the signatures of a batch of txs in one pass & applies them in order
+        with `apply_txs`, rejecting every tx with a bad signature.
+    '''
+    return apply_txs(db, txs, validate_tx_sigs(txs, pool))
+
+def apply_txs(db, txs, accepted=None):
+    ''' Applies `txs` in order, skipping any tx marked False in `accepted`, & returns the
+        result of `add_tx` for each. The legs of a swap are applied together by
+        `add_swap` where its first leg is, & each leg gets its result, so a swap lands
+        whole or not at all--a leg with a bad signature sinks the whole swap.
+    '''
+    if accepted is None:
+        accepted = [True] * len(txs)
+    swap_legs = group_swap_legs(txs)
+    results = [False] * len(txs)
+    for i, tx in enumerate(txs):
+        if not tx.is_swap:
+            results[i] = add_tx(db, tx) if accepted[i] else False
+        elif swap_legs[tx.swap.h][0] == i:
+            legs = swap_legs[tx.swap.h]
+            landed = all(accepted[j] for j in legs) and add_swap(db, [txs[j] for j in legs])
+            for j in legs:
+                results[j] = landed
+    return results
+
+def group_swap_legs(txs):
+    ''' Returns {swap hash: indexes of its legs in `txs`} for every swap in `txs` '''
+    swap_legs = {}
+    for i, tx in enumerate(txs):
+        if tx.is_swap:
+            swap_legs.setdefault(tx.swap.h, []).append(i)
+    return swap_legs
+
+def is_complete_swap(txs):
+    ''' Checks that `txs` are every leg of one swap, each once '''
+    swap = txs[0].swap
+    # Legs signed by each party, or read back from disk, carry their own copy of the swap
+    if swap is None or any(tx.swap is None or tx.swap.h != swap.h for tx in txs):
+        return False
+    return sorted(tx.msg.h for tx in txs) == sorted(msg.h for msg in swap.msgs)
 
 def add_tx(db, tx):
-    # Now make sure the range is owned by the sender
-    sender_ranges = db.get(tx.sender)
+    # Swap legs only land together, through `add_swap`
+    if tx.is_swap:
+        return False
+    # An empty range is owned by anyone, but would leave a bogus range in the coin map
+    if tx.offset <= 0:
+        return False
     tx_start = tx.start
     tx_end = tx.start + tx.offset - 1
-    # Subtract ranges from sender range list and store
-    if not subtract_range(sender_ranges, tx_start, tx_end):
+    # Make sure the range is owned by the sender. It may span several of the sender's
+    # ranges as they were sent, but adjacent ranges of one owner are always merged.
+    coin_map = get_coin_map(db)
+    if not coin_map.is_owner(tx.sender, tx_start, tx_end):
         return False
+    # Subtract ranges from sender range list and store
+    sender_ranges = get_range_list(db, tx.sender)
+    assert subtract_range(sender_ranges, tx_start, tx_end)
     db.put(tx.sender, sender_ranges)
     # After having deleted the sender ranges,
     # Add ranges to recipient range list and store
-    recipient_ranges = db.get(tx.recipient)
+    recipient_ranges = get_range_list(db, tx.recipient)
     add_range(recipient_ranges, tx_start, tx_end)
     db.put(tx.recipient, recipient_ranges)
+    coin_map.transfer(tx.recipient, tx_start, tx_end)
+    db.put('coin_map', coin_map)
     return sender_ranges
 
+def add_swap(db, txs):
+    ''' Applies every leg of a swap or none of them. Each leg is checked against the
+        coin map before anything is written, so a swap never lands half way.
+    '''
+    if not is_complete_swap(txs):
+        return False
+    coin_map = get_coin_map(db)
+    legs = sorted(((tx.start, tx.start + tx.offset - 1, tx) for tx in txs), key=lambda leg: leg[0])
+    previous_end = -1
+    for start, end, tx in legs:
+        if tx.offset <= 0 or start <= previous_end or not coin_map.is_owner(tx.sender, start, end):
+            return False
+        previous_end = end
+    # Legs don't overlap, so applying one leg can't change who owns another's coins
+    range_lists = {}
+    for start, end, tx in legs:
+        for owner in (tx.sender, tx.recipient):
+            if owner not in range_lists:
+                range_lists[owner] = get_range_list(db, owner)
+        assert subtract_range(range_lists[tx.sender], start, end)
+        add_range(range_lists[tx.recipient], start, end)
+        coin_map.transfer(tx.recipient, start, end)
+    for owner, owner_ranges in range_lists.items():
+        db.put(owner, owner_ranges)
+    db.put('coin_map', coin_map)
+    return True
+
 def add_deposit(db, owner, amount):
     total_deposits = db.get('total_deposits')
     if total_deposits is None:
         total_deposits = 0
-    owner_ranges = db.get(owner)
-    if owner_ranges is None:
-        owner_ranges = []
-    owner_ranges += [total_deposits, total_deposits + amount - 1]
+    owner_ranges = get_range_list(db, owner)
+    add_range(owner_ranges, total_deposits, total_deposits + amount - 1)
+    coin_map = get_coin_map(db)
+    coin_map.add(owner, total_deposits, total_deposits + amount - 1)
     total_deposits += amount
     db.put(owner, owner_ranges)
+    db.put('coin_map', coin_map)
     db.put('total_deposits', total_deposits)
     return owner_ranges
 
+def encode_transfer(transfer):
+    ''' Encodes a TransferRecord whose addresses may be hex strings '''
+    sender, recipient = (a if type(a) == bytes else decode_hex(a) for a in (transfer.sender, transfer.recipient))
+    return TransferRecord(sender, recipient, *[getattr(transfer, f[0]) for f in TransferRecord.fields[2:]]).encode()
+
+def get_sig_check(tx):
+    ''' Returns (msg_hash, v, r, s, sender) for a `utils.Tx` or a (TransferRecord, Signature) pair '''
+    if isinstance(tx, tuple):
+        transfer, sig = tx
+        # The same hash as `transfer.hash`, but the addresses may be hex strings
+        msg_hash, v, r, s, sender = keccak(encode_transfer(transfer)), sig.v, sig.r, sig.s, transfer.sender
+    else:
+        msg_hash, v, r, s, sender = tx.full_msg_hash, tx.sigv, tx.sigr, tx.sigs, tx.sender
+    if type(sender) != bytes:
+        sender = decode_hex(sender)
+    return msg_hash, v, r, s, sender
+
+def check_sig(sig_check):
+    msg_hash, v, r, s, sender = sig_check
+    try:
+        signer = Account.recoverHash(msg_hash, vrs=(v, r, s))
+    except (BadSignature, ValueError):
+        return False
+    return decode_hex(signer) == sender
+
+def check_sig_chunk(sig_checks):
+    return [check_sig(c) for c in sig_checks]
+
+def validate_tx_sigs(txs, pool=None, chunk_size=SIG_CHUNK_SIZE):
+    ''' Recovers the signer of every tx and returns whether it matches the sender, in order.
+        Takes `utils.Tx` objects or (TransferRecord, Signature) pairs. If `pool` (eg. a
+        `concurrent.futures.ProcessPoolExecutor`) is given, recovery is fanned out over
+        it in chunks of `chunk_size` txs.
+    '''
+    sig_checks = [get_sig_check(tx) for tx in txs]
+    if pool is None:
+        return check_sig_chunk(sig_checks)
+    chunks = [sig_checks[i:i + chunk_size] for i in range(0, len(sig_checks), chunk_size)]
+    verdicts = []
+    for chunk_verdicts in pool.map(check_sig_chunk, chunks):
+        verdicts += chunk_verdicts
+    return verdicts
+
 def validate_tx_sig(tx):
-    # TODO: Actually verify the signature
-    return True
+    return check_sig(get_sig_check(tx))
@@ -0,0 +1,122 @@
+import multiprocessing
+import os
+from plasmalib.state import State
+
+'''
+State sharded by token_id across worker processes.
+
+A transfer of one token never touches another token's keys, so every token_id is
+owned by exactly one shard: a worker process with its own State, DB & tx log in
+`<db_dir>/shard-<n>` & `<tx_log_dir>/shard-<n>`. The ShardedState router sends each
+deposit & transfer to the shard owning its token_id, fans a batch of txs out to
+every shard at once so they validate & commit in parallel, & aggregates queries
+which span shards, like an owner's balances across every token.
+
+The shard of a token_id is `token_id % num_shards`, so `num_shards` must not change
+once a DB has been created.
+'''
+
+
+def get_shard(token_id, num_shards):
+    return token_id % num_shards
+
+def get_shard_dir(parent_dir, shard):
+    return os.path.join(parent_dir, 'shard-%d' % shard)
+
+def run_shard(conn, db_dir, tx_log_dir, state_kwargs):
+    ''' Worker loop: calls State methods sent by the router & sends back their results '''
+    state = State(db_dir, tx_log_dir, **state_kwargs)
+    try:
+        while True:
+            method, args = conn.recv()
+            if method == 'close':
+                break
+            try:
+                conn.send((True, getattr(state, method)(*args)))
+            except Exception as e:
+                conn.send((False, e))
+    finally:
+        state.close()
+        conn.close()
+
+
+class ShardedState:
+    def __init__(self, db_dir, tx_log_dir, num_shards=4, **state_kwargs):
+        self.num_shards = num_shards
+        self.conns = []
+        self.workers = []
+        os.makedirs(db_dir, exist_ok=True)
+        for shard in range(num_shards):
+            parent_conn, child_conn = multiprocessing.Pipe()
+            worker = multiprocessing.Process(target=run_shard, args=(child_conn, get_shard_dir(db_dir, shard), get_shard_dir(tx_log_dir, shard), state_kwargs), daemon=True)
+            worker.start()
+            child_conn.close()
+            self.conns.append(parent_conn)
+            self.workers.append(worker)
+
+    def call(self, shard, method, *args):
+        return self.call_shards({shard: (method, args)})[shard]
+
+    def call_shards(self, calls):
+        ''' Sends {shard: (method, args)} to every shard before waiting on any of them,
+            so the shards run in parallel. Returns {shard: result}.
+        '''
+        for shard, call in calls.items():
+            self.conns[shard].send(call)
+        results = {}
+        errors = []
+        for shard in calls:
+            ok, results[shard] = self.conns[shard].recv()
+            if not ok:
+                errors.append(results[shard])
+        # Only raise once every shard has replied so the pipes stay in step
+        if len(errors) > 0:
+            raise errors[0]
+        return results
+
+    def add_deposit(self, recipient, token_id, amount):
+        return self.call(get_shard(token_id, self.num_shards), 'add_deposit', recipient, token_id, amount)
+
+    def add_deposits(self, deposits):
+        shard_deposits = {}
+        for deposit in deposits:
+            shard_deposits.setdefault(get_shard(deposit[1], self.num_shards), []).append(deposit)
+        self.call_shards({shard: ('add_deposits', (d,)) for shard, d in shard_deposits.items()})
+        return True
+
+    def add_transaction(self, txs, sigs=None):
+        ''' Splits `txs` by shard, applies every shard's txs in parallel & returns
+            whether each tx was accepted, in the order of `txs`.
+        '''
+        shard_txs = {}
+        for i, tx in enumerate(txs):
+            shard_txs.setdefault(get_shard(tx.token_id, self.num_shards), []).append(i)
+        calls = {}
+        for shard, indexes in shard_txs.items():
+            shard_sigs = None if sigs is None else [sigs[i] for i in indexes]
+            calls[shard] = ('add_transaction', ([txs[i] for i in indexes], shard_sigs))
+        accepted = [False] * len(txs)
+        for shard, shard_accepted in self.call_shards(calls).items():
+            for i, tx_accepted in zip(shard_txs[shard], shard_accepted):
+                accepted[i] = tx_accepted
+        return accepted
+
+    def get_balance(self, owner, token_id):
+        return self.call(get_shard(token_id, self.num_shards), 'get_balance', owner, token_id)
+
+    def get_balances(self, owner):
+        ''' Returns {token_id: balance} for `owner`, gathered from every shard '''
+        balances = {}
+        for shard_balances in self.call_shards({shard: ('get_balances', (owner,)) for shard in range(self.num_shards)}).values():
+            balances.update(shard_balances)
+        return balances
+
+    def get_owned_ranges(self, owner, token_id):
+        return self.call(get_shard(token_id, self.num_shards), 'get_owned_ranges', owner, token_id)
+
+    def close(self):
+        for conn in self.conns:
+            conn.send(('close', ()))
+            conn.close()
+        for worker in self.workers:
+            worker.join()
@@ -1,110 +1,250 @@
-import plyvel
 from web3 import Web3
 from plasmalib.utils import (
     int_to_big_endian8,
     int_to_big_endian32,
 )
+from plasmalib.operator.transaction_validator import validate_tx_sigs, encode_transfer
+from plasmalib.operator.transactions import (
+    SimpleSerializableElement,
+    TransferRecord,
+)
+from plasmalib.wal import WriteAheadLog
+from plasmalib.storage import LevelDBBackend
 from eth_utils import (
     big_endian_to_int,
     decode_hex,
 )
-import time
-import os
+from contextlib import contextmanager
+import bisect
+import heapq
 import rlp
 
 
+'''
+DB layout (schema v2):
+- total_deposits-<token_id>            -> total deposits [32 bytes]
+- r<token_id><start>                   -> end [32 bytes] + owner [20 bytes], one key per range
+- o<owner><token_id><start>            -> b'', secondary index of the ranges each owner holds
+- n<owner>                             -> nonce [8 bytes]
+- b<owner><token_id>                    -> balance [32 bytes], kept up to date on every range write
+- schema_version                       -> SCHEMA_VERSION [8 bytes]
+- block_number                         -> number of the last committed block [8 bytes]
+- log_position                         -> segment [8 bytes] + offset [8 bytes] of the last tx log record in the DB
+Range keys are fixed-width and share one prefix, so scanning a token's ranges
+touches nothing but range keys. Adjacent ranges with the same owner are merged
+as deposits & transfers are written, & `coalesce_ranges` merges whatever is left
+over in the background, so an owner's coins don't fragment into many keys.
+'''
+SCHEMA_VERSION = 2
+SCHEMA_VERSION_KEY = b'schema_version'
+LOG_POSITION_KEY = b'log_position'
+BLOCK_NUMBER_KEY = b'block_number'
+DEPOSIT_OP = b'deposit'
+TRANSFER_OP = b'transfer'
+BLOCK_OP = b'block'
 TOTAL_DEPOSITS_PREFIX = b'total_deposits-'
-OFFSET_SUFFIX = b'-0offset'
-OWNER_SUFFIX = b'-1owner'
-NONCE_SUFFIX = b'-nonce'
+RANGE_PREFIX = b'r'
+OWNER_PREFIX = b'o'
+NONCE_PREFIX = b'n'
+BALANCE_PREFIX = b'b'
 
 def get_total_deposits_key(token_id):
     assert type(token_id) == bytes
     return TOTAL_DEPOSITS_PREFIX + token_id
 
-def get_start_to_offset_key(token_id, start):
+def get_range_key(token_id, start):
     assert type(token_id) == bytes and type(start) == bytes
-    return token_id + start + OFFSET_SUFFIX
+    return RANGE_PREFIX + token_id + start
 
-def get_start_to_owner_key(token_id, start):
-    assert type(token_id) == bytes and type(start) == bytes
-    return token_id + start + OWNER_SUFFIX
+def decode_range_key(key):
+    ''' Returns the (token_id, start) of a range key, with `start` as an int '''
+    return key[1:9], big_endian_to_int(key[9:41])
+
+def encode_range_value(end, owner):
+    assert type(owner) == bytes
+    return int_to_big_endian32(end) + owner
+
+def decode_range_value(value):
+    ''' Returns the (end, owner) of a range value, with `end` as an int '''
+    return big_endian_to_int(value[0:32]), value[32:52]
 
 def get_owner_to_nonce_key(owner):
     assert type(owner) == bytes
-    return owner + NONCE_SUFFIX
+    return NONCE_PREFIX + owner
 
 def get_owner_to_start_key(owner, token_id, start):
     assert type(owner) == bytes and type(token_id) == bytes and type(start) == bytes
-    return owner + token_id + start
+    return OWNER_PREFIX + owner + token_id + start
 
-class FileLog:
-    def __init__(self, log_dir, backup_timeout):
-        self.log_dir = log_dir
-        self.tmp_log_path = os.path.join(log_dir, "tmp_log")
-        try:
-            os.remove(self.tmp_log_path)
-        except Exception:
-            print('No tmp log found')
-        assert not os.path.isfile(self.tmp_log_path)
-        os.makedirs(os.path.dirname(self.tmp_log_path), exist_ok=True)
-        self.tmp_log = open(self.tmp_log_path, 'a')
-        self.last_backup = time.time()
-        self.backup_timeout = backup_timeout
-
-    def add_record(self, record):
-        self.tmp_log.write(rlp.encode(record))
-        if time.time() - self.backup_timeout > self.last_backup:
-            self.backup()
-
-    def backup(self):
-        self.tmp_log.flush()
-        self.tmp_log.close()
-        os.rename(self.tmp_log_path, os.path.join(self.log_dir, int(time.time())))
-        self.tmp_log = open(self.tmp_log_path, 'a')
-
-
-class State:
+def get_balance_key(owner, token_id):
+    assert type(owner) == bytes and type(token_id) == bytes
+    return BALANCE_PREFIX + owner + token_id
+
+def encode_log_position(position):
+    return int_to_big_endian8(position[0]) + int_to_big_endian8(position[1])
+
+def decode_log_position(value):
+    return big_endian_to_int(value[0:8]), big_endian_to_int(value[8:16])
+
+def find_conflicting_transfers(txs):
+    ''' Returns the indexes of the txs which overlap another tx in the batch. Sorts
+        the txs by (token_id, start) & sweeps over them once: a tx overlaps an earlier
+        one iff it starts before the furthest end seen so far for its token.
     '''
-    State object accepts txs, verifies that they are valid, and updates
-    the leveldb database.
+    conflicting = set()
+    furthest = None
+    for i in sorted(range(len(txs)), key=lambda i: (txs[i].token_id, txs[i].start)):
+        tx = txs[i]
+        if furthest is not None and txs[furthest].token_id == tx.token_id:
+            if tx.start < txs[furthest].start + txs[furthest].offset:
+                conflicting.update((i, furthest))
+            if tx.start + tx.offset <= txs[furthest].start + txs[furthest].offset:
+                continue
+        furthest = i
+    return conflicting
+
+
+class WriteBatchOverlay:
     '''
-    def __init__(self, db_dir, tx_log_dir, create_if_missing=True, backup_timeout=60):
-        self.db = plyvel.DB(db_dir, create_if_missing=create_if_missing)
-        # self.wb = self.db.write_batch()
-        # self.db = EphemDB()
-        self.file_log = FileLog(tx_log_dir, backup_timeout)
+    Stages writes in a single storage write batch while keeping a sorted in-memory
+    copy of them, so that reads made before the batch is written see the staged
+    values (read-your-own-writes). Nothing reaches the DB until `write()`.
+    '''
+    def __init__(self, db):
+        self.db = db
+        self.wb = db.write_batch()
+        # Deposits & transfers to write to the tx log when the batch commits.
+        # None while replaying the log.
+        self.log_ops = []
+        # Staged values by key. Deleted keys map to None.
+        self.staged = {}
+        self.staged_keys = []
 
-    def add_deposit(self, recipient, token_id, amount):
-        # Update total deposits
-        total_deposits = self.db.get(get_total_deposits_key(int_to_big_endian8(token_id)))
-        if total_deposits is None:
-            total_deposits = b'\x00'*32
-        deposit_start = big_endian_to_int(total_deposits)
-        total_deposits = int_to_big_endian32(deposit_start + amount)
-        # Begin write batch--data written to DB during write batch is all or nothing
-        wb = self.db.write_batch()
-        # Store the range
-        self.store_range(recipient, token_id, deposit_start, amount)
-        # Update total deposits
-        self.db.put(b'total_deposits-' + int_to_big_endian8(token_id), total_deposits)
-        # End write batch
-        wb.write()
-        return True
+    def get(self, key):
+        if key in self.staged:
+            return self.staged[key]
+        return self.db.get(key)
 
-    def store_range(self, owner, token_id, start, offset):
-        ''' Stores a range with the specified parameters.
-            Note that all params other than `owner` are ints.
+    def put(self, key, value):
+        if key not in self.staged:
+            bisect.insort(self.staged_keys, key)
+        self.staged[key] = value
+        self.wb.put(key, value)
+
+    def delete(self, key):
+        if key not in self.staged:
+            bisect.insort(self.staged_keys, key)
+        self.staged[key] = None
+        self.wb.delete(key)
+
+    def iterator(self, start, stop, reverse=False):
+        ''' Yields the keys in [start, stop) of the DB merged with the staged writes. '''
+        db_keys = self.db.iterator(start=start, stop=stop, reverse=reverse, include_value=False)
+        staged_keys = self.staged_keys[bisect.bisect_left(self.staged_keys, start):bisect.bisect_left(self.staged_keys, stop)]
+        if reverse:
+            staged_keys.reverse()
+        last_key = None
+        for key in heapq.merge(db_keys, staged_keys, reverse=reverse):
+            if key == last_key:
+                continue
+            last_key = key
+            if key in self.staged and self.staged[key] is None:
+                continue
+            yield key
+
+    def write(self):
+        self.wb.write()
+
+
+class RangeIndex:
+    '''
+    Write-through in-memory interval index over the ranges stored in the DB.
+    For every token_id it keeps a sorted list of range starts and a map from
+    start to (end, owner), so the ranges overlapping [start, end] are found
+    with one bisect. Ranges are [start, end) with int bounds.
+    '''
+    def __init__(self):
+        self.starts = {}
+        self.ranges = {}
+        # Undo log of (token_id, start, previous value) kept while a batch is open
+        self.journal = None
+
+    @classmethod
+    def load(cls, db):
+        ''' Builds the index from the range keys in `db` '''
+        index = cls()
+        for key, value in db.iterator(prefix=RANGE_PREFIX):
+            token_id, start = decode_range_key(key)
+            end, owner = decode_range_value(value)
+            index.add(token_id, start, end, owner)
+        return index
+
+    def get(self, token_id, start):
+        ''' Returns (end, owner) of the range starting at `start`, or None '''
+        return self.ranges.get(token_id, {}).get(start)
+
+    def add(self, token_id, start, end, owner):
+        if token_id not in self.ranges:
+            self.starts[token_id] = []
+            self.ranges[token_id] = {}
+        ranges = self.ranges[token_id]
+        if self.journal is not None:
+            self.journal.append((token_id, start, ranges.get(start)))
+        if start not in ranges:
+            bisect.insort(self.starts[token_id], start)
+        ranges[start] = (end, owner)
+
+    def remove(self, token_id, start):
+        ranges = self.ranges[token_id]
+        if self.journal is not None:
+            self.journal.append((token_id, start, ranges[start]))
+        del ranges[start]
+        starts = self.starts[token_id]
+        del starts[bisect.bisect_left(starts, start)]
+
+    def get_previous(self, token_id, start):
+        ''' Returns (start, end, owner) of the range before the one starting at `start`, or None '''
+        starts = self.starts.get(token_id, [])
+        i = bisect.bisect_left(starts, start)
+        if i == 0:
+            return None
+        return (starts[i - 1],) + self.ranges[token_id][starts[i - 1]]
+
+    def get_overlapping(self, token_id, start, end):
+        ''' Returns (start, end, owner) for the range at or before `start` and every
+            following range which starts at or before `end`.
         '''
-        owner, token_id, start, offset = self.get_converted_parameters(addresses=(owner,), bytes8s=(token_id,), bytes32s=(start, offset))
-        # Put everything into the db
-        if self.db.get(get_owner_to_nonce_key(owner)) is None:
-            # If there's no nonce for the owner, add one
-            self.db.put(get_owner_to_nonce_key(owner), int_to_big_endian8(0))
-        self.db.put(get_owner_to_start_key(owner, token_id, start), b'1')
-        self.db.put(get_start_to_offset_key(token_id, start), offset)
-        self.db.put(get_start_to_owner_key(token_id, start), owner)
+        starts = self.starts.get(token_id, [])
+        ranges = self.ranges.get(token_id, {})
+        # Start from the last range which begins at or before `start`
+        i = max(bisect.bisect_right(starts, start) - 1, 0)
+        overlapping = []
+        while i < len(starts) and starts[i] <= end:
+            r_start = starts[i]
+            overlapping.append((r_start,) + ranges[r_start])
+            i += 1
+        return overlapping
+
+    def begin(self):
+        self.journal = []
+
+    def commit(self):
+        self.journal = None
 
+    def rollback(self):
+        journal, self.journal = self.journal, None
+        for token_id, start, previous in reversed(journal):
+            if previous is None:
+                self.remove(token_id, start)
+            else:
+                self.add(token_id, start, previous[0], previous[1])
+
+
+class StateReader:
+    '''
+    Read queries shared by State & StateView. Subclasses provide `get`,
+    `iterate_keys` & `get_range`.
+    '''
     def get_converted_parameters(self, addresses=(), bytes8s=(), bytes32s=()):
         converted = ()
         for a in addresses:
@@ -124,75 +264,409 @@ class State:
             converted += (b32,)
         return converted
 
-    def get_ranges(self, token_id, start, end):
-        token_id, start, end = self.get_converted_parameters(bytes8s=(token_id,), bytes32s=(start, end))
-        it = self.db.iterator(include_value=False)
-        token_lookup_key = token_id + start
-        it.seek(token_lookup_key)
-        last_key = next(it)
-        # Move the iterator to the previous range
-        while last_key[0:40] > token_lookup_key or OFFSET_SUFFIX not in last_key[40:]:
-            last_key = it.prev()
-        if last_key[0:40] != token_lookup_key:
-            # If we entered the while loop, then we need to call next() to change the direction of the iterator
-            last_key = next(it)
-        affected_ranges = []
-        end = token_id + end + OWNER_SUFFIX
-        while end >= last_key:
-            # Append to the affected_ranges list
-            affected_ranges.append(last_key)
-            last_key = next(it)
-        return affected_ranges
+    def get_balance(self, owner, token_id):
+        ''' Returns the number of `token_id` coins held by `owner` in O(1) '''
+        owner, token_id = self.get_converted_parameters(addresses=(owner,), bytes8s=(token_id,))
+        balance = self.get(get_balance_key(owner, token_id))
+        return 0 if balance is None else big_endian_to_int(balance)
+
+    def get_balances(self, owner):
+        ''' Returns {token_id: balance} for every token `owner` has ever held '''
+        owner, = self.get_converted_parameters(addresses=(owner,))
+        balance_prefix = get_balance_key(owner, b'')
+        balances = {}
+        # Balance keys are the prefix followed by an 8 byte token_id
+        for key in self.iterate_keys(balance_prefix, balance_prefix + b'\xff' * 9):
+            balances[big_endian_to_int(key[len(balance_prefix):])] = big_endian_to_int(self.get(key))
+        return balances
+
+    def get_owned_ranges(self, owner, token_id):
+        ''' Returns (start, end) for every range of `token_id` held by `owner`,
+            using a prefix scan over the owner index.
+        '''
+        owner, token_id = self.get_converted_parameters(addresses=(owner,), bytes8s=(token_id,))
+        owner_prefix = get_owner_to_start_key(owner, token_id, b'')
+        owned_ranges = []
+        # Owner index keys are the prefix followed by a 32 byte start
+        for key in self.iterate_keys(owner_prefix, owner_prefix + b'\xff' * 33):
+            start = big_endian_to_int(key[len(owner_prefix):])
+            owned_ranges.append((start, self.get_range(token_id, start)[0]))
+        return owned_ranges
 
     def verify_ranges_owner(self, ranges, owner):
         owner, = self.get_converted_parameters(addresses=(owner,))
         for r in ranges:
-            r_owner = self.db.get(r)
-            if owner != r_owner:
+            r_range = self.get_range(*decode_range_key(r))
+            if r_range is None or owner != r_range[1]:
                 return False
         return True
 
+    def verify_ranges_cover(self, ranges, start, end):
+        ''' Checks that `ranges`, as returned by `get_ranges`, cover every coin in [start, end) '''
+        if len(ranges) == 0:
+            return False
+        last_range = self.get_range(*decode_range_key(ranges[-1]))
+        return decode_range_key(ranges[0])[1] <= start and last_range is not None and end <= last_range[0]
+
+
+class StateView(StateReader):
+    '''
+    Read-only view of the State as of one storage snapshot. It never sees a
+    half-written batch & is safe to use from other threads while the State
+    is committing, without any locks.
+    '''
+    def __init__(self, snapshot, block_number=None):
+        self.snapshot = snapshot
+        self.block_number = block_number
+
+    def get(self, key):
+        return self.snapshot.get(key)
+
+    def iterate_keys(self, start, stop, reverse=False):
+        return self.snapshot.iterator(start=start, stop=stop, reverse=reverse, include_value=False)
+
+    def get_range(self, token_id, start):
+        ''' Returns (end, owner) of the range starting at `start`, or None '''
+        value = self.get(get_range_key(token_id, int_to_big_endian32(start)))
+        return None if value is None else decode_range_value(value)
+
+    def get_ranges(self, token_id, start, end):
+        ''' Returns the keys of the range containing `start` and every following range
+            which starts at or before `end`.
+        '''
+        token_id, = self.get_converted_parameters(bytes8s=(token_id,))
+        # Range keys of one token are fixed-width & contiguous, so the range containing
+        # `start` is the first key at or before it when scanning backwards
+        containing_range = next(self.iterate_keys(get_range_key(token_id, b''), get_range_key(token_id, int_to_big_endian32(start)) + b'\x00', reverse=True), None)
+        first_key = get_range_key(token_id, int_to_big_endian32(start)) if containing_range is None else containing_range
+        return list(self.iterate_keys(first_key, get_range_key(token_id, int_to_big_endian32(end)) + b'\x00'))
+
+
+class State(StateReader):
+    '''
+    State object accepts txs, verifies that they are valid, and updates
+    the leveldb database.
+    '''
+    def __init__(self, db_dir, tx_log_dir, create_if_missing=True, backup_timeout=60, sync_records=100, sync_interval_ms=10, segment_bytes=64 * 2**20, snapshot_retention=16, backend=LevelDBBackend):
+        # Any backend from `plasmalib.storage`, constructed as backend(db_dir, create_if_missing=...)
+        self.db = backend(db_dir, create_if_missing=create_if_missing)
+        self.check_schema_version()
+        # Set while a write batch is open--all reads & writes go through it
+        self.batch = None
+        block_number = self.db.get(BLOCK_NUMBER_KEY)
+        self.block_number = None if block_number is None else big_endian_to_int(block_number)
+        # Snapshots of the last `snapshot_retention` committed blocks by block number
+        self.block_snapshots = {}
+        self.snapshot_retention = snapshot_retention
+        # Serves every range lookup--the DB is only the durable copy
+        self.range_index = RangeIndex.load(self.db)
+        # Every committed batch is logged before it is written to the DB
+        self.tx_log = WriteAheadLog(tx_log_dir, sync_records, sync_interval_ms, segment_bytes, backup_timeout)
+        self.recover()
+
+    def check_schema_version(self):
+        version = self.db.get(SCHEMA_VERSION_KEY)
+        if version is None:
+            assert next(self.db.iterator(include_value=False), None) is None, \
+                'DB uses the v1 range layout, migrate it with `python -m plasmalib.migrate_state <db_dir>`'
+            self.db.put(SCHEMA_VERSION_KEY, int_to_big_endian8(SCHEMA_VERSION))
+            return
+        assert big_endian_to_int(version) == SCHEMA_VERSION, 'Unsupported DB schema version'
+
+    @contextmanager
+    def write_batch(self, block_number=None):
+        ''' Stages every write made inside the `with` block in one WriteBatch which
+            is written atomically when the block exits, or discarded if it raises.
+            Use this to commit a whole block of deposits & transfers in one write,
+            passing its `block_number` to keep a snapshot of the state after it.
+            Nested calls join the outer batch.
+        '''
+        if self.batch is not None:
+            assert block_number is None, 'Only the outermost write batch can commit a block'
+            yield self.batch
+            return
+        self.batch = WriteBatchOverlay(self.db)
+        self.range_index.begin()
+        try:
+            yield self.batch
+            if block_number is not None:
+                self.batch.put(BLOCK_NUMBER_KEY, int_to_big_endian8(block_number))
+                self.log_op([BLOCK_OP, int_to_big_endian8(block_number)])
+            if self.batch.log_ops:
+                position = self.tx_log.append(rlp.encode(self.batch.log_ops))
+                self.batch.put(LOG_POSITION_KEY, encode_log_position(position))
+            self.batch.write()
+        except BaseException:
+            self.range_index.rollback()
+            raise
+        else:
+            self.range_index.commit()
+        finally:
+            self.batch = None
+        if block_number is not None:
+            self.block_number = block_number
+            self.retain_snapshot(block_number)
+
+    def retain_snapshot(self, block_number):
+        self.block_snapshots[block_number] = self.db.snapshot()
+        while len(self.block_snapshots) > self.snapshot_retention:
+            # Just drop the oldest snapshot--readers still using it keep it alive
+            del self.block_snapshots[min(self.block_snapshots)]
+
+    @contextmanager
+    def snapshot(self, block_number=None):
+        ''' Yields a StateView of the state right after block `block_number` was committed,
+            or of the latest committed state if no block number is given.
+        '''
+        if block_number is None:
+            snapshot = self.db.snapshot()
+            # Read the block number from the snapshot itself so it matches the data
+            block_number = snapshot.get(BLOCK_NUMBER_KEY)
+            try:
+                yield StateView(snapshot, None if block_number is None else big_endian_to_int(block_number))
+            finally:
+                snapshot.close()
+            return
+        snapshot = self.block_snapshots.get(block_number)
+        assert snapshot is not None, 'No snapshot retained for block %d' % block_number
+        yield StateView(snapshot, block_number)
+
+    def recover(self):
+        ''' Re-applies every tx log record which is missing from the DB, eg. after a crash '''
+        last_position = self.db.get(LOG_POSITION_KEY)
+        last_position = (0, 0) if last_position is None else decode_log_position(last_position)
+        for position, payload in self.tx_log.replay(last_position[0]):
+            if position <= last_position:
+                continue
+            with self.write_batch() as wb:
+                # Don't log the ops again, just record how far we've replayed
+                wb.log_ops = None
+                for op in rlp.decode(payload):
+                    self.apply_log_op(op)
+                wb.put(LOG_POSITION_KEY, encode_log_position(position))
+
+    def apply_log_op(self, op):
+        if op[0] == DEPOSIT_OP:
+            self.add_deposit(op[1], big_endian_to_int(op[2]), big_endian_to_int(op[3]))
+        elif op[0] == TRANSFER_OP:
+            self.add_transaction([SimpleSerializableElement.decode(op[1], TransferRecord)])
+        elif op[0] == BLOCK_OP:
+            self.batch.put(BLOCK_NUMBER_KEY, op[1])
+            self.block_number = big_endian_to_int(op[1])
+        else:
+            raise ValueError('Unknown tx log op: %s' % op[0])
+
+    def log_op(self, op):
+        if self.batch.log_ops is not None:
+            self.batch.log_ops.append(op)
+
+    def close(self):
+        self.tx_log.close()
+        self.db.close()
+
+    def get(self, key):
+        ''' Reads a key, including writes staged in the current batch '''
+        if self.batch is not None:
+            return self.batch.get(key)
+        return self.db.get(key)
+
+    def iterate_keys(self, start, stop, reverse=False):
+        ''' Iterates over the keys in [start, stop), including writes staged in the current batch '''
+        if self.batch is not None:
+            return self.batch.iterator(start, stop, reverse=reverse)
+        return self.db.iterator(start=start, stop=stop, reverse=reverse, include_value=False)
+
+    def add_deposit(self, recipient, token_id, amount):
+        return self.add_deposits([(recipient, token_id, amount)])
+
+    def add_deposits(self, deposits):
+        ''' Adds a batch of (recipient, token_id, amount) deposits in one write batch.
+            Each deposit's start comes from an in-memory counter per token, so the
+            total deposits counter is only read & written once per token.
+        '''
+        # Begin write batch--data written to DB during write batch is all or nothing
+        with self.write_batch() as wb:
+            total_deposits = {}
+            for recipient, token_id, amount in deposits:
+                token_id_bytes = int_to_big_endian8(token_id)
+                if token_id_bytes not in total_deposits:
+                    token_total_deposits = self.get(get_total_deposits_key(token_id_bytes))
+                    total_deposits[token_id_bytes] = 0 if token_total_deposits is None else big_endian_to_int(token_total_deposits)
+                deposit_start = total_deposits[token_id_bytes]
+                total_deposits[token_id_bytes] = deposit_start + amount
+                # Store the range, merging it into the previous range if that has the same owner
+                self.store_range(recipient, token_id, deposit_start, amount)
+                self.coalesce_range(token_id_bytes, deposit_start)
+                recipient, = self.get_converted_parameters(addresses=(recipient,))
+                self.log_op([DEPOSIT_OP, recipient, token_id_bytes, int_to_big_endian32(amount)])
+            # Update total deposits
+            for token_id_bytes, token_total_deposits in total_deposits.items():
+                wb.put(get_total_deposits_key(token_id_bytes), int_to_big_endian32(token_total_deposits))
+        return True
+
+    def store_range(self, owner, token_id, start, offset):
+        ''' Stores a range with the specified parameters.
+            Note that all params other than `owner` are ints.
+        '''
+        owner, token_id, start = self.get_converted_parameters(addresses=(owner,), bytes8s=(token_id,), bytes32s=(start,))
+        # Put everything into the db
+        with self.write_batch() as wb:
+            if self.get(get_owner_to_nonce_key(owner)) is None:
+                # If there's no nonce for the owner, add one
+                wb.put(get_owner_to_nonce_key(owner), int_to_big_endian8(0))
+            wb.put(get_owner_to_start_key(owner, token_id, start), b'')
+            start = big_endian_to_int(start)
+            self.put_range(token_id, start, start + offset, owner)
+
+    def put_range(self, token_id, start, end, owner):
+        ''' Writes the range key, updates the index & the owner's balance. Does not touch the owner index. '''
+        previous = self.range_index.get(token_id, start)
+        with self.write_batch() as wb:
+            wb.put(get_range_key(token_id, int_to_big_endian32(start)), encode_range_value(end, owner))
+            if previous is not None:
+                self.update_balance(previous[1], token_id, start - previous[0])
+            self.update_balance(owner, token_id, end - start)
+        self.range_index.add(token_id, start, end, owner)
+
+    def update_balance(self, owner, token_id, delta):
+        balance_key = get_balance_key(owner, token_id)
+        balance = self.get(balance_key)
+        balance = 0 if balance is None else big_endian_to_int(balance)
+        with self.write_batch() as wb:
+            wb.put(balance_key, int_to_big_endian32(balance + delta))
+
+    def get_range(self, token_id, start):
+        ''' Returns (end, owner) of the range starting at `start`, or None '''
+        return self.range_index.get(token_id, start)
+
+    def get_ranges(self, token_id, start, end):
+        ''' Returns the keys of the range containing `start` and every following range
+            which starts at or before `end`.
+        '''
+        token_id, = self.get_converted_parameters(bytes8s=(token_id,))
+        return [get_range_key(token_id, int_to_big_endian32(r[0])) for r in self.range_index.get_overlapping(token_id, start, end)]
+
     def delete_ranges(self, ranges):
-        for r in ranges:
-            self.db.delete(r)
-
-    def add_transaction(self, txs):
-        affected_ranges = []
-        for tx in txs:
-            tx_ranges = self.get_ranges(tx.token_id, tx.start, tx.start + tx.offset)
-            assert self.verify_ranges_owner(tx_ranges[1::2], tx.sender)
-            print([big_endian_to_int(r[8:40]) for r in tx_ranges])
-            affected_ranges.append(tx_ranges)
-        print(affected_ranges)
+        with self.write_batch() as wb:
+            for r in ranges:
+                token_id, start = decode_range_key(r)
+                end, owner = self.range_index.get(token_id, start)
+                wb.delete(get_owner_to_start_key(owner, token_id, r[9:41]))
+                wb.delete(r)
+                self.update_balance(owner, token_id, start - end)
+                self.range_index.remove(token_id, start)
+
+    def add_transaction(self, txs, sigs=None, pool=None):
+        ''' Applies a batch of TransferRecords & returns whether each tx was accepted.
+            A tx is rejected if it moves no coins, if its coins aren't all owned by its
+            sender or, when `sigs` are given, if its signature is bad (signatures are
+            verified in one batch, fanned out over `pool` if given). Of the txs which
+            pass, the ones overlapping each other are rejected too--so a tx which was
+            going to fail anyway can't knock out a valid one--& every other tx is
+            applied in one write batch.
+        '''
+        if sigs is not None:
+            accepted = validate_tx_sigs(list(zip(txs, sigs)), pool)
+        else:
+            accepted = [True] * len(txs)
         for i, tx in enumerate(txs):
-            self.add_transfer(tx, affected_ranges[i])
+            if not accepted[i] or tx.offset <= 0:
+                accepted[i] = False
+                continue
+            # Txs which don't overlap touch disjoint coins, so checking them all
+            # against the state before the batch is the same as checking them in turn
+            tx_ranges = self.get_ranges(tx.token_id, tx.start, tx.start + tx.offset - 1)
+            if not self.verify_ranges_cover(tx_ranges, tx.start, tx.start + tx.offset) or not self.verify_ranges_owner(tx_ranges, tx.sender):
+                accepted[i] = False
+        passed = [i for i in range(len(txs)) if accepted[i]]
+        for i in find_conflicting_transfers([txs[i] for i in passed]):
+            accepted[passed[i]] = False
+        with self.write_batch():
+            for i, tx in enumerate(txs):
+                if not accepted[i]:
+                    continue
+                # Earlier transfers in the batch may have split or merged ranges around this one
+                self.add_transfer(tx, self.get_ranges(tx.token_id, tx.start, tx.start + tx.offset - 1))
+                self.log_op([TRANSFER_OP, encode_transfer(tx)])
+        return accepted
 
     def add_transfer(self, transfer, affected_ranges):
-        sender, recipient, token_id, start, offset = self.get_converted_parameters(addresses=(transfer.sender, transfer.recipient), bytes8s=(transfer.token_id,), bytes32s=(transfer.start, transfer.offset))
-        end = token_id + int_to_big_endian32(big_endian_to_int(start) + big_endian_to_int(offset)) + OFFSET_SUFFIX
-        # Shorten first range if needed
-        if get_start_to_offset_key(token_id, start) != affected_ranges[0]:
-            # TODO: Add
-            self.db.put(affected_ranges[0], int_to_big_endian32(big_endian_to_int(start) - big_endian_to_int(affected_ranges[0][8:40])))
-            print('setting new end offset to:', big_endian_to_int(start) - big_endian_to_int(affected_ranges[0][8:40]))
-            del affected_ranges[0:2]
-        # Shorten last range if needed
-        if len(affected_ranges) != 0 and end != affected_ranges[-1]:
-            self.db.put(affected_ranges[-2], start + offset)
-            print('setting new start to:', big_endian_to_int(start) + big_endian_to_int(offset))
-            del affected_ranges[-2:]
-
-        # # Check that affected ranges are owned by the sender
-        # assert self.validate_range_owner(affected_ranges, tx.sender)
-        # # Shorten first range if needed
-        # if new_db_entry.start_to_offset_key != affected_ranges[0]:
-        #     # TODO: Add
-        #     self.db.put(affected_ranges[0], int_to_big_endian32(tx.start - big_endian_to_int(affected_ranges[0][8:40])))
-        #     print('setting new end offset to:', tx.start - big_endian_to_int(affected_ranges[0][8:40]))
-        #     del affected_ranges[0:2]
-        # # Shorten last range if needed
-        # if len(affected_ranges) != 0 and new_db_entry.end != affected_ranges[-1]:
-        #     self.db.put(affected_ranges[-2], int_to_big_endian32(tx.start + tx.offset))
-        #     print('setting new start to:', tx.start + tx.offset)
-        #     del affected_ranges[-2:]
-        # print('Final Affected range start pos:', [big_endian_to_int(r[8:40]) for r in affected_ranges])
+        ''' Moves the coins [start, start + offset) to the recipient, splitting the first
+            & last affected ranges if the transfer only covers part of them.
+        '''
+        sender, recipient, token_id = self.get_converted_parameters(addresses=(transfer.sender, transfer.recipient), bytes8s=(transfer.token_id,))
+        start = transfer.start
+        end = transfer.start + transfer.offset
+        assert transfer.offset > 0
+        first_start = decode_range_key(affected_ranges[0])[1]
+        first_owner = self.range_index.get(token_id, first_start)[1]
+        last_end, last_owner = self.range_index.get(*decode_range_key(affected_ranges[-1]))
+        assert first_start <= start and end <= last_end
+        with self.write_batch():
+            if first_start < start:
+                # Shorten the first range in place--its key & owner index entry stay the same
+                self.put_range(token_id, first_start, start, first_owner)
+                affected_ranges = affected_ranges[1:]
+            self.delete_ranges(affected_ranges)
+            # Give back the part of the last range after the transfer
+            if end < last_end:
+                self.store_range(last_owner, token_id, end, last_end - end)
+            self.store_range(recipient, token_id, start, end - start)
+            self.coalesce_range(token_id, start)
+
+    def coalesce_range(self, token_id, start):
+        ''' Merges the range starting at `start` with its neighbours if they are adjacent
+            & have the same owner. Returns the start of the merged range.
+        '''
+        end, owner = self.range_index.get(token_id, start)
+        previous = self.range_index.get_previous(token_id, start)
+        following = self.range_index.get(token_id, end)
+        merge_previous = previous is not None and previous[1] == start and previous[2] == owner
+        merge_following = following is not None and following[1] == owner
+        if not merge_previous and not merge_following:
+            return start
+        with self.write_batch():
+            merged_ranges = []
+            merged_start, merged_end = start, end
+            if merge_previous:
+                merged_ranges.append(get_range_key(token_id, int_to_big_endian32(start)))
+                merged_start = previous[0]
+            if merge_following:
+                merged_ranges.append(get_range_key(token_id, int_to_big_endian32(end)))
+                merged_end = following[0]
+            # Delete the ranges being merged away, then grow the one which is kept in place
+            self.delete_ranges(merged_ranges)
+            self.put_range(token_id, merged_start, merged_end, owner)
+        return merged_start
+
+    def coalesce_ranges(self, token_id, start=0, max_ranges=1000):
+        ''' Background pass which merges runs of adjacent ranges with the same owner,
+            visiting at most `max_ranges` ranges of `token_id` from `start` in one write
+            batch. Returns where the next pass should start, or None once the end of the
+            token's ranges has been reached.
+        '''
+        token_id, = self.get_converted_parameters(bytes8s=(token_id,))
+        starts = self.range_index.starts.get(token_id, [])
+        with self.write_batch():
+            for n in range(max_ranges):
+                # Skip to the first range which starts at or after `start`
+                i = bisect.bisect_left(starts, start)
+                if i == len(starts):
+                    return None
+                start = self.coalesce_range(token_id, starts[i])
+                start = self.range_index.get(token_id, start)[0]
+        return start
+
+    def get_range_metrics(self, token_id):
+        ''' Returns counts describing how fragmented the ranges of `token_id` are '''
+        token_id, = self.get_converted_parameters(bytes8s=(token_id,))
+        ranges_by_owner = {}
+        for end, owner in self.range_index.ranges.get(token_id, {}).values():
+            ranges_by_owner[owner] = ranges_by_owner.get(owner, 0) + 1
+        num_ranges = sum(ranges_by_owner.values())
+        return {
+            'ranges': num_ranges,
+            'owners': len(ranges_by_owner),
+            'ranges_per_owner': num_ranges / len(ranges_by_owner) if ranges_by_owner else 0,
+            'max_ranges_per_owner': max(ranges_by_owner.values()) if ranges_by_owner else 0,
+        }
@@ -0,0 +1,271 @@
+import bisect
+import heapq
+import threading
+import plyvel
+
+'''
+Storage backends for State.
+
+Every backend is an ordered key-value store of bytes with the same interface as
+plyvel.DB, which is what State was first written against:
+
+- get(key), put(key, value), delete(key)
+- iterator(start=None, stop=None, prefix=None, reverse=False, include_value=True)
+  iterates over [start, stop) (or over every key with `prefix`) in key order,
+  seeking straight to `start` (or to `stop` when reversed)
+- write_batch() -> batch with put(key, value), delete(key) & write(), which
+  applies every staged write at once
+- snapshot() -> read-only view with get(key), iterator(...) & close() which
+  doesn't see writes made after it was taken
+- close()
+
+Backends are constructed as `backend(path, create_if_missing=True)`, so a backend
+class can be passed straight to State.
+'''
+
+
+# Above this many pending changes MemoryBackend re-merges its sorted keys instead of splicing
+MAX_SORTED_KEY_UPDATES = 64
+
+def get_prefix_stop(prefix):
+    ''' Returns the smallest key greater than every key starting with `prefix` '''
+    prefix = prefix.rstrip(b'\xff')
+    if len(prefix) == 0:
+        return None
+    return prefix[:-1] + bytes([prefix[-1] + 1])
+
+def iterate_sorted_keys(sorted_keys, kv, start, stop, prefix, reverse, include_value):
+    if prefix is not None:
+        start, stop = prefix, get_prefix_stop(prefix)
+    lo = 0 if start is None else bisect.bisect_left(sorted_keys, start)
+    hi = len(sorted_keys) if stop is None else bisect.bisect_left(sorted_keys, stop)
+    keys = sorted_keys[lo:hi]
+    if reverse:
+        keys.reverse()
+    for key in keys:
+        if key not in kv:
+            continue
+        yield (key, kv[key]) if include_value else key
+
+
+class LevelDBBackend:
+    ''' LevelDB through plyvel--the default backend '''
+    def __init__(self, path, create_if_missing=True):
+        self.db = plyvel.DB(path, create_if_missing=create_if_missing)
+
+    def get(self, key):
+        return self.db.get(key)
+
+    def put(self, key, value):
+        self.db.put(key, value)
+
+    def delete(self, key):
+        self.db.delete(key)
+
+    def iterator(self, start=None, stop=None, prefix=None, reverse=False, include_value=True):
+        return self.db.iterator(start=start, stop=stop, prefix=prefix, reverse=reverse, include_value=include_value)
+
+    def write_batch(self):
+        return self.db.write_batch()
+
+    def snapshot(self):
+        return self.db.snapshot()
+
+    def close(self):
+        self.db.close()
+
+
+class MemoryWriteBatch:
+    def __init__(self, backend):
+        self.backend = backend
+        self.ops = []
+
+    def put(self, key, value):
+        self.ops.append((key, value))
+
+    def delete(self, key):
+        self.ops.append((key, None))
+
+    def write(self):
+        # Hold the backend's lock so a snapshot never sees half a batch
+        with self.backend.lock:
+            for key, value in self.ops:
+                if value is None:
+                    self.backend.delete(key)
+                else:
+                    self.backend.put(key, value)
+        self.ops = []
+
+
+class MemorySnapshot:
+    def __init__(self, kv, sorted_keys):
+        self.kv = kv
+        self.sorted_keys = sorted_keys
+
+    def get(self, key):
+        return self.kv.get(key)
+
+    def iterator(self, start=None, stop=None, prefix=None, reverse=False, include_value=True):
+        return iterate_sorted_keys(self.sorted_keys, self.kv, start, stop, prefix, reverse, include_value)
+
+    def close(self):
+        pass
+
+
+class MemoryBackend:
+    '''
+    Ordered in-memory map. Values live in a dict & keys in a sorted list which is
+    brought up to date lazily, the next time the map is iterated: a few changes are
+    spliced in, many are sorted & merged in one pass. Bulk loads are O(n log n)
+    rather than O(n) per put. Snapshots copy the map, so they are O(n). Writes,
+    batches & snapshots take one lock, so a snapshot taken from another thread
+    sees every batch either whole or not at all.
+    '''
+    def __init__(self, path=None, create_if_missing=True):
+        self.lock = threading.RLock()
+        self.kv = {}
+        self.sorted_keys = []
+        # New keys which aren't in `sorted_keys` yet
+        self.unsorted_keys = set()
+        # Deleted keys which are still in `sorted_keys`
+        self.deleted_keys = set()
+
+    def get(self, key):
+        return self.kv.get(key)
+
+    def put(self, key, value):
+        with self.lock:
+            if key not in self.kv:
+                if key in self.deleted_keys:
+                    self.deleted_keys.remove(key)
+                else:
+                    self.unsorted_keys.add(key)
+            self.kv[key] = value
+
+    def delete(self, key):
+        with self.lock:
+            if key in self.kv:
+                del self.kv[key]
+                if key in self.unsorted_keys:
+                    self.unsorted_keys.remove(key)
+                else:
+                    self.deleted_keys.add(key)
+
+    def get_sorted_keys(self):
+        with self.lock:
+            return self.update_sorted_keys()
+
+    def update_sorted_keys(self):
+        if 0 < len(self.deleted_keys) + len(self.unsorted_keys) <= MAX_SORTED_KEY_UPDATES:
+            # A few changes are cheaper to splice in than to merge the whole list
+            for key in self.deleted_keys:
+                del self.sorted_keys[bisect.bisect_left(self.sorted_keys, key)]
+            for key in self.unsorted_keys:
+                bisect.insort(self.sorted_keys, key)
+            self.deleted_keys = set()
+            self.unsorted_keys = set()
+        if len(self.deleted_keys) > 0:
+            self.sorted_keys = [k for k in self.sorted_keys if k not in self.deleted_keys]
+            self.deleted_keys = set()
+        if len(self.unsorted_keys) > 0:
+            self.sorted_keys = list(heapq.merge(self.sorted_keys, sorted(self.unsorted_keys)))
+            self.unsorted_keys = set()
+        return self.sorted_keys
+
+    def iterator(self, start=None, stop=None, prefix=None, reverse=False, include_value=True):
+        return iterate_sorted_keys(self.get_sorted_keys(), self.kv, start, stop, prefix, reverse, include_value)
+
+    def write_batch(self):
+        return MemoryWriteBatch(self)
+
+    def snapshot(self):
+        with self.lock:
+            return MemorySnapshot(dict(self.kv), list(self.update_sorted_keys()))
+
+    def close(self):
+        pass
+
+
+def iterate_lmdb(txn, start, stop, prefix, reverse, include_value):
+    if prefix is not None:
+        start, stop = prefix, get_prefix_stop(prefix)
+    cursor = txn.cursor()
+    if reverse:
+        # Position on the last key before `stop`
+        if stop is None or not cursor.set_range(stop):
+            positioned = cursor.last()
+        else:
+            positioned = cursor.prev()
+        while positioned and (start is None or cursor.key() >= start):
+            yield (cursor.key(), cursor.value()) if include_value else cursor.key()
+            positioned = cursor.prev()
+    else:
+        positioned = cursor.first() if start is None else cursor.set_range(start)
+        while positioned and (stop is None or cursor.key() < stop):
+            yield (cursor.key(), cursor.value()) if include_value else cursor.key()
+            positioned = cursor.next()
+
+
+class LMDBWriteBatch(MemoryWriteBatch):
+    def write(self):
+        # Apply the whole batch in one LMDB write transaction
+        with self.backend.env.begin(write=True) as txn:
+            for key, value in self.ops:
+                if value is None:
+                    txn.delete(key)
+                else:
+                    txn.put(key, value)
+        self.ops = []
+
+
+class LMDBSnapshot:
+    ''' A long-lived LMDB read transaction, which is a consistent snapshot by design '''
+    def __init__(self, env):
+        self.txn = env.begin()
+
+    def get(self, key):
+        return self.txn.get(key)
+
+    def iterator(self, start=None, stop=None, prefix=None, reverse=False, include_value=True):
+        return iterate_lmdb(self.txn, start, stop, prefix, reverse, include_value)
+
+    def close(self):
+        self.txn.abort()
+
+
+class LMDBBackend:
+    '''
+    Memory-mapped B+tree store through the optional `lmdb` package. Reads are served
+    straight out of the page cache. `map_size` caps the size of the DB.
+    '''
+    def __init__(self, path, create_if_missing=True, map_size=2**34):
+        import lmdb
+        self.env = lmdb.open(path, map_size=map_size, create=create_if_missing)
+
+    def get(self, key):
+        with self.env.begin() as txn:
+            return txn.get(key)
+
+    def put(self, key, value):
+        with self.env.begin(write=True) as txn:
+            txn.put(key, value)
+
+    def delete(self, key):
+        with self.env.begin(write=True) as txn:
+            txn.delete(key)
+
+    def iterator(self, start=None, stop=None, prefix=None, reverse=False, include_value=True):
+        snapshot = LMDBSnapshot(self.env)
+        try:
+            yield from snapshot.iterator(start, stop, prefix, reverse, include_value)
+        finally:
+            snapshot.close()
+
+    def write_batch(self):
+        return LMDBWriteBatch(self)
+
+    def snapshot(self):
+        return LMDBSnapshot(self.env)
+
+    def close(self):
+        self.env.close()
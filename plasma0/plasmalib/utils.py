@@ -2,9 +2,9 @@ from web3 import Web3
 from web3.contract import ConciseContract
 from eth_tester import EthereumTester, PyEVMBackend
 from vyper import compiler
-from math import floor, ceil, log
 from hexbytes import HexBytes
 from plasmalib.constants import *
+from plasmalib.merkle import iterate_levels, hash_parent
 from eth_utils import encode_hex as encode_hex_0x
 from eth_utils import (
     int_to_big_endian,
@@ -16,10 +16,10 @@ PP = PrettyPrinter(indent=4)
 
 
 class MST:
-    def __init__(self, l, r):
+    def __init__(self, l, r, h=None):
         self.l = l
         self.r = r
-        self.h = Web3.sha3(l.h + r.h)
+        self.h = Web3.sha3(l.h + r.h) if h is None else h
 
 class Leaf:
     def __init__(self, tx):
@@ -122,19 +122,19 @@ def pairs(l):
 
 # assumes no overlapping txs
 def construct_tree(txs):
-    depth = ceil(log(len(txs), 2))
+    depth = (len(txs) - 1).bit_length()
     assert depth <= MAX_TREE_DEPTH
 
     leaves = [Leaf(tx) for tx in txs]
     leaves.sort(key = lambda leaf: leaf.tx.msg.start)
-    leaves += [Leaf(NullTx())] * (2 ** depth - len(leaves))
+    leaves += [Leaf(NullTx(0, 0))] * (2 ** depth - len(leaves))
 
-    fst = lambda x: x[0]
-    snd = lambda x: x[1]
+    # Hash every level in one pass, then link up the MST nodes
+    levels = iterate_levels([leaf.h for leaf in leaves], hash_parent, 32)
+    next(levels)
     nodes = leaves
-    # depth = 1
-    for i in range(depth):
-        nodes = list(map(lambda x: MST(fst(x), snd(x)), pairs(nodes)))
+    for level in levels:
+        nodes = [MST(l, r, level[i * 32:(i + 1) * 32]) for i, (l, r) in enumerate(pairs(nodes))]
     return nodes[0]
 
 
@@ -0,0 +1,164 @@
+import os
+import struct
+import threading
+import time
+import zlib
+
+'''
+Segment-based write-ahead log.
+
+The log is a directory of segment files named after their (increasing) segment
+number. Every record is written as:
+
+    length [4 bytes] + crc32 of the payload [4 bytes] + payload [length bytes]
+
+A record never spans two segments. On open a fresh segment is always started, so a
+record torn by a crash can only ever sit at the tail of an older segment, and
+`replay` skips the rest of that segment.
+
+Every append is flushed to the OS before it returns, so a record survives the
+process crashing as soon as `append` returns. Group commit: fsyncs are batched,
+happening once `sync_records` records have been appended since the last fsync,
+or at the latest `sync_interval_ms` after the first unsynced append--a background
+timer syncs a log which went idle. So on power failure (or an OS crash) at most
+that window of records can be lost, without paying an fsync per record.
+'''
+
+SEGMENT_SUFFIX = '.wal'
+RECORD_HEADER = struct.Struct('>II')
+
+
+def get_segment_name(segment_number):
+    return '%016d%s' % (segment_number, SEGMENT_SUFFIX)
+
+def encode_record(payload):
+    return RECORD_HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+
+def read_records(segment_file):
+    ''' Yields (end offset, payload) of every intact record in an open segment file,
+        stopping at the first torn or corrupt record.
+    '''
+    offset = 0
+    while True:
+        header = segment_file.read(RECORD_HEADER.size)
+        if len(header) < RECORD_HEADER.size:
+            return
+        length, checksum = RECORD_HEADER.unpack(header)
+        payload = segment_file.read(length)
+        if len(payload) < length or zlib.crc32(payload) != checksum:
+            return
+        offset += RECORD_HEADER.size + length
+        yield offset, payload
+
+
+class WriteAheadLog:
+    def __init__(self, log_dir, sync_records=100, sync_interval_ms=10, segment_bytes=64 * 2**20, segment_timeout=60):
+        self.log_dir = log_dir
+        self.sync_records = sync_records
+        self.sync_interval_ms = sync_interval_ms
+        self.segment_bytes = segment_bytes
+        self.segment_timeout = segment_timeout
+        os.makedirs(log_dir, exist_ok=True)
+        segments = self.get_segments()
+        self.segment_number = segments[-1] if len(segments) > 0 else -1
+        self.segment = None
+        self.unsynced_records = 0
+        self.last_sync = time.time()
+        # Guards the segment against the sync timer's thread
+        self.lock = threading.RLock()
+        self.sync_timer = None
+        self.rotate()
+
+    def get_segments(self):
+        ''' Returns the numbers of every segment in the log directory, in order '''
+        return sorted(int(name[:-len(SEGMENT_SUFFIX)]) for name in os.listdir(self.log_dir) if name.endswith(SEGMENT_SUFFIX))
+
+    def get_segment_path(self, segment_number):
+        return os.path.join(self.log_dir, get_segment_name(segment_number))
+
+    def append(self, payload):
+        ''' Appends a record & returns its position: (segment number, end offset in the segment) '''
+        with self.lock:
+            if self.rotation_due():
+                self.rotate()
+            record = encode_record(payload)
+            self.segment.write(record)
+            self.segment.flush()
+            self.segment_size += len(record)
+            self.unsynced_records += 1
+            if self.sync_due():
+                self.sync()
+            elif self.sync_timer is None:
+                self.sync_timer = threading.Timer(self.sync_interval_ms / 1000, self.timed_sync)
+                self.sync_timer.daemon = True
+                self.sync_timer.start()
+            return self.segment_number, self.segment_size
+
+    def sync_due(self):
+        if self.unsynced_records == 0:
+            return False
+        return self.unsynced_records >= self.sync_records or (time.time() - self.last_sync) * 1000 >= self.sync_interval_ms
+
+    def rotation_due(self):
+        return self.segment_size >= self.segment_bytes or time.time() - self.segment_opened > self.segment_timeout
+
+    def sync(self):
+        with self.lock:
+            self.segment.flush()
+            os.fsync(self.segment.fileno())
+            self.unsynced_records = 0
+            self.last_sync = time.time()
+            if self.sync_timer is not None:
+                self.sync_timer.cancel()
+                self.sync_timer = None
+
+    def tick(self):
+        ''' Syncs & rotates if either is due. Unsynced records are already synced on
+            time by the sync timer; call this periodically so an idle log still gets
+            rotated on time, not just on the next append.
+        '''
+        with self.lock:
+            if self.sync_due():
+                self.sync()
+            if self.rotation_due():
+                self.rotate()
+
+    def timed_sync(self):
+        ''' Sync timer callback: syncs whatever was appended since the timer started '''
+        with self.lock:
+            self.sync_timer = None
+            if self.unsynced_records > 0 and not self.segment.closed:
+                self.sync()
+
+    def rotate(self):
+        ''' Seals the current segment & starts the next one '''
+        if self.segment is not None:
+            self.sync()
+            self.segment.close()
+        self.segment_number += 1
+        self.segment = open(self.get_segment_path(self.segment_number), 'ab')
+        self.segment_size = 0
+        self.segment_opened = time.time()
+        # Make sure the new segment's directory entry survives a crash
+        dir_fd = os.open(self.log_dir, os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+
+    def replay(self, from_segment=0):
+        ''' Yields (position, payload) for every intact record in segment `from_segment`
+            and all later segments, where position is (segment number, end offset).
+        '''
+        self.segment.flush()
+        for segment_number in self.get_segments():
+            if segment_number < from_segment:
+                continue
+            with open(self.get_segment_path(segment_number), 'rb') as segment_file:
+                for offset, payload in read_records(segment_file):
+                    yield (segment_number, offset), payload
+
+    def close(self):
+        with self.lock:
+            self.sync()
+            self.segment.close()
@@ -6,12 +6,27 @@ from web3 import Web3
 from web3.contract import ConciseContract
 from eth_tester import EthereumTester, PyEVMBackend
 from eth_account import Account
-from plasmalib.utils import contract_factory
+from plasmalib.utils import contract_factory, Msg, Tx
 from plasmalib.constants import PLASMA_BLOCK_INTERVAL
 from plasmalib.state import State
 from random import randrange, seed
 
 
+def pytest_addoption(parser):
+    parser.addoption('--runslow', action='store_true', help='also run the slow benchmarks')
+
+def pytest_configure(config):
+    config.addinivalue_line('markers', 'slow: slow benchmark, only run with --runslow')
+
+def pytest_collection_modifyitems(config, items):
+    if config.getoption('--runslow'):
+        return
+    skip_slow = pytest.mark.skip(reason='slow benchmark, run with --runslow')
+    for item in items:
+        if 'slow' in item.keywords:
+            item.add_marker(skip_slow)
+
+
 @pytest.fixture(scope="session")
 def tester():
     return EthereumTester(backend=PyEVMBackend())
@@ -47,6 +62,35 @@ def accts(w3):
         w3.personal.unlockAccount(accts[i].address, PASSPHRASE)
     return accts
 
+class MockSig:
+    v = 0
+    r = 0
+    s = 0
+
+@pytest.fixture
+def mock_signer():
+    ''' Signs with an all zero signature, for txs whose signatures aren't checked '''
+    return lambda msg: MockSig()
+
+@pytest.fixture
+def random_txs(mock_signer):
+    ''' Returns a factory for random txs between `accts` over the coins [0, total_deposits),
+        of min_offset to max_range - 1 coins each. Given the `coin_map`, 3 in 4 txs are sent by
+        the real owner of their first coin, so some are valid.
+    '''
+    def make_random_txs(accts, num_txs, total_deposits, max_range=10, coin_map=None, min_offset=1):
+        txs = []
+        for i in range(num_txs):
+            start = randrange(total_deposits - max_range)
+            if coin_map is not None and randrange(4):
+                sender = coin_map.get_owner(start)
+            else:
+                sender = accts[randrange(len(accts))].address
+            msg = Msg(sender, accts[randrange(len(accts))].address, start, randrange(min_offset, max_range))
+            txs.append(Tx(msg, None, mock_signer))
+        return txs
+    return make_random_txs
+
 class MockAccount:
     def __init__(self, address):
         self.address = address
@@ -1,10 +1,14 @@
-from plasmalib.block_generator import create_tx_buckets, EphemDB, construct_tree
-from plasmalib.transaction_validator import add_tx, add_deposit, subtract_range, add_range
+from plasmalib.operator import block_generator
+from plasmalib.operator.block_generator import create_tx_buckets, EphemDB, construct_tree, add_sum_to_hash
+from plasmalib.operator.transaction_validator import add_tx, add_swap, apply_txs, add_deposit, subtract_range, add_range, get_owner, RangeList, RANGE_LIST_CHUNK_SIZE
+from plasmalib.merkle import build_tree_parallel, sum_hash_parent
 from plasmalib.utils import Msg, Tx, Swap
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from random import randrange
+from web3 import Web3
 import pickle
+import pytest
 import time
-import os
 
 class MockSig:
     def __init__(self):
@@ -107,9 +111,8 @@ def process_tx(db, write_file, tx):
 
 
 # def add_deposit(db, owner, amount, total_deposits):
-def test_tx_validator(w3, tester, mock_accts):
-    file_path = os.path.dirname(os.path.realpath(__file__)) + '/test.txt'
-    test_write = open(file_path, 'w')
+def test_tx_validator(w3, tester, mock_accts, tmp_path):
+    test_write = open(str(tmp_path / 'test.txt'), 'w')
 
     accts = mock_accts
     print([a.address for a in accts])
@@ -163,7 +166,7 @@ def test_tx_validator(w3, tester, mock_accts):
 
 def test_subtract_range():
     # Test subtracting a bunch of ranges
-    range_list = [0, 3, 6, 10, 15, 17, 18, 18]
+    range_list = RangeList([0, 3, 6, 10, 15, 17, 18, 18])
     subtract_range(range_list, 0, 3)
     assert range_list == [6, 10, 15, 17, 18, 18]
     subtract_range(range_list, 18, 18)
@@ -183,7 +186,7 @@ def test_subtract_range():
 
 def test_add_range():
     # Test adding a bunch of ranges
-    range_list = [0, 1, 6, 10, 15, 17, 20, 20]
+    range_list = RangeList([0, 1, 6, 10, 15, 17, 20, 20])
     add_range(range_list, 5, 5)
     assert range_list == [0, 1, 5, 10, 15, 17, 20, 20]
     add_range(range_list, 3, 3)
@@ -197,6 +200,196 @@ def test_add_range():
     add_range(range_list, 11, 14)
     assert range_list == [0, 20]
 
+def test_range_list_across_chunks():
+    # Enough ranges to split into several chunks
+    num_ranges = RANGE_LIST_CHUNK_SIZE * 5
+    range_list = RangeList()
+    for i in range(num_ranges):
+        range_list.append(i * 10, i * 10 + 4)
+    expected = list(range_list)
+    # Fill every gap from the back, merging everything into one range
+    for i in reversed(range(num_ranges - 1)):
+        assert subtract_range(range_list, i * 10 + 5, i * 10 + 9) is False
+        add_range(range_list, i * 10 + 5, i * 10 + 9)
+    assert range_list == [0, num_ranges * 10 - 6]
+    # Punch the gaps back out from the front
+    for i in range(num_ranges - 1):
+        assert subtract_range(range_list, i * 10 + 5, i * 10 + 9)
+    assert range_list == expected
+    assert len(range_list) == 2 * num_ranges
+    assert range_list[-1] == num_ranges * 10 - 6
+    assert range_list.get(RANGE_LIST_CHUNK_SIZE * 30 + 3) == (RANGE_LIST_CHUNK_SIZE * 30, RANGE_LIST_CHUNK_SIZE * 30 + 4)
+    assert range_list.get(RANGE_LIST_CHUNK_SIZE * 30 + 7) is None
+
+def test_add_tx_spanning_ranges(mock_accts):
+    a0, a1 = mock_accts[0].address, mock_accts[1].address
+    db = EphemDB()
+    add_deposit(db, a0, 5)
+    add_deposit(db, a0, 5)
+    add_deposit(db, a1, 5)
+    # Adjacent deposits of one owner are merged
+    assert db.get(a0) == [0, 9]
+    # Spans both of a0's deposits
+    assert add_tx(db, Tx(Msg(a0, a1, 3, 5), None, mock_signer)) is not False
+    assert db.get(a0) == [0, 2, 8, 9]
+    assert db.get(a1) == [3, 7, 10, 14]
+    assert [get_owner(db, i) for i in (0, 3, 7, 8, 10, 15)] == [a0, a1, a1, a0, a1, None]
+    # Coins 8 & 9 aren't a1's
+    assert add_tx(db, Tx(Msg(a1, a0, 3, 10), None, mock_signer)) is False
+    assert add_tx(db, Tx(Msg(a0, a1, 8, 2), None, mock_signer)) is not False
+    assert db.get(a1) == [3, 14]
+    # Now a1 can send coins which arrived in three separate ranges at once
+    assert add_tx(db, Tx(Msg(a1, a0, 3, 12), None, mock_signer)) is not False
+    assert db.get(a0) == [0, 14]
+    assert db.get(a1) == []
+    assert get_owner(db, 10) == a0
+
+def test_add_tx_rejects_empty_txs(mock_accts):
+    a0, a1, a2 = [a.address for a in mock_accts[:3]]
+    db = EphemDB()
+    add_deposit(db, a0, 10)
+    add_deposit(db, a1, 10)
+    assert add_tx(db, Tx(Msg(a0, a2, 5, 0), None, mock_signer)) is False
+    assert add_swap(db, make_swap([Msg(a0, a2, 5, 0), Msg(a1, a0, 10, 5)])) is False
+    assert db.get(a2) is None
+    assert [get_owner(db, i) for i in (4, 5, 10)] == [a0, a0, a1]
+    # The real owner's coins are untouched
+    assert add_tx(db, Tx(Msg(a0, a1, 3, 5), None, mock_signer)) is not False
+    assert db.get(a1) == [3, 7, 10, 19]
+
+def make_swap(msgs):
+    swap = Swap(msgs)
+    return [Tx(msg, swap, mock_signer) for msg in msgs]
+
+def test_add_swap(mock_accts):
+    a0, a1, a2 = [a.address for a in mock_accts[:3]]
+    db = EphemDB()
+    for a in (a0, a1, a2):
+        add_deposit(db, a, 10)
+    # a0's coins 0-4 for a1's coins 10-14
+    assert add_swap(db, make_swap([Msg(a0, a1, 0, 5), Msg(a1, a0, 10, 5)]))
+    assert db.get(a0) == [5, 14]
+    assert db.get(a1) == [0, 4, 15, 19]
+    # a2 doesn't own coins 15-19, so neither leg lands
+    swap = make_swap([Msg(a0, a2, 5, 5), Msg(a2, a0, 15, 5)])
+    assert not add_swap(db, swap)
+    assert db.get(a0) == [5, 14]
+    assert db.get(a2) == [20, 29]
+    # Half a swap is rejected
+    assert not add_swap(db, make_swap([Msg(a0, a2, 5, 5), Msg(a2, a0, 20, 5)])[:1])
+    # Legs can't spend the same coins twice
+    assert not add_swap(db, make_swap([Msg(a0, a2, 5, 5), Msg(a0, a1, 7, 5)]))
+    assert db.get(a0) == [5, 14]
+
+class CopyingDB(EphemDB):
+    ''' Stores copies of values, like a DB which serializes them would '''
+    def put(self, key, value):
+        super().put(key, pickle.dumps(value))
+
+    def get(self, key):
+        value = super().get(key)
+        return None if value is None else pickle.loads(value)
+
+    def iterator(self, *args, **kwargs):
+        for key, value in super().iterator(*args, **kwargs):
+            yield key, pickle.loads(value)
+
+def test_tx_validator_writes_back(mock_accts):
+    a0, a1, a2 = [a.address for a in mock_accts[:3]]
+    db = CopyingDB()
+    for a in (a0, a1, a2):
+        add_deposit(db, a, 10)
+    assert add_tx(db, Tx(Msg(a0, a1, 0, 5), None, mock_signer)) is not False
+    assert add_swap(db, make_swap([Msg(a1, a2, 0, 5), Msg(a2, a0, 20, 5)]))
+    # Every change to the coin map was stored, not just made to a copy
+    assert [get_owner(db, i) for i in (0, 5, 10, 20, 25)] == [a2, a0, a1, a0, a2]
+    assert add_tx(db, Tx(Msg(a1, a0, 0, 5), None, mock_signer)) is False
+    assert add_tx(db, Tx(Msg(a2, a0, 0, 5), None, mock_signer)) is not False
+
+def test_coin_map_from_flat_lists(mock_accts):
+    a0, a1 = mock_accts[0].address, mock_accts[1].address
+    # A DB with only flat per-owner lists, as written before the coin map existed
+    db = EphemDB()
+    # Back to back deposits of one owner used to be stored unmerged
+    db.put(a0, [0, 4, 5, 9, 15, 19])
+    db.put(a1, [10, 14])
+    db.put('total_deposits', 20)
+    # Spans two of a0's stored ranges
+    assert add_tx(db, Tx(Msg(a0, a1, 3, 4), None, mock_signer)) is not False
+    assert db.get(a0) == [0, 2, 7, 9, 15, 19]
+    assert db.get(a1) == [3, 6, 10, 14]
+    assert add_tx(db, Tx(Msg(a0, a1, 15, 5), None, mock_signer)) is not False
+    assert db.get(a1) == [3, 6, 10, 19]
+    assert [get_owner(db, i) for i in (0, 3, 7, 10, 15, 20)] == [a0, a1, a0, a1, a1, None]
+    assert add_tx(db, Tx(Msg(a0, a1, 1, 3), None, mock_signer)) is False
+
+def test_swap_legs_only_land_together(mock_accts):
+    a0, a1, a2 = [a.address for a in mock_accts[:3]]
+    db = EphemDB()
+    for a in (a0, a1, a2):
+        add_deposit(db, a, 10)
+    legs = make_swap([Msg(a0, a1, 0, 5), Msg(a1, a0, 10, 5)])
+    # A lone leg is never applied by add_tx
+    assert add_tx(db, legs[0]) is False
+    assert db.get(a0) == [0, 9]
+    incomplete = make_swap([Msg(a0, a2, 5, 5), Msg(a2, a0, 20, 5)])[:1]
+    # Coins 0-4 are a1's by the time this swap comes up
+    invalid = make_swap([Msg(a2, a0, 25, 5), Msg(a0, a2, 0, 5)])
+    plain = Tx(Msg(a2, a1, 20, 2), None, mock_signer)
+    # Legs are grouped wherever they are in the batch & each gets the swap's result
+    results = apply_txs(db, [legs[1], plain, incomplete[0], invalid[0], legs[0], invalid[1]])
+    assert [result is not False for result in results] == [True, True, False, False, True, False]
+    assert db.get(a0) == [5, 14]
+    assert db.get(a1) == [0, 4, 15, 21]
+    assert db.get(a2) == [22, 29]
+    # A leg rejected up front, eg. for its signature, sinks the whole swap
+    legs = make_swap([Msg(a0, a2, 5, 5), Msg(a2, a0, 22, 5)])
+    assert apply_txs(db, legs, [True, False]) == [False, False]
+    assert db.get(a0) == [5, 14]
+
+def test_swap_legs_with_separate_swaps(mock_accts):
+    a0, a1 = mock_accts[0].address, mock_accts[1].address
+    db = EphemDB()
+    add_deposit(db, a0, 10)
+    add_deposit(db, a1, 10)
+    msgs = [Msg(a0, a1, 0, 5), Msg(a1, a0, 10, 5)]
+    # Each party builds & signs its own leg
+    legs = [Tx(msg, Swap(msgs), mock_signer) for msg in msgs]
+    assert apply_txs(db, legs) == [True, True]
+    assert db.get(a0) == [5, 14]
+    # Legs read back from disk are separate objects too
+    legs = [pickle.loads(pickle.dumps(leg)) for leg in make_swap([Msg(a0, a1, 5, 5), Msg(a1, a0, 0, 5)])]
+    assert add_swap(db, legs)
+    assert db.get(a0) == [0, 4, 10, 14]
+    # But not legs of different swaps
+    legs = [make_swap([msg, Msg(a1, a0, 15, 5)])[0] for msg in (Msg(a0, a1, 0, 5), Msg(a1, a0, 15, 5))]
+    assert not add_swap(db, legs)
+
+def test_tx_validator_fragmented_owners(mock_accts):
+    ''' Like test_tx_validator, but every owner starts out with 10k one coin ranges '''
+    accts = mock_accts[:10]
+    db = EphemDB()
+    for a in accts:
+        db.put(a.address, [])
+    # Round robin deposits so no two ranges of an owner are adjacent
+    for i in range(100000):
+        add_deposit(db, accts[i % len(accts)].address, 1)
+    nodes = [TestNode(db, a, accts) for a in accts]
+    start_time = time.time()
+    total_txs = 10000
+    accepted = 0
+    for i in range(total_txs // len(nodes)):
+        txs = []
+        for n in nodes:
+            n.add_random_tx(txs, False)
+        for t in txs:
+            accepted += add_tx(db, t) is not False
+    end_time = time.time() - start_time
+    assert accepted == total_txs
+    assert sum(len(db.get(a.address)) // 2 for a in accts) > 50000
+    print('Processed', total_txs, 'transactions over owners with', 100000 // len(accts), 'ranges each')
+    print("--- in %s seconds ---" % (end_time))
+
 def test_generate_block(w3, tester, accts):
     db = EphemDB()
     # Generate transactions
@@ -221,3 +414,62 @@ def test_generate_block(w3, tester, accts):
     print("--- in %s seconds ---" % (end_time))
 
     print('done')
+
+def test_create_tx_buckets(mock_accts):
+    db = EphemDB()
+    txs = generate_txs(300, 40, 1000, 10, mock_accts)
+    buckets = create_tx_buckets(db, txs)
+    txs_by_start = sorted(txs, key=lambda tx: tx.start)
+    # Buckets tile the coins from 0 to the last tx end
+    assert buckets[0].start == 0
+    for bucket, next_bucket in zip(buckets, buckets[1:]):
+        active_txs = [tx for tx in txs_by_start if tx.start <= bucket.start < tx.start + tx.offset]
+        if len(active_txs) == 0:
+            assert [tx.plaintext() for tx in bucket.txs] == [b'null']
+        else:
+            assert bucket.txs == active_txs
+    assert max(tx.start + tx.offset for tx in txs) > buckets[-1].start
+
+@pytest.mark.parametrize('total_txs', [10000, pytest.param(100000, marks=pytest.mark.slow), pytest.param(1000000, marks=pytest.mark.slow)])
+def test_generate_block_benchmark(mock_accts, total_txs):
+    db = EphemDB()
+    txs = generate_txs(total_txs, total_txs // 2, total_txs, 10, mock_accts)
+    start_time = time.time()
+    buckets = create_tx_buckets(db, txs)
+    bucket_time = time.time() - start_time
+    root_hash = construct_tree(db, [bucket.tx_merkle_tree_root_hash for bucket in buckets])
+    end_time = time.time() - start_time
+    print('Processed', total_txs, 'transactions into', len(buckets), 'buckets')
+    print("--- buckets in %s seconds, block in %s seconds ---" % (bucket_time, end_time))
+
+def build_block(txs, pool):
+    db = EphemDB()
+    start_time = time.time()
+    buckets = create_tx_buckets(db, txs, pool)
+    root_hash = construct_tree(db, [bucket.tx_merkle_tree_root_hash for bucket in buckets], pool)
+    return root_hash, db, time.time() - start_time
+
+def test_parallel_block_generation(mock_accts, monkeypatch):
+    # Small chunks so every block is split across several tasks
+    monkeypatch.setattr(block_generator, 'BUCKET_CHUNK_SIZE', 64)
+    monkeypatch.setattr(block_generator, 'TREE_CHUNK_LEAVES', 32)
+    with ProcessPoolExecutor(2) as pool:
+        for total_txs, total_deposits in ((20, 100), (3000, 10000)):
+            txs = generate_txs(total_txs, total_txs // 10, total_deposits, 10, mock_accts)
+            root_hash, db, build_time = build_block(txs, None)
+            parallel_root_hash, parallel_db, build_time = build_block(txs, pool)
+            assert parallel_root_hash == root_hash
+            assert list(parallel_db.iterator()) == list(db.iterator())
+    # Every chunk size splits the tree into subtrees of the serial tree
+    leaves = [add_sum_to_hash(Web3.sha3(i.to_bytes(2, byteorder='big')), i % 5 + 1) for i in range(1000)]
+    with ThreadPoolExecutor(2) as pool:
+        for chunk_leaves in (1, 2, 16, 64, 512):
+            assert build_tree_parallel(leaves, sum_hash_parent, 32, pool=pool, chunk_leaves=chunk_leaves) == construct_tree(EphemDB(), leaves)
+
+@pytest.mark.slow
+@pytest.mark.parametrize('workers', [1, 2, 4, 8, 16])
+def test_parallel_block_generation_benchmark(mock_accts, workers):
+    txs = generate_txs(100000, 50000, 100000, 10, mock_accts)
+    with ProcessPoolExecutor(workers) as pool:
+        root_hash, db, build_time = build_block(txs, pool)
+    print('Built a 100000 tx block with', workers, 'workers in', build_time, 'seconds')
@@ -0,0 +1,46 @@
+import os
+import time
+from random import randrange, seed
+from plasmalib.operator.block_generator import EphemDB, create_tx_buckets, construct_tree
+from plasmalib.operator.block_store import write_block_file, BlockFile, get_level_counts
+from plasmalib.operator.proofs import get_branch, verify_branch, get_node_sum
+from plasmalib.utils import Msg, Tx
+
+def get_block_path(name):
+    os.makedirs('/tmp/plasma_prime_block_files', exist_ok=True)
+    return '/tmp/plasma_prime_block_files/%s-%s' % (name, time.time())
+
+def test_get_level_counts():
+    assert get_level_counts(1) == [1]
+    assert get_level_counts(5) == [5, 3, 2, 1]
+    assert get_level_counts(8) == [8, 4, 2, 1]
+
+def test_block_file(mock_accts, random_txs):
+    seed(5)
+    db = EphemDB()
+    buckets = create_tx_buckets(db, random_txs(mock_accts[:10], 300, 1000))
+    root = construct_tree(db, [bucket.tx_merkle_tree_root_hash for bucket in buckets])
+    path = get_block_path('block')
+    assert write_block_file(path, buckets) == root
+    block = BlockFile(path)
+    assert block.get_root() == root
+    assert block.num_buckets == len(buckets)
+    total = get_node_sum(root)
+    for coin in [0, total - 1] + [randrange(total) for i in range(50)]:
+        bucket, leaf, branch = block.get_branch(coin)
+        # Same branch as walking the indexed tree in the DB
+        assert (leaf, branch) == get_branch(db, root, coin)
+        assert verify_branch(root, coin, leaf, branch)
+        assert leaf == buckets[bucket].tx_merkle_tree_root_hash
+        assert block.get_bucket_txs(bucket) == [tx.plaintext() for tx in buckets[bucket].txs]
+    block.close()
+
+def test_single_bucket_block_file(mock_accts, mock_signer):
+    db = EphemDB()
+    buckets = create_tx_buckets(db, [Tx(Msg(mock_accts[0].address, mock_accts[1].address, 0, 5), None, mock_signer)])
+    path = get_block_path('single')
+    root = write_block_file(path, buckets)
+    block = BlockFile(path)
+    assert block.get_branch(3) == (0, root, [])
+    assert block.get_bucket_txs(0) == [buckets[0].txs[0].plaintext()]
+    block.close()
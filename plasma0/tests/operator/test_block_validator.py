@@ -0,0 +1,91 @@
+import pytest
+from random import randrange, seed
+import time
+import numpy as np
+from plasmalib.operator.block_generator import EphemDB
+from plasmalib.operator.block_validator import validate_block, get_overlap_mask
+from plasmalib.operator.transaction_validator import add_deposit, add_tx, get_coin_map
+from plasmalib.utils import Msg, Tx, Swap
+
+def make_db(accts, num_deposits):
+    db = EphemDB()
+    for i in range(num_deposits):
+        add_deposit(db, accts[randrange(len(accts))].address, randrange(1, 10))
+    return db
+
+def test_get_overlap_mask():
+    starts = np.array([10, 0, 5, 20, 30])
+    ends = np.array([12, 4, 10, 25, 30])
+    assert list(get_overlap_mask(starts, ends)) == [True, False, True, False, False]
+
+def test_validate_block(mock_accts, random_txs):
+    seed(1)
+    accts = mock_accts[:10]
+    db = make_db(accts, 1000)
+    txs = random_txs(accts, 200, db.get('total_deposits'), coin_map=get_coin_map(db))
+    mask = validate_block(db, txs)
+    coin_map = get_coin_map(db)
+    for i, tx in enumerate(txs):
+        end = tx.start + tx.offset - 1
+        overlaps = any(j != i and other.start <= end and tx.start <= other.start + other.offset - 1 for j, other in enumerate(txs))
+        assert mask[i] == (coin_map.is_owner(tx.sender, tx.start, end) and not overlaps)
+    assert 0 < mask.sum() < len(txs)
+    # Every tx which passed applies cleanly one by one
+    for tx, valid in zip(txs, mask):
+        if valid:
+            assert add_tx(db, tx) is not False
+
+def test_validate_block_swaps(mock_accts, mock_signer):
+    a0, a1, a2 = [a.address for a in mock_accts[:3]]
+    db = EphemDB()
+    for a in (a0, a1, a2):
+        add_deposit(db, a, 10)
+
+    def make_swap(msgs):
+        swap = Swap(msgs)
+        return [Tx(msg, swap, mock_signer) for msg in msgs]
+    valid = make_swap([Msg(a0, a1, 0, 5), Msg(a1, a0, 10, 5)])
+    # a2 doesn't own coins 5-9, so neither leg is valid
+    invalid = make_swap([Msg(a2, a0, 20, 5), Msg(a2, a1, 5, 5)])
+    incomplete = make_swap([Msg(a2, a0, 25, 2), Msg(a0, a2, 15, 2)])[:1]
+    assert list(validate_block(db, valid + invalid + incomplete)) == [True, True, False, False, False]
+    # Legs built separately, as each party signs its own, are still one swap
+    msgs = [Msg(a0, a2, 5, 5), Msg(a2, a0, 20, 5)]
+    assert list(validate_block(db, [Tx(msg, Swap(msgs), mock_signer) for msg in msgs])) == [True, True]
+
+def test_validate_block_wei_amounts(mock_accts, mock_signer):
+    seed(2)
+    accts = [a.address for a in mock_accts[:3]]
+    db = EphemDB()
+    # 10 ETH in wei puts coins past 2**63
+    for i in range(6):
+        add_deposit(db, accts[i % 3], 10**19)
+    starts = [randrange(6 * 10**19 - 10**18) for i in range(50)] + [2**64 + 5, 10**19 - 5, 2 * 10**19 - 5]
+    txs = []
+    for i, start in enumerate(starts):
+        sender = get_coin_map(db).get_owner(start) if i % 4 else accts[i % 3]
+        txs.append(Tx(Msg(sender, accts[(i + 1) % 3], start, randrange(1, 10**18)), None, mock_signer))
+    mask = validate_block(db, txs)
+    coin_map = get_coin_map(db)
+    for i, tx in enumerate(txs):
+        end = tx.start + tx.offset - 1
+        overlaps = any(j != i and other.start <= end and tx.start <= other.start + other.offset - 1 for j, other in enumerate(txs))
+        assert mask[i] == (coin_map.is_owner(tx.sender, tx.start, end) and not overlaps)
+    assert 0 < mask.sum() < len(txs)
+
+@pytest.mark.slow
+def test_validate_block_performance(mock_accts, random_txs):
+    accts = mock_accts[:10]
+    db = make_db(accts, 100000)
+    txs = random_txs(accts, 100000, db.get('total_deposits'), max_range=5, coin_map=get_coin_map(db))
+    start_time = time.time()
+    mask = validate_block(db, txs)
+    vectorized_time = time.time() - start_time
+    loop_txs = txs[:10000]
+    start_time = time.time()
+    for tx in loop_txs:
+        add_tx(db, tx)
+    loop_time = time.time() - start_time
+    print('Vectorized: validated', len(txs), 'txs (', mask.sum(), 'valid) in', vectorized_time, 'seconds')
+    print('add_tx loop:', len(loop_txs), 'txs in', loop_time, 'seconds')
+    print('Speedup per tx:', (loop_time / len(loop_txs)) / (vectorized_time / len(txs)))
@@ -0,0 +1,137 @@
+import pytest
+import os
+import time
+import tracemalloc
+from web3 import Web3
+from plasmalib.merkle import build_tree, iterate_levels, hash_parent, sum_hash_parent, sum_hash40_parent, IncrementalTree
+from plasmalib.operator.block_generator import EphemDB, construct_tree, merklize, add_sum_to_hash, new_block_tree, iterate_tx_buckets, create_tx_buckets
+from plasmalib.constants import MAX_TREE_DEPTH
+from plasmalib.utils import bytes_to_int, construct_tree as construct_tx_tree
+
+class DictDB:
+    def __init__(self):
+        self.kv = {}
+
+    def put(self, k, v):
+        self.kv[k] = v
+
+# The recursive builders the engine replaced, to check it against
+def reference_sum_tree(db, nodes):
+    if len(nodes) == 1:
+        return nodes[0]
+    remaining_nodes = []
+    for i in range(0, len(nodes), 2):
+        if i+1 == len(nodes):
+            remaining_nodes.append(nodes[i])
+            break
+        left_value = b'\x00' + nodes[i][1:]
+        right_value = b'\x01' + nodes[i+1][1:]
+        new_value = b''.join([left_value, right_value])
+        new_sum = bytes_to_int(nodes[i+1][24:]) + bytes_to_int(nodes[i][24:])
+        new_hash = add_sum_to_hash(Web3.sha3(new_value), new_sum)
+        db.put(new_hash, new_value)
+        remaining_nodes.append(new_hash)
+    return reference_sum_tree(db, remaining_nodes)
+
+def reference_merklize(db, nodes):
+    if len(nodes) == 1:
+        return nodes[0]
+    remaining_nodes = []
+    for i in range(0, len(nodes), 2):
+        if i+1 == len(nodes):
+            remaining_nodes.append(nodes[i])
+            break
+        new_value = b''.join([nodes[i], nodes[i+1]])
+        new_hash = Web3.sha3(new_value)
+        db.put(new_hash, new_value)
+        remaining_nodes.append(new_hash)
+    return reference_merklize(db, remaining_nodes)
+
+def make_sum_leaves(count):
+    return [add_sum_to_hash(os.urandom(32), 1 + i % 7) for i in range(count)]
+
+def test_matches_reference_builders():
+    for count in list(range(1, 20)) + [255, 256, 257]:
+        leaves = make_sum_leaves(count)
+        db, reference_db = DictDB(), DictDB()
+        assert build_tree(leaves, sum_hash_parent, 32, db) == reference_sum_tree(reference_db, leaves)
+        assert db.kv == reference_db.kv
+        db, reference_db = DictDB(), DictDB()
+        assert build_tree(leaves, hash_parent, 32, db) == reference_merklize(reference_db, leaves)
+        assert db.kv == reference_db.kv
+
+def test_block_generator_trees():
+    leaves = make_sum_leaves(100)
+    db = EphemDB()
+    root = construct_tree(db, leaves)
+    assert root == reference_sum_tree(DictDB(), leaves)
+    # The root's sum is the sum of the leaves'
+    assert bytes_to_int(root[24:]) == sum(bytes_to_int(leaf[24:]) for leaf in leaves)
+    assert db.get(root) is not None
+    assert merklize(db, leaves) == reference_merklize(DictDB(), leaves)
+
+def test_sum_hash40_parent():
+    leaves = [os.urandom(32) + (i + 1).to_bytes(8, byteorder='big') for i in range(5)]
+    levels = list(iterate_levels(leaves, sum_hash40_parent, 40))
+    assert [len(level) // 40 for level in levels] == [5, 3, 2, 1]
+    root = levels[-1]
+    assert bytes_to_int(root[32:]) == 15
+    left, right = levels[2][0:40], levels[2][40:80]
+    assert root[:32] == Web3.sha3(left + right)
+    # The last node is carried up until it has a sibling
+    assert right == leaves[4]
+
+def test_incremental_tree():
+    leaves = make_sum_leaves(300)
+    db = DictDB()
+    tree = IncrementalTree(sum_hash_parent, db, index=True)
+    assert tree.get_root() is None
+    for i, leaf in enumerate(leaves):
+        tree.append(leaf)
+        # The provisional root is always the root of the leaves so far
+        assert tree.get_root() == build_tree(leaves[:i + 1], sum_hash_parent, 32)
+        assert len(tree.frontier) == (i + 1).bit_length()
+    assert tree.count == 300
+    full_db = DictDB()
+    assert tree.seal() == build_tree(leaves, sum_hash_parent, 32, full_db, index=True)
+    assert db.kv == full_db.kv
+
+def test_stream_block_tree(mock_accts, random_txs):
+    txs = random_txs(mock_accts[:10], 200, 1000)
+    db = EphemDB()
+    root = construct_tree(db, [bucket.tx_merkle_tree_root_hash for bucket in create_tx_buckets(db, txs)])
+    # Append buckets as the sweep finalizes them
+    streaming_db = EphemDB()
+    tree = new_block_tree(streaming_db)
+    for bucket in iterate_tx_buckets(streaming_db, txs):
+        tree.append(bucket.tx_merkle_tree_root_hash)
+    assert tree.seal() == root
+    assert list(streaming_db.iterator()) == list(db.iterator())
+
+def test_construct_tx_tree_padding(mock_accts, random_txs):
+    # Not a power of two, so the tree is padded with null txs
+    txs = random_txs(mock_accts[:10], 100, 10000)
+    root = construct_tx_tree(txs)
+    node = root
+    depth = 0
+    while hasattr(node, 'l'):
+        assert node.h == Web3.sha3(node.l.h + node.r.h)
+        node = node.l
+        depth += 1
+    assert depth == 7
+    # Proofs on chain are at most MAX_TREE_DEPTH long
+    with pytest.raises(AssertionError):
+        construct_tx_tree(random_txs(mock_accts[:10], 2**MAX_TREE_DEPTH + 1, 10000))
+
+@pytest.mark.slow
+def test_merkle_engine_benchmark():
+    leaves = make_sum_leaves(2**17)
+    for name, builder in (('recursive', reference_sum_tree), ('engine', lambda db, nodes: build_tree(nodes, sum_hash_parent, 32, db))):
+        db = EphemDB()
+        tracemalloc.start()
+        start_time = time.time()
+        builder(db, leaves)
+        end_time = time.time() - start_time
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        print(name, 'built a tree of', len(leaves), 'leaves in', end_time, 'seconds, peak', peak // 2**20, 'MiB')
@@ -0,0 +1,88 @@
+import time
+import plyvel
+from web3 import Web3
+from plasmalib.migrate_state import migrate_v1_to_v2
+from plasmalib.state import State, decode_range_key
+from plasmalib.utils import (
+    int_to_big_endian8,
+    int_to_big_endian32,
+)
+
+
+def put_v1_range(db, owner, token_id, start, offset):
+    token_id, start = int_to_big_endian8(token_id), int_to_big_endian32(start)
+    db.put(owner + b'-nonce', int_to_big_endian8(0))
+    db.put(owner + token_id + start, b'1')
+    db.put(token_id + start + b'-0offset', int_to_big_endian32(offset))
+    db.put(token_id + start + b'-1owner', owner)
+
+class InterruptedDB:
+    ''' Wraps a plyvel DB & raises instead of writing its `writes_left + 1`th batch '''
+    def __init__(self, db, writes_left):
+        self.db = db
+        self.writes_left = writes_left
+
+    def __getattr__(self, name):
+        return getattr(self.db, name)
+
+    def write_batch(self):
+        wb = self.db.write_batch()
+        write = wb.write
+
+        def interrupt():
+            if self.writes_left == 0:
+                raise KeyboardInterrupt
+            self.writes_left -= 1
+            write()
+        return InterruptedBatch(wb, interrupt)
+
+class InterruptedBatch:
+    def __init__(self, wb, write):
+        self.put = wb.put
+        self.delete = wb.delete
+        self.write = write
+
+def test_migrate_v1_to_v2(mock_accts):
+    db_path = '/tmp/plasma_prime_blank_test_db/' + str(time.time())
+    file_log_path = '/tmp/plasma_prime_blank_test_tx_log/' + str(time.time())
+    owners = [Web3.toBytes(hexstr=a.address) for a in mock_accts[0:2]]
+    db = plyvel.DB(db_path, create_if_missing=True)
+    for i in range(10):
+        put_v1_range(db, owners[i % 2], 0, i*10, 10)
+    db.put(b'total_deposits-' + int_to_big_endian8(0), int_to_big_endian32(100))
+    # Use a small batch size so the migration spans several batches
+    assert migrate_v1_to_v2(db, batch_size=3) == 10
+    db.close()
+    state = State(db_path, file_log_path)
+    assert list(range(0, 100, 10)) == [decode_range_key(r)[1] for r in state.get_ranges(0, 0, 99)]
+    assert state.verify_ranges_owner(state.get_ranges(0, 20, 29), mock_accts[0].address)
+    assert state.verify_ranges_owner(state.get_ranges(0, 30, 39), mock_accts[1].address)
+    # Every key was rewritten--nothing of the v1 layout is left
+    assert all(len(k) != 48 and len(k) != 47 for k in state.db.iterator(include_value=False))
+    assert state.get_balance(mock_accts[1].address, 0) == 50
+    state.add_deposit(mock_accts[0].address, 0, 10)
+    assert [90, 100] == [decode_range_key(r)[1] for r in state.get_ranges(0, 95, 100)]
+
+def test_resume_interrupted_migration(mock_accts):
+    owners = [Web3.toBytes(hexstr=a.address) for a in mock_accts[0:3]]
+    interrupted = 0
+    for writes_left in range(20):
+        db_path = '/tmp/plasma_prime_blank_test_db/' + str(time.time())
+        db = plyvel.DB(db_path, create_if_missing=True)
+        for i in range(10):
+            put_v1_range(db, owners[i % 3], 0, i*10, 10)
+        try:
+            migrate_v1_to_v2(InterruptedDB(db, writes_left), batch_size=3)
+        except KeyboardInterrupt:
+            interrupted += 1
+            # Re-running picks up where the interrupted run stopped
+            migrate_v1_to_v2(db, batch_size=3)
+        db.close()
+        state = State(db_path, '/tmp/plasma_prime_blank_test_tx_log/' + str(time.time()))
+        assert list(range(0, 100, 10)) == [decode_range_key(r)[1] for r in state.get_ranges(0, 0, 99)]
+        assert all(len(k) != 48 and len(k) != 47 for k in state.db.iterator(include_value=False))
+        assert [state.get_balance(a.address, 0) for a in mock_accts[0:3]] == [40, 30, 30]
+        assert state.get_owned_ranges(mock_accts[2].address, 0) == [(20, 30), (50, 60), (80, 90)]
+        state.close()
+    # The migration was interrupted at every batch boundary before it finished
+    assert interrupted > 5
@@ -0,0 +1,64 @@
+import asyncio
+from eth_account import Account
+from eth_hash.auto import keccak
+from plasmalib.operator.operator_service import OperatorService
+from plasmalib.operator.transaction_validator import encode_transfer
+from plasmalib.operator.transactions import TransferRecord, Signature
+
+def run_service(service, coroutine_fn):
+    async def main():
+        service.start()
+        try:
+            return await coroutine_fn()
+        finally:
+            await service.stop()
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(main())
+    finally:
+        loop.close()
+
+def test_operator_service(blank_state, mock_accts):
+    for a in mock_accts[:10]:
+        blank_state.add_deposit(a.address, 0, 10)
+    service = OperatorService(blank_state, max_batch_size=4, max_batch_delay_ms=50, verify_sigs=False)
+    batch_sizes = []
+    commit_batch = service.commit_batch
+    def record_batch(txs, sigs):
+        batch_sizes.append(len(txs))
+        return commit_batch(txs, sigs)
+    service.commit_batch = record_batch
+    txs = [TransferRecord(mock_accts[i].address, mock_accts[i + 1].address, 0, i * 10, 10, 0, 0, 3) for i in range(9)]
+    # Not owned by the sender
+    txs.append(TransferRecord(mock_accts[0].address, mock_accts[1].address, 0, 95, 5, 0, 0, 3))
+    results = run_service(service, lambda: asyncio.gather(*[service.submit(tx) for tx in txs]))
+    # Every caller gets its own result & batches are cut by size
+    assert results == [True] * 9 + [False]
+    assert batch_sizes == [4, 4, 2]
+    assert blank_state.get_balance(mock_accts[9].address, 0) == 20
+
+def test_operator_service_batch_deadline(blank_state, mock_accts):
+    blank_state.add_deposit(mock_accts[0].address, 0, 10)
+    service = OperatorService(blank_state, max_batch_size=1000, max_batch_delay_ms=1, verify_sigs=False)
+    async def submit():
+        # A lone tx is committed once the batch deadline passes, without waiting for a full batch
+        return await asyncio.wait_for(service.submit(TransferRecord(mock_accts[0].address, mock_accts[1].address, 0, 0, 5, 0, 0, 3)), 5)
+    assert run_service(service, submit) == True
+    assert blank_state.get_balance(mock_accts[1].address, 0) == 5
+
+def test_operator_service_verifies_sigs(blank_state):
+    accts = [Account.create(str(i)) for i in range(3)]
+    blank_state.add_deposit(accts[0].address, 0, 10)
+    blank_state.add_deposit(accts[1].address, 0, 10)
+    service = OperatorService(blank_state, max_batch_size=3, max_batch_delay_ms=50)
+
+    def sign(sender, start, signer=None):
+        tx = TransferRecord(accts[sender].address, accts[2].address, 0, start, 5, 0, 0, 3)
+        sig = Account.signHash(keccak(encode_transfer(tx)), accts[sender if signer is None else signer].privateKey)
+        return tx, Signature(sig.v, sig.r, sig.s)
+    # Signed by its sender, signed by someone else & signed by a sender who doesn't own the coins
+    signed = [sign(0, 0), sign(1, 10, signer=0), sign(1, 5)]
+    results = run_service(service, lambda: asyncio.gather(*[service.submit(tx, sig) for tx, sig in signed]))
+    assert results == [True, False, False]
+    assert blank_state.get_owned_ranges(accts[2].address, 0) == [(0, 5)]
+    assert blank_state.get_balance(accts[1].address, 0) == 10
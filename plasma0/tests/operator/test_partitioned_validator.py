@@ -0,0 +1,89 @@
+from random import randrange, seed
+import time
+from plasmalib.operator.block_generator import EphemDB
+from plasmalib.operator.partitioned_validator import add_txs_partitioned, split_range, get_shard_bounds, get_coin_map_ranges
+from plasmalib.operator.transaction_validator import add_deposit, add_tx, apply_txs, get_coin_map
+from plasmalib.utils import Msg, Tx, Swap
+
+def make_dbs(accts, num_deposits):
+    ''' Returns two DBs with the same deposits '''
+    dbs = (EphemDB(), EphemDB())
+    for i in range(num_deposits):
+        owner, amount = accts[randrange(len(accts))].address, randrange(1, 10)
+        for db in dbs:
+            add_deposit(db, owner, amount)
+    return dbs
+
+def test_split_range():
+    bounds = get_shard_bounds(100, 4)
+    assert bounds == [0, 25, 50, 75, 100]
+    assert split_range(bounds, 3, 10) == [(0, 3, 10)]
+    assert split_range(bounds, 20, 60) == [(0, 20, 24), (1, 25, 49), (2, 50, 60)]
+    assert split_range(bounds, 90, 120) == [(3, 90, 120)]
+
+def test_add_txs_partitioned_matches_serial(mock_accts, random_txs, mock_signer):
+    seed(2)
+    accts = mock_accts[:5]
+    serial_db, partitioned_db = make_dbs(accts, 200)
+    coin_map = get_coin_map(serial_db)
+    # Large ranges so plenty of txs cross shards
+    txs = random_txs(accts, 500, serial_db.get('total_deposits'), max_range=40, coin_map=coin_map)
+    # Empty txs sent by the real owners, which must not touch the coin map
+    txs = [Tx(Msg(coin_map.get_owner(start), accts[0].address, start, 0), None, mock_signer) for start in (5, 60, 300)] + txs
+    serial_verdicts = [add_tx(serial_db, tx) is not False for tx in txs]
+    verdicts = add_txs_partitioned(partitioned_db, txs, num_shards=4)
+    assert verdicts == serial_verdicts
+    assert verdicts[:3] == [False, False, False]
+    assert 0 < sum(verdicts) < len(txs)
+    assert get_coin_map_ranges(get_coin_map(partitioned_db)) == get_coin_map_ranges(get_coin_map(serial_db))
+    for a in accts:
+        assert partitioned_db.get(a.address) == serial_db.get(a.address)
+    # Carries on from the stored state
+    more_txs = random_txs(accts, 100, serial_db.get('total_deposits'), max_range=40, coin_map=get_coin_map(serial_db))
+    assert add_txs_partitioned(partitioned_db, more_txs, num_shards=3) == [add_tx(serial_db, tx) is not False for tx in more_txs]
+
+def make_swaps(db, accts, num_swaps, max_range, signer):
+    ''' Returns the legs of swaps spread over the coins, some incomplete or invalid '''
+    total_deposits = db.get('total_deposits')
+    coin_map = get_coin_map(db)
+    txs = []
+    for i in range(num_swaps):
+        msgs = []
+        for j in range(randrange(2, 4)):
+            start = randrange(total_deposits - max_range)
+            sender = coin_map.get_owner(start) if randrange(4) else accts[randrange(len(accts))].address
+            msgs.append(Msg(sender, accts[randrange(len(accts))].address, start, randrange(1, max_range)))
+        swap = Swap(msgs)
+        legs = [Tx(msg, swap, signer) for msg in msgs]
+        txs += legs[1:] if randrange(5) == 0 else legs
+    return txs
+
+def test_add_txs_partitioned_swaps(mock_accts, random_txs, mock_signer):
+    seed(3)
+    accts = mock_accts[:5]
+    serial_db, partitioned_db = make_dbs(accts, 200)
+    txs = random_txs(accts, 300, serial_db.get('total_deposits'), max_range=40, coin_map=get_coin_map(serial_db))
+    txs += make_swaps(serial_db, accts, 60, 20, mock_signer)
+    txs = [txs[i] for i in sorted(range(len(txs)), key=lambda i: randrange(len(txs)))]
+    serial_verdicts = [result is not False for result in apply_txs(serial_db, txs)]
+    assert add_txs_partitioned(partitioned_db, txs, num_shards=4) == serial_verdicts
+    assert 0 < sum(verdict for tx, verdict in zip(txs, serial_verdicts) if tx.is_swap)
+    assert get_coin_map_ranges(get_coin_map(partitioned_db)) == get_coin_map_ranges(get_coin_map(serial_db))
+    for a in accts:
+        assert partitioned_db.get(a.address) == serial_db.get(a.address)
+
+def test_add_txs_partitioned_throughput(mock_accts, random_txs):
+    accts = mock_accts[:10]
+    serial_db, partitioned_db = make_dbs(accts, 10000)
+    txs = random_txs(accts, 20000, serial_db.get('total_deposits'), max_range=5, coin_map=get_coin_map(serial_db))
+    start_time = time.time()
+    serial_verdicts = [add_tx(serial_db, tx) is not False for tx in txs]
+    print('Serial:', len(txs), 'txs in', time.time() - start_time, 'seconds')
+    for num_shards in (1, 2, 4):
+        # Same starting state each run--the coin map itself is never modified, only replaced
+        db = EphemDB()
+        db.put('coin_map', get_coin_map(partitioned_db))
+        db.put('total_deposits', partitioned_db.get('total_deposits'))
+        start_time = time.time()
+        assert add_txs_partitioned(db, txs, num_shards) == serial_verdicts
+        print(num_shards, 'shards:', len(txs), 'txs in', time.time() - start_time, 'seconds')
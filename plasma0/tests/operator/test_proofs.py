@@ -0,0 +1,46 @@
+from random import randrange, seed
+from plasmalib.operator.block_generator import EphemDB, create_tx_buckets, construct_tree
+from plasmalib.operator.proofs import get_branch, verify_branch, get_multiproof, verify_multiproof, get_node_sum
+
+def make_block(txs):
+    db = EphemDB()
+    buckets = create_tx_buckets(db, txs)
+    root = construct_tree(db, [bucket.tx_merkle_tree_root_hash for bucket in buckets])
+    return db, root, buckets
+
+def get_bucket(buckets, coin):
+    for bucket, next_bucket in zip(buckets, buckets[1:] + [None]):
+        if next_bucket is None or coin < next_bucket.start:
+            return bucket
+
+def test_get_branch(mock_accts, random_txs):
+    seed(3)
+    db, root, buckets = make_block(random_txs(mock_accts[:10], 300, 1000))
+    total = get_node_sum(root)
+    for coin in [0, total - 1] + [randrange(total) for i in range(50)]:
+        leaf, branch = get_branch(db, root, coin)
+        assert leaf == get_bucket(buckets, coin).tx_merkle_tree_root_hash
+        assert len(branch) <= len(buckets).bit_length()
+        assert verify_branch(root, coin, leaf, branch)
+        # The proof is only good for coins in that bucket
+        assert not verify_branch(root, get_bucket(buckets, coin).start - 1, leaf, branch)
+        if len(branch) > 0:
+            sibling, sibling_is_left = branch[0]
+            assert not verify_branch(root, coin, leaf, [(sibling, not sibling_is_left)] + branch[1:])
+
+def test_multiproof(mock_accts, random_txs):
+    seed(4)
+    db, root, buckets = make_block(random_txs(mock_accts[:10], 300, 1000))
+    ranges = [(10, 12), (11, 40), (500, 501), (700, 760)]
+    proof = get_multiproof(db, root, ranges)
+    leaves = verify_multiproof(root, proof)
+    expected = [b for b in buckets if any(b.start < end and start < b.start + get_node_sum(b.tx_merkle_tree_root_hash) for start, end in ranges)]
+    assert [(start, leaf) for start, end, leaf in leaves] == [(b.start, b.tx_merkle_tree_root_hash) for b in expected]
+    # Shared nodes are only sent once
+    individual_nodes = sum(len(get_branch(db, root, start)[1]) + 1 for start, end, leaf in leaves)
+    assert len([entry for entry in proof if entry[0] != 'branch']) < individual_nodes
+    # A tampered proof doesn't match the root
+    i = next(i for i, entry in enumerate(proof) if entry[0] == 'node')
+    tampered = proof[:i] + [('node', b'\x00' * 32)] + proof[i + 1:]
+    assert verify_multiproof(root, tampered) is None
+    assert verify_multiproof(root, proof[:-1]) is None
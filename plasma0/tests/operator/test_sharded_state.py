@@ -0,0 +1,33 @@
+import time
+import pytest
+from plasmalib.sharded_state import ShardedState, get_shard
+from plasmalib.operator.transactions import TransferRecord
+
+@pytest.fixture
+def sharded_state():
+    db_path = '/tmp/plasma_prime_blank_test_db/sharded-' + str(time.time())
+    tx_log_path = '/tmp/plasma_prime_blank_test_tx_log/sharded-' + str(time.time())
+    state = ShardedState(db_path, tx_log_path, num_shards=2)
+    yield state
+    state.close()
+
+def test_get_shard():
+    assert [get_shard(token_id, 2) for token_id in range(4)] == [0, 1, 0, 1]
+
+def test_sharded_state(sharded_state, mock_accts):
+    a0, a1 = mock_accts[0].address, mock_accts[1].address
+    # Tokens 0 & 1 land on different shards
+    for token_id in range(2):
+        sharded_state.add_deposit(a0, token_id, 10)
+        sharded_state.add_deposit(a1, token_id, 10)
+    txs = [
+        TransferRecord(a0, a1, 0, 0, 5, 0, 0, 3),
+        TransferRecord(a1, a0, 1, 10, 10, 0, 0, 3),
+        # Not owned by the sender, so only this one is rejected
+        TransferRecord(a0, a1, 0, 10, 1, 0, 0, 3),
+    ]
+    assert sharded_state.add_transaction(txs) == [True, True, False]
+    assert sharded_state.get_balance(a0, 0) == 5
+    assert sharded_state.get_owned_ranges(a0, 1) == [(0, 20)]
+    assert sharded_state.get_balances(a0) == {0: 5, 1: 20}
+    assert sharded_state.get_balances(a1) == {0: 15, 1: 0}
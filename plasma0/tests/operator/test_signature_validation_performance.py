@@ -1,4 +1,10 @@
+import pytest
 import time
+from concurrent.futures import ProcessPoolExecutor
+from eth_account import Account
+from web3 import Web3
+from plasmalib.operator.transactions import TransferRecord, Signature
+from plasmalib.operator.transaction_validator import validate_tx_sigs
 
 def test_signature_validation_performance(w3, accts):
     raw_txs = []
@@ -19,3 +25,41 @@ def test_signature_validation_performance(w3, accts):
     for r in raw_txs:
         w3.eth.account.recoverTransaction(r)
     print('Total time to recover', num_sigs, 'sigs:', time.time() - start_time)  # On my macbook I was processing 100 sigs per second.
+
+def sign_transfers(accts, num_sigs):
+    transfers = []
+    sigs = []
+    for i in range(num_sigs):
+        sender = accts[i % len(accts)]
+        recipient = accts[(i + 1) % len(accts)]
+        tr = TransferRecord(Web3.toBytes(hexstr=sender.address), Web3.toBytes(hexstr=recipient.address), 0, i*10, 10, 0, 0, 3)
+        sig = Account.signHash(tr.hash, sender.privateKey)
+        transfers.append(tr)
+        sigs.append(Signature(sig.v, sig.r, sig.s))
+    return transfers, sigs
+
+def test_validate_tx_sigs(accts):
+    transfers, sigs = sign_transfers(accts, 20)
+    # Swap two signatures & blank out another
+    sigs[3], sigs[4] = sigs[4], sigs[3]
+    sigs[7] = Signature(0, 0, 0)
+    expected = [i not in (3, 4, 7) for i in range(20)]
+    assert validate_tx_sigs(list(zip(transfers, sigs))) == expected
+    with ProcessPoolExecutor(max_workers=2) as pool:
+        assert validate_tx_sigs(list(zip(transfers, sigs)), pool, chunk_size=3) == expected
+
+@pytest.mark.slow
+def test_batch_signature_validation_throughput(accts):
+    num_sigs = 1000
+    transfers, sigs = sign_transfers(accts, num_sigs)
+    pairs = list(zip(transfers, sigs))
+    start_time = time.time()
+    assert all(validate_tx_sigs(pairs))
+    print('Serial:', num_sigs / (time.time() - start_time), 'sigs per second')
+    for num_workers in [1, 2, 4, 8]:
+        with ProcessPoolExecutor(max_workers=num_workers) as pool:
+            # Warm up the workers so process start up isn't counted
+            validate_tx_sigs(pairs[0:num_workers], pool, chunk_size=1)
+            start_time = time.time()
+            assert all(validate_tx_sigs(pairs, pool))
+            print(num_workers, 'workers:', num_sigs / (time.time() - start_time), 'sigs per second')
@@ -1,10 +1,14 @@
+import pytest
+from concurrent.futures import ThreadPoolExecutor
 from random import randrange
 import time
+from eth_account import Account
+from web3 import Web3
 from eth_utils import (
     big_endian_to_int,
 )
-from plasmalib.state import get_total_deposits_key, State
-from plasmalib.operator.transactions import TransferRecord, SimpleSerializableList
+from plasmalib.state import get_total_deposits_key, decode_range_key, find_conflicting_transfers, State, RangeIndex
+from plasmalib.operator.transactions import TransferRecord, SimpleSerializableList, Signature
 from plasmalib.utils import (
     int_to_big_endian8,
 )
@@ -19,6 +23,27 @@ def test_deposit(blank_state, mock_accts):
     assert end_total_deposits == 1000
     print('End total deposits:', end_total_deposits)
 
+def test_add_deposits(blank_state, mock_accts):
+    state = blank_state
+    deposits = [(a.address, i % 2, 10) for i, a in enumerate(mock_accts)]
+    state.add_deposits(deposits)
+    for token_id in range(2):
+        assert big_endian_to_int(state.db.get(get_total_deposits_key(int_to_big_endian8(token_id)))) == 500
+    # Deposits get contiguous starts per token, in the order they were given
+    assert state.get_owned_ranges(mock_accts[0].address, 0) == [(0, 10)]
+    assert state.get_owned_ranges(mock_accts[2].address, 0) == [(10, 20)]
+    assert state.get_owned_ranges(mock_accts[3].address, 1) == [(10, 20)]
+    # Later deposits carry on from the stored counter
+    state.add_deposits([(mock_accts[0].address, 0, 5)])
+    assert state.get_owned_ranges(mock_accts[0].address, 0) == [(0, 10), (500, 505)]
+
+def test_performance_add_deposits(blank_state, mock_accts):
+    deposits = [(mock_accts[i % len(mock_accts)].address, i % 4, 10) for i in range(5000)]
+    start_time = time.time()
+    blank_state.add_deposits(deposits)
+    print('Added', len(deposits), 'deposits in', time.time() - start_time, 'seconds')
+    assert big_endian_to_int(blank_state.db.get(get_total_deposits_key(int_to_big_endian8(3)))) == 12500
+
 def make_simple_state(state, accts):
     for i in range(5):
         # Fill up tokens 0-99, alternating between two owners every 10 tokens
@@ -34,33 +59,246 @@ def test_add_transaction(blank_state, mock_accts):
     print(tr_list)
     print(tr_list.serializableElements)
     state.add_transaction(tr_list.serializableElements)
+    # The first 9 coins of each range changed hands & the last coin stayed put--acct 0's
+    # coins 9 & 10-18 are adjacent, so they were merged into one range
+    assert [0, 9, 19] == [decode_range_key(r)[1] for r in state.get_ranges(0, 0, 19)]
+    assert state.verify_ranges_owner(state.get_ranges(0, 0, 8), mock_accts[1].address)
+    assert state.verify_ranges_owner(state.get_ranges(0, 9, 9), mock_accts[0].address)
+    assert state.verify_ranges_owner(state.get_ranges(0, 10, 18), mock_accts[0].address)
+    assert state.verify_ranges_owner(state.get_ranges(0, 19, 19), mock_accts[1].address)
+
+def test_write_batch(blank_state, mock_accts):
+    state = make_simple_state(blank_state, mock_accts)
+    tr = TransferRecord(mock_accts[0].address, mock_accts[1].address, 0, 2, 5, 0, 0, 3)
+    with state.write_batch():
+        state.add_deposit(mock_accts[2].address, 0, 10)
+        state.add_transaction([tr])
+        # Staged writes are visible through the state...
+        assert [0, 2, 7] == [decode_range_key(r)[1] for r in state.get_ranges(0, 0, 9)]
+        assert state.verify_ranges_owner(state.get_ranges(0, 100, 109), mock_accts[2].address)
+        # ...but nothing has been written to the DB yet
+        assert big_endian_to_int(state.db.get(get_total_deposits_key(int_to_big_endian8(0)))) == 100
+    assert big_endian_to_int(state.db.get(get_total_deposits_key(int_to_big_endian8(0)))) == 110
+    assert [0, 2, 7] == [decode_range_key(r)[1] for r in state.get_ranges(0, 0, 9)]
+
+def test_write_batch_is_discarded_on_error(blank_state, mock_accts):
+    state = make_simple_state(blank_state, mock_accts)
+    tr = TransferRecord(mock_accts[0].address, mock_accts[1].address, 0, 0, 5, 0, 0, 3)
+    with pytest.raises(ValueError):
+        with state.write_batch():
+            state.add_transaction([tr])
+            state.add_deposit(mock_accts[2].address, 0, 10)
+            raise ValueError('Abort the batch')
+    assert [0] == [decode_range_key(r)[1] for r in state.get_ranges(0, 0, 9)]
+    assert state.verify_ranges_owner(state.get_ranges(0, 0, 9), mock_accts[0].address)
+    assert state.get_owned_ranges(mock_accts[2].address, 0) == []
+
+def test_add_transaction_rejects_invalid_txs(blank_state, mock_accts):
+    state = make_simple_state(blank_state, mock_accts)
+    txs = [
+        # Valid
+        TransferRecord(mock_accts[0].address, mock_accts[2].address, 0, 0, 5, 0, 0, 3),
+        # Coins 10-19 are owned by mock_accts[1]
+        TransferRecord(mock_accts[0].address, mock_accts[2].address, 0, 10, 5, 0, 0, 3),
+        # These two overlap each other, so both are rejected
+        TransferRecord(mock_accts[0].address, mock_accts[2].address, 0, 20, 5, 0, 0, 3),
+        TransferRecord(mock_accts[0].address, mock_accts[3].address, 0, 24, 2, 0, 0, 3),
+        # Valid, and right next to the first tx
+        TransferRecord(mock_accts[0].address, mock_accts[3].address, 0, 5, 5, 0, 0, 3),
+        # Past the last deposit
+        TransferRecord(mock_accts[1].address, mock_accts[2].address, 0, 95, 10, 0, 0, 3),
+    ]
+    assert state.add_transaction(txs) == [True, False, False, False, True, False]
+    assert state.get_owned_ranges(mock_accts[2].address, 0) == [(0, 5)]
+    assert state.get_owned_ranges(mock_accts[3].address, 0) == [(5, 10)]
+    assert state.get_balance(mock_accts[0].address, 0) == 40
+
+def test_invalid_txs_dont_conflict(blank_state):
+    accts = [Account.create(str(i)) for i in range(3)]
+    addresses = [Web3.toBytes(hexstr=acct.address) for acct in accts]
+    blank_state.add_deposit(addresses[0], 0, 10)
+
+    def sign(sender, start, offset):
+        tr = TransferRecord(addresses[sender], addresses[2], 0, start, offset, 0, 0, 3)
+        sig = Account.signHash(tr.hash, accts[sender].privateKey)
+        return tr, Signature(sig.v, sig.r, sig.s)
+    valid, valid_sig = sign(0, 0, 5)
+    # Overlaps the valid tx, but its signature is garbage
+    bad_sig, unused = sign(0, 3, 3)
+    # Overlaps the valid tx & is signed, but its sender owns nothing
+    not_owned, not_owned_sig = sign(2, 2, 2)
+    txs = [bad_sig, valid, not_owned]
+    assert blank_state.add_transaction(txs, [Signature(0, 0, 0), valid_sig, not_owned_sig]) == [False, True, False]
+    assert blank_state.get_owned_ranges(addresses[2], 0) == [(0, 5)]
+
+def test_add_transaction_hex_address_sigs(blank_state):
+    accts = [Account.create(str(i)) for i in range(3)]
+    blank_state.add_deposit(accts[0].address, 0, 10)
+    txs = [TransferRecord(accts[0].address, accts[2].address, 0, start, 5, 0, 0, 3) for start in (0, 5)]
+    # Signed over the encoding with byte addresses, as a client would
+    signed = TransferRecord(Web3.toBytes(hexstr=accts[0].address), Web3.toBytes(hexstr=accts[2].address), 0, 0, 5, 0, 0, 3)
+    sig = Account.signHash(signed.hash, accts[0].privateKey)
+    assert blank_state.add_transaction(txs, [Signature(sig.v, sig.r, sig.s), Signature(sig.v, sig.r, sig.s)]) == [True, False]
+    assert blank_state.get_owned_ranges(accts[2].address, 0) == [(0, 5)]
+
+def test_add_transaction_rejects_empty_txs(blank_state, mock_accts):
+    state = make_simple_state(blank_state, mock_accts)
+    tr = TransferRecord(mock_accts[0].address, mock_accts[2].address, 0, 5, 0, 0, 0, 3)
+    assert state.add_transaction([tr]) == [False]
+    assert state.get_balance(mock_accts[0].address, 0) == 50
+    assert state.get_owned_ranges(mock_accts[0].address, 0)[0] == (0, 10)
+    assert state.get_owned_ranges(mock_accts[2].address, 0) == []
+
+def test_find_conflicting_transfers(mock_accts):
+    def tr(token_id, start, offset):
+        return TransferRecord(mock_accts[0].address, mock_accts[1].address, token_id, start, offset, 0, 0, 3)
+    assert find_conflicting_transfers([tr(0, 0, 10), tr(0, 10, 5), tr(1, 5, 10)]) == set()
+    # Overlaps with a tx which isn't the one right before it in sorted order are found too
+    assert find_conflicting_transfers([tr(0, 0, 10), tr(0, 2, 1), tr(0, 5, 1), tr(0, 10, 1)]) == {0, 1, 2}
+    assert find_conflicting_transfers([tr(0, 6, 1), tr(0, 0, 5), tr(0, 1, 9), tr(1, 0, 9)]) == {0, 1, 2}
+
+def test_range_index_matches_db(blank_state, mock_accts):
+    state = make_simple_state(blank_state, mock_accts)
+    tr1 = TransferRecord(mock_accts[0].address, mock_accts[1].address, 0, 3, 5, 0, 0, 3)
+    tr2 = TransferRecord(mock_accts[1].address, mock_accts[2].address, 0, 5, 2, 0, 0, 3)
+    # tr2 spends coins received in tr1, so it has to go in a later batch
+    assert state.add_transaction([tr1]) == [True]
+    assert state.add_transaction([tr2]) == [True]
+    loaded_index = RangeIndex.load(state.db)
+    assert loaded_index.starts == state.range_index.starts
+    assert loaded_index.ranges == state.range_index.ranges
+    assert [(0, 3), (3, 5), (5, 7), (7, 8), (8, 10), (10, 20), (20, 30)] == [(r[0], r[1]) for r in state.range_index.get_overlapping(b'\x00'*8, 0, 29)]
+
+def test_owned_ranges_and_balances(blank_state, mock_accts):
+    state = make_simple_state(blank_state, mock_accts)
+    assert state.get_owned_ranges(mock_accts[0].address, 0) == [(0, 10), (20, 30), (40, 50), (60, 70), (80, 90)]
+    assert state.get_balance(mock_accts[0].address, 0) == 50
+    assert state.get_balance(mock_accts[2].address, 0) == 0
+    tr1 = TransferRecord(mock_accts[0].address, mock_accts[2].address, 0, 3, 5, 0, 0, 3)
+    tr2 = TransferRecord(mock_accts[1].address, mock_accts[2].address, 0, 10, 10, 0, 0, 3)
+    state.add_transaction([tr1, tr2])
+    assert state.get_owned_ranges(mock_accts[0].address, 0) == [(0, 3), (8, 10), (20, 30), (40, 50), (60, 70), (80, 90)]
+    assert state.get_owned_ranges(mock_accts[2].address, 0) == [(3, 8), (10, 20)]
+    assert state.get_owned_ranges(mock_accts[2].address, 1) == []
+    assert state.get_balance(mock_accts[0].address, 0) == 45
+    assert state.get_balance(mock_accts[1].address, 0) == 40
+    assert state.get_balance(mock_accts[2].address, 0) == 15
+
+def test_recover_from_tx_log(blank_state, mock_accts):
+    state = make_simple_state(blank_state, mock_accts)
+    tr1 = TransferRecord(mock_accts[0].address, mock_accts[2].address, 0, 3, 5, 0, 0, 3)
+    tr2 = TransferRecord(mock_accts[1].address, mock_accts[2].address, 0, 10, 10, 0, 0, 3)
+    with state.write_batch(block_number=7):
+        state.add_transaction([tr1, tr2])
+    tx_log_dir = state.tx_log.log_dir
+    state.close()
+    # Rebuild the state from the tx log alone, as if the DB had been lost
+    recovered_state = State('/tmp/plasma_prime_blank_test_db/' + str(time.time()), tx_log_dir)
+    assert recovered_state.get_owned_ranges(mock_accts[2].address, 0) == [(3, 8), (10, 20)]
+    assert recovered_state.block_number == 7
+    assert recovered_state.get_balance(mock_accts[0].address, 0) == 45
+    assert recovered_state.get_balance(mock_accts[1].address, 0) == 40
+    assert big_endian_to_int(recovered_state.db.get(get_total_deposits_key(int_to_big_endian8(0)))) == 100
+    # Records already in the DB are not replayed twice
+    db_dir = '/tmp/plasma_prime_blank_test_db/' + str(time.time())
+    recovered_state.close()
+    reopened_state = State(db_dir, tx_log_dir)
+    reopened_state.close()
+    reopened_state = State(db_dir, tx_log_dir)
+    assert reopened_state.get_balance(mock_accts[2].address, 0) == 15
+
+def test_snapshot_isolation(blank_state, mock_accts):
+    state = blank_state
+    with state.write_batch(block_number=0):
+        make_simple_state(state, mock_accts)
+    tr = TransferRecord(mock_accts[0].address, mock_accts[2].address, 0, 0, 20, 0, 0, 3)
+    with state.snapshot() as view:
+        with state.write_batch(block_number=1):
+            state.add_transaction([TransferRecord(mock_accts[1].address, mock_accts[0].address, 0, 10, 10, 0, 0, 3)])
+            # Readers don't see the half-applied block...
+            assert view.get_balance(mock_accts[0].address, 0) == 50
+            state.add_transaction([tr])
+        # ...or the committed block
+        assert view.block_number == 0
+        assert [0, 10] == [decode_range_key(r)[1] for r in view.get_ranges(0, 5, 15)]
+        assert view.verify_ranges_owner(view.get_ranges(0, 10, 19), mock_accts[1].address)
+        assert view.get_owned_ranges(mock_accts[2].address, 0) == []
+    with state.snapshot() as view:
+        assert view.block_number == 1
+        assert [0, 20] == [decode_range_key(r)[1] for r in view.get_ranges(0, 5, 25)]
+        assert view.verify_ranges_owner(view.get_ranges(0, 0, 19), mock_accts[2].address)
+        assert view.get_owned_ranges(mock_accts[2].address, 0) == [(0, 20)]
+        assert view.get_balance(mock_accts[0].address, 0) == 40
+    # Retained snapshots of older blocks can be read from other threads
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        balances = pool.map(lambda block_number: get_balance_at_block(state, block_number, mock_accts[2].address), [0, 1, 0, 1])
+        assert list(balances) == [0, 20, 0, 20]
+
+def get_balance_at_block(state, block_number, owner):
+    with state.snapshot(block_number) as view:
+        return view.get_balance(owner, 0)
+
+def test_coalesce_on_write(blank_state, mock_accts):
+    state = blank_state
+    # Back to back deposits by the same owner end up in one range
+    for i in range(5):
+        state.add_deposit(mock_accts[0].address, 0, 10)
+    state.add_deposit(mock_accts[1].address, 0, 10)
+    assert [0, 50] == [decode_range_key(r)[1] for r in state.get_ranges(0, 0, 59)]
+    # Sending coins back to the owner of both neighbours closes the gap
+    tr1 = TransferRecord(mock_accts[0].address, mock_accts[1].address, 0, 20, 10, 0, 0, 3)
+    tr2 = TransferRecord(mock_accts[1].address, mock_accts[0].address, 0, 20, 10, 0, 0, 3)
+    state.add_transaction([tr1])
+    assert [0, 20, 30, 50] == [decode_range_key(r)[1] for r in state.get_ranges(0, 0, 59)]
+    state.add_transaction([tr2])
+    assert [0, 50] == [decode_range_key(r)[1] for r in state.get_ranges(0, 0, 59)]
+    assert state.get_owned_ranges(mock_accts[0].address, 0) == [(0, 50)]
+    assert state.get_balance(mock_accts[0].address, 0) == 50
+
+def test_coalesce_ranges(blank_state, mock_accts):
+    state = blank_state
+    # Build fragmented ranges directly, bypassing the merge on the write path
+    with state.write_batch():
+        for i in range(10):
+            state.store_range(mock_accts[i // 4].address, 0, i * 10, 10)
+    metrics = state.get_range_metrics(0)
+    assert metrics['ranges'] == 10 and metrics['owners'] == 3 and metrics['max_ranges_per_owner'] == 4
+    # Merge in bounded passes until the whole key space has been visited
+    start = state.coalesce_ranges(0, max_ranges=1)
+    while start is not None:
+        start = state.coalesce_ranges(0, start, max_ranges=1)
+    assert [0, 40, 80] == [decode_range_key(r)[1] for r in state.get_ranges(0, 0, 99)]
+    assert state.get_range_metrics(0) == {'ranges': 3, 'owners': 3, 'ranges_per_owner': 1, 'max_ranges_per_owner': 1}
+    for i, owner in enumerate(mock_accts[:3]):
+        assert state.get_owned_ranges(owner.address, 0) == [(i * 40, min(i * 40 + 40, 100))]
+        assert state.get_balance(owner.address, 0) == min(40, 100 - i * 40)
 
 def test_get_ranges(blank_state, mock_accts):
     state = make_simple_state(blank_state, mock_accts)
-    assert [0, 0] == [big_endian_to_int(r[8:40]) for r in state.get_ranges(0, 0, 9)]
-    assert [10, 10, 20, 20] == [big_endian_to_int(r[8:40]) for r in state.get_ranges(0, 10, 29)]
-    assert [0, 0, 10, 10] == [big_endian_to_int(r[8:40]) for r in state.get_ranges(0, 5, 19)]
-    assert [0, 0, 10, 10, 20, 20] == [big_endian_to_int(r[8:40]) for r in state.get_ranges(0, 5, 29)]
+    assert [0] == [decode_range_key(r)[1] for r in state.get_ranges(0, 0, 9)]
+    assert [10, 20] == [decode_range_key(r)[1] for r in state.get_ranges(0, 10, 29)]
+    assert [0, 10] == [decode_range_key(r)[1] for r in state.get_ranges(0, 5, 19)]
+    assert [0, 10, 20] == [decode_range_key(r)[1] for r in state.get_ranges(0, 5, 29)]
 
 def test_delete_ranges(blank_state, mock_accts):
     state = make_simple_state(blank_state, mock_accts)
-    assert [0, 0] == [big_endian_to_int(r[8:40]) for r in state.get_ranges(0, 0, 9)]
+    assert [0] == [decode_range_key(r)[1] for r in state.get_ranges(0, 0, 9)]
     ranges_to_delete = state.get_ranges(0, 10, 29)
-    assert [10, 10, 20, 20] == [big_endian_to_int(r[8:40]) for r in ranges_to_delete]
+    assert [10, 20] == [decode_range_key(r)[1] for r in ranges_to_delete]
     state.delete_ranges(ranges_to_delete)
     new_ranges = state.get_ranges(0, 10, 29)
-    assert [0, 0] == [big_endian_to_int(r[8:40]) for r in new_ranges]
+    assert [0] == [decode_range_key(r)[1] for r in new_ranges]
 
 def test_check_ranges_owner(blank_state, mock_accts):
     state = make_simple_state(blank_state, mock_accts)
     state.add_deposit(mock_accts[1].address, 0, 10)
     test_range = state.get_ranges(0, 0, 9)
-    assert state.verify_ranges_owner(test_range[1::2], mock_accts[0].address)
+    assert state.verify_ranges_owner(test_range, mock_accts[0].address)
     test_range = state.get_ranges(0, 0, 19)
-    assert not state.verify_ranges_owner(test_range[1::2], mock_accts[0].address)
-    assert not state.verify_ranges_owner(test_range[1::2], mock_accts[1].address)
+    assert not state.verify_ranges_owner(test_range, mock_accts[0].address)
+    assert not state.verify_ranges_owner(test_range, mock_accts[1].address)
     test_range = state.get_ranges(0, 90, 109)
-    assert state.verify_ranges_owner(test_range[1::2], mock_accts[1].address)
+    assert state.verify_ranges_owner(test_range, mock_accts[1].address)
 
 
 def test_performace_get_ranges(blank_state, mock_accts):
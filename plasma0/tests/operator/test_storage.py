@@ -0,0 +1,120 @@
+import pytest
+import sys
+import threading
+import time
+from random import randrange, seed
+from plasmalib.state import State
+from plasmalib.storage import LevelDBBackend, MemoryBackend, LMDBBackend
+from plasmalib.operator.transactions import TransferRecord
+
+
+def get_backend(name):
+    if name == 'lmdb':
+        pytest.importorskip('lmdb')
+    return {'leveldb': LevelDBBackend, 'memory': MemoryBackend, 'lmdb': LMDBBackend}[name]
+
+@pytest.fixture(params=['leveldb', 'memory', 'lmdb'])
+def backend(request):
+    return get_backend(request.param)
+
+def test_backend_interface(backend):
+    db = backend('/tmp/plasma_prime_blank_test_db/' + str(time.time()))
+    for i in [5, 1, 3, 2, 4]:
+        db.put(b'a' + bytes([i]), bytes([i]))
+    db.put(b'b', b'b')
+    db.delete(b'a\x04')
+    assert db.get(b'a\x04') is None
+    assert db.get(b'a\x03') == b'\x03'
+    assert list(db.iterator(prefix=b'a', include_value=False)) == [b'a\x01', b'a\x02', b'a\x03', b'a\x05']
+    assert list(db.iterator(start=b'a\x02', stop=b'a\x05')) == [(b'a\x02', b'\x02'), (b'a\x03', b'\x03')]
+    assert list(db.iterator(start=b'a\x02', stop=b'a\x05', reverse=True, include_value=False)) == [b'a\x03', b'a\x02']
+    assert list(db.iterator(reverse=True, include_value=False))[0] == b'b'
+    snapshot = db.snapshot()
+    wb = db.write_batch()
+    wb.put(b'a\x04', b'\x04')
+    wb.delete(b'a\x01')
+    assert db.get(b'a\x04') is None
+    wb.write()
+    assert list(db.iterator(prefix=b'a', include_value=False)) == [b'a\x02', b'a\x03', b'a\x04', b'a\x05']
+    # The snapshot still sees the DB from before the batch
+    assert snapshot.get(b'a\x04') is None
+    assert list(snapshot.iterator(prefix=b'a', include_value=False)) == [b'a\x01', b'a\x02', b'a\x03', b'a\x05']
+    snapshot.close()
+    db.close()
+
+def test_snapshots_see_whole_batches(backend):
+    db = backend('/tmp/plasma_prime_blank_test_db/' + str(time.time()))
+    keys = [bytes([i]) for i in range(50)]
+    done = threading.Event()
+
+    def write_batches():
+        for i in range(3000):
+            wb = db.write_batch()
+            for key in keys:
+                wb.put(key, i.to_bytes(4, byteorder='big'))
+            wb.write()
+        done.set()
+    # Switch threads often so snapshots land in the middle of batches
+    switch_interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    try:
+        writer = threading.Thread(target=write_batches)
+        writer.start()
+        torn = 0
+        while not done.is_set():
+            snapshot = db.snapshot()
+            # Every key is written by each batch, so they must all hold the same value
+            if len(set(snapshot.get(key) for key in keys)) > 1:
+                torn += 1
+            snapshot.close()
+        writer.join()
+    finally:
+        sys.setswitchinterval(switch_interval)
+    assert torn == 0
+    db.close()
+
+def test_state_on_each_backend(backend, mock_accts):
+    db_path = '/tmp/plasma_prime_blank_test_db/' + str(time.time())
+    file_log_path = '/tmp/plasma_prime_blank_test_tx_log/' + str(time.time())
+    state = State(db_path, file_log_path, backend=backend)
+    for i in range(5):
+        state.add_deposit(mock_accts[0].address, 0, 10)
+        state.add_deposit(mock_accts[1].address, 0, 10)
+    state.add_transaction([TransferRecord(mock_accts[0].address, mock_accts[2].address, 0, 5, 5, 0, 0, 3)])
+    assert state.get_owned_ranges(mock_accts[0].address, 0) == [(0, 5), (20, 30), (40, 50), (60, 70), (80, 90)]
+    assert state.get_balance(mock_accts[2].address, 0) == 5
+    with state.snapshot() as view:
+        assert view.verify_ranges_owner(view.get_ranges(0, 5, 9), mock_accts[2].address)
+        assert view.get_owned_ranges(mock_accts[1].address, 0) == [(10, 20), (30, 40), (50, 60), (70, 80), (90, 100)]
+    state.close()
+
+def run_deposit_and_transfer_workload(state, accts, num_deposits, num_transfers):
+    seed(0)
+    for i in range(num_deposits):
+        state.add_deposit(accts[i % len(accts)].address, 0, 10)
+    num_applied = 0
+    for i in range(num_transfers):
+        sender = accts[randrange(len(accts))]
+        owned_ranges = state.get_owned_ranges(sender.address, 0)
+        start, end = owned_ranges[randrange(len(owned_ranges))]
+        offset = randrange(1, end - start + 1)
+        recipient = accts[randrange(len(accts))]
+        state.add_transaction([TransferRecord(sender.address, recipient.address, 0, start, offset, 0, 0, 3)])
+        num_applied += 1
+    return num_applied
+
+@pytest.mark.parametrize('backend_name', ['leveldb', 'memory', 'lmdb'])
+def test_backend_benchmark(backend_name, mock_accts):
+    backend = get_backend(backend_name)
+    db_path = '/tmp/plasma_prime_blank_test_db/' + str(time.time())
+    file_log_path = '/tmp/plasma_prime_blank_test_tx_log/' + str(time.time())
+    state = State(db_path, file_log_path, backend=backend)
+    start_time = time.time()
+    run_deposit_and_transfer_workload(state, mock_accts, 10000, 0)
+    deposit_time = time.time()
+    run_deposit_and_transfer_workload(state, mock_accts, 0, 5000)
+    transfer_time = time.time()
+    print('~~~~~~~~~~~~~~', backend_name, '~~~~~~~~~~~~~~')
+    print('10000 deposits:', deposit_time - start_time)
+    print('5000 transfers:', transfer_time - deposit_time)
+    state.close()
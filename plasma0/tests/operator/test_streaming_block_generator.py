@@ -0,0 +1,74 @@
+import os
+import pytest
+import time
+import tracemalloc
+from random import randrange, seed
+from web3 import Web3
+from plasmalib.operator.block_generator import EphemDB, create_tx_buckets, construct_tree, iterate_bucket_spans
+from plasmalib.operator.streaming_block_generator import generate_block, spill_txs, merge_runs, SpilledTx
+
+def get_spill_dir(name):
+    return '/tmp/plasma_prime_spills/%s-%s' % (name, time.time())
+
+class CountingDB:
+    ''' Drops every write, so only the generator itself uses memory '''
+    def __init__(self):
+        self.puts = 0
+
+    def put(self, key, value):
+        self.puts += 1
+
+def test_spill_txs(mock_accts, random_txs):
+    seed(1)
+    txs = random_txs(mock_accts[:10], 500, 1000, min_offset=0)
+    spill_dir = get_spill_dir('spill')
+    run_paths = spill_txs(txs, spill_dir, run_size=64)
+    assert len(run_paths) == 8
+    spilled = list(merge_runs(run_paths))
+    # Same order as a stable sort of every tx by start
+    txs_by_start = sorted(txs, key=lambda tx: tx.start)
+    assert [(tx.start, tx.offset, tx.h, tx.plaintext()) for tx in spilled] == [(tx.start, tx.offset, tx.h, tx.plaintext()) for tx in txs_by_start]
+    for path in run_paths:
+        os.remove(path)
+
+def test_generate_block(mock_accts, random_txs):
+    seed(2)
+    for num_txs, run_size in [(1, 4), (20, 4), (300, 7), (1000, 2**17)]:
+        txs = random_txs(mock_accts[:10], num_txs, 1000, min_offset=0)
+        db = EphemDB()
+        buckets = create_tx_buckets(db, txs)
+        root = construct_tree(db, [bucket.tx_merkle_tree_root_hash for bucket in buckets])
+        streamed_db = EphemDB()
+        spill_dir = get_spill_dir('generate')
+        streamed_root, num_buckets = generate_block(streamed_db, iter(txs), spill_dir, run_size)
+        assert streamed_root == root
+        assert num_buckets == len(buckets)
+        assert list(streamed_db.iterator()) == list(db.iterator())
+        # The spill is cleaned up
+        assert os.listdir(spill_dir) == []
+    assert generate_block(EphemDB(), [], get_spill_dir('empty')) == (None, 0)
+
+def test_iterate_bucket_spans_offset_zero():
+    # Empty txs are bucketed where they start, in the order they came in
+    txs = [SpilledTx(5, 0, b'a' * 32, b'a'), SpilledTx(0, 10, b'b' * 32, b'b'), SpilledTx(5, 0, b'c' * 32, b'c')]
+    spans = [(start, offset, [tx.h for tx in span_txs]) for start, offset, span_txs in iterate_bucket_spans(txs)]
+    assert spans == [(0, 5, [b'b' * 32]), (5, 5, [b'b' * 32])]
+
+def iterate_light_txs(num_txs):
+    ''' Yields txs as they'd be read from disk, without holding them all '''
+    for i in range(num_txs):
+        h = Web3.sha3(i.to_bytes(8, byteorder='big'))
+        yield SpilledTx(i * 7 % (num_txs * 3), randrange(1, 5), h, h * 6)
+
+@pytest.mark.slow
+def test_generate_block_memory():
+    seed(4)
+    num_txs = 50000
+    start_time = time.time()
+    tracemalloc.start()
+    root, num_buckets = generate_block(CountingDB(), iterate_light_txs(num_txs), get_spill_dir('memory'), run_size=2**12)
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print('Streamed', num_txs, 'txs into', num_buckets, 'buckets in', time.time() - start_time, 'seconds, peak memory', peak)
+    # Every tx's plaintext alone would be ~9MB
+    assert peak < 4 * 2**20
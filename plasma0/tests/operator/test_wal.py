@@ -0,0 +1,64 @@
+import os
+import time
+from plasmalib.wal import WriteAheadLog
+
+
+def get_log_dir():
+    return '/tmp/plasma_prime_blank_test_tx_log/' + str(time.time())
+
+def test_append_and_replay():
+    log = WriteAheadLog(get_log_dir())
+    positions = [log.append(b'record' + bytes([i])) for i in range(10)]
+    assert positions == sorted(positions)
+    assert [(p, b'record' + bytes([i])) for i, p in enumerate(positions)] == list(log.replay())
+    log.close()
+
+def test_group_commit():
+    log = WriteAheadLog(get_log_dir(), sync_records=5, sync_interval_ms=10**6)
+    for i in range(4):
+        log.append(b'record')
+    assert log.unsynced_records == 4
+    log.append(b'record')
+    assert log.unsynced_records == 0
+    log.close()
+
+def test_idle_log_is_synced():
+    log = WriteAheadLog(get_log_dir(), sync_records=100, sync_interval_ms=20)
+    position = log.append(b'record')
+    # Flushed to the OS straight away, so a process crash can't lose it
+    assert os.path.getsize(log.get_segment_path(position[0])) == position[1]
+    assert log.unsynced_records == 1
+    # & fsynced once the interval is up, even with no more appends
+    time.sleep(0.2)
+    assert log.unsynced_records == 0
+    log.close()
+
+def test_segment_rotation():
+    log_dir = get_log_dir()
+    log = WriteAheadLog(log_dir, segment_bytes=96)
+    for i in range(10):
+        log.append(b'x' * 40)
+    # Segments rotate once they hold two 48 byte records
+    assert log.get_segments() == [0, 1, 2, 3, 4]
+    assert len(list(log.replay())) == 10
+    assert len(list(log.replay(from_segment=3))) == 4
+    log.close()
+    # Reopening the log starts a new segment
+    log = WriteAheadLog(log_dir, segment_bytes=96)
+    assert log.segment_number == 5
+    assert len(list(log.replay())) == 10
+    log.close()
+
+def test_replay_skips_torn_records():
+    log_dir = get_log_dir()
+    log = WriteAheadLog(log_dir)
+    for i in range(3):
+        log.append(b'record' + bytes([i]))
+    log.close()
+    # Simulate a crash part way through writing a record
+    with open(os.path.join(log_dir, '0000000000000000.wal'), 'ab') as segment:
+        segment.write(b'\x00\x00\x00\x10\x00')
+    log = WriteAheadLog(log_dir)
+    log.append(b'after crash')
+    assert [payload for _, payload in log.replay()] == [b'record\x00', b'record\x01', b'record\x02', b'after crash']
+    log.close()